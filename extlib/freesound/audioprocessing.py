@@ -24,9 +24,11 @@ from PIL import Image, ImageDraw, ImageColor #@UnresolvedImport
 from functools import partial
 import math
 import numpy
+from numpy.lib.stride_tricks import as_strided
 import os
 import re
 import signal
+import tempfile
 
 
 def get_sound_type(input_filename):
@@ -46,6 +48,10 @@ except ImportError:
     print "WARNING: audiolab is not installed so wav2png will not work"
 import subprocess
 
+# The layout of raw PCM files given to BatchAudioProcessor
+PCM_DTYPE = numpy.dtype('<f4')
+PCM_CHANNELS = 2
+
 class AudioProcessingException(Exception):
     pass
 
@@ -165,7 +171,7 @@ class AudioProcessor(object):
 
         if resize_if_less and (add_to_start > 0 or add_to_end > 0):
             if add_to_start > 0:
-                samples = numpy.concatenate((numpy.zeros(add_to_start), samples), axis=1)
+                samples = numpy.concatenate((numpy.zeros(add_to_start), samples))
 
             if add_to_end > 0:
                 samples = numpy.resize(samples, size)
@@ -193,7 +199,7 @@ class AudioProcessor(object):
         if energy > 1e-60:
             # calculate the spectral centroid
 
-            if self.spectrum_range == None:
+            if self.spectrum_range is None:
                 self.spectrum_range = numpy.arange(length)
 
             spectral_centroid = (spectrum * self.spectrum_range).sum() / (energy * (length - 1)) * self.audio_file.samplerate * 0.5
@@ -251,6 +257,186 @@ class AudioProcessor(object):
         return (min_value, max_value) if min_index < max_index else (max_value, min_value)
 
 
+class BatchAudioProcessor(object):
+    """
+    Like AudioProcessor, but for all the columns of an image at once.
+
+    The file is decoded only once, into a memory-mapped array of samples,
+    and the spectra of all columns are computed by a few batched FFTs over
+    the windows of the array, instead of seeking and reading for each
+    column.
+
+    If samplerate is given, input_filename is not decoded at all but
+    memory-mapped directly: it has to be raw, interleaved, little endian
+    32 bit float PCM with two channels (see PCM_DTYPE), as decoded by
+    GStreamer alongside some other transcoding.
+    """
+    # How many frames to decode at once
+    read_block_size = 65536
+    # How many windows to run through the FFT at once, bounds the memory use
+    fft_batch_size = 1024
+
+    def __init__(self, input_filename, fft_size, window_function=numpy.hanning,
+                 tmp_dir=None, samplerate=None):
+        self.fft_size = fft_size
+        self.window = window_function(self.fft_size)
+        self.lower = 100
+        self.higher = 22050
+        self.lower_log = math.log10(self.lower)
+        self.higher_log = math.log10(self.higher)
+
+        if samplerate is not None:
+            self.samples = self.map_pcm(input_filename)
+            self.samplerate = samplerate
+        else:
+            self.samples = self.read_samples(input_filename, tmp_dir)
+        self.nframes = len(self.samples)
+
+        max_level = max(self.samples.max(), -self.samples.min()) if self.nframes else 0
+
+        # figure out what the maximum value is for an FFT doing the FFT of a DC signal
+        fft = numpy.fft.rfft(numpy.ones(fft_size) * self.window)
+        max_fft = (numpy.abs(fft)).max()
+        # set the scale to normalized audio and normalized FFT
+        self.scale = 1.0/max_level/max_fft if max_level > 0 else 1
+
+    def map_pcm(self, pcm_filename):
+        """ memory-map the left channel of a raw PCM file, without copying it """
+        if not os.path.getsize(pcm_filename):
+            return numpy.zeros(0)
+
+        frames = numpy.memmap(pcm_filename, dtype=PCM_DTYPE, mode='r')
+        return frames.reshape((-1, PCM_CHANNELS))[:,0]
+
+    def read_samples(self, input_filename, tmp_dir=None):
+        """
+        Decode the whole file into a memory-mapped array of mono samples,
+        backed by an anonymous temporary file in tmp_dir.
+        """
+        audio_file = audiolab.Sndfile(input_filename, 'r')
+        try:
+            self.samplerate = audio_file.samplerate
+            if not audio_file.nframes:
+                return numpy.zeros(0)
+
+            # The memory map goes away together with the array
+            samples = numpy.memmap(
+                tempfile.TemporaryFile(dir=tmp_dir), dtype=numpy.float64,
+                mode='w+', shape=(audio_file.nframes,))
+
+            position = 0
+            n_samples_left = audio_file.nframes
+            while n_samples_left:
+                to_read = min(self.read_block_size, n_samples_left)
+
+                try:
+                    block = audio_file.read_frames(to_read)
+                except RuntimeError:
+                    # this can happen with a broken header, the rest of
+                    # the samples stay silent
+                    break
+
+                # convert to mono by selecting left channel only
+                if audio_file.channels > 1:
+                    block = block[:,0]
+
+                samples[position:position + to_read] = block
+                position += to_read
+                n_samples_left -= to_read
+        finally:
+            audio_file.close()
+
+        return samples
+
+    def seek_points(self, image_width):
+        """ the first sample of each of image_width columns, plus the end """
+        samples_per_pixel = self.nframes / float(image_width)
+        return (numpy.arange(image_width + 1) * samples_per_pixel).astype(numpy.intp)
+
+    def frames(self, seek_points):
+        """ the fft_size samples centered around each seek point, one row per seek point """
+        starts = seek_points - self.fft_size / 2
+        frames = numpy.zeros((len(starts), self.fft_size))
+
+        # All windows that lie within the samples are copied out of a
+        # (read-only) view of every fft_size long window of the samples
+        inside = (starts >= 0) & (starts + self.fft_size <= self.nframes)
+        if inside.any():
+            step = self.samples.strides[0]
+            windows = as_strided(
+                self.samples,
+                shape=(self.nframes - self.fft_size + 1, self.fft_size),
+                strides=(step, step))
+            frames[inside] = windows[starts[inside]]
+
+        # The few windows around the start and end are padded with zeros
+        for row in numpy.flatnonzero(~inside):
+            start = max(starts[row], 0)
+            end = min(starts[row] + self.fft_size, self.nframes)
+            if end > start:
+                frames[row, start - starts[row]:end - starts[row]] = self.samples[start:end]
+
+        return frames
+
+    def spectra(self, image_width):
+        """ the normalized abs(FFT) of the window centered on each column, one row per column """
+        seek_points = self.seek_points(image_width)[:-1]
+
+        spectra = numpy.empty((image_width, self.fft_size / 2 + 1))
+        for start in range(0, image_width, self.fft_batch_size):
+            frames = self.frames(seek_points[start:start + self.fft_batch_size])
+            fft = numpy.fft.rfft(frames * self.window, axis=1)
+            spectra[start:start + len(frames)] = self.scale * numpy.abs(fft)
+
+        return spectra
+
+    def spectral_centroids(self, image_width, spec_range=110.0):
+        """
+        calculate the spectral centroid and db spectrum of all columns,
+        returns an array of centroids and an array with a db spectrum per column
+        """
+        spectra = self.spectra(image_width)
+        length = numpy.float64(spectra.shape[1])
+
+        # scale the db spectrum from [- spec_range db ... 0 db] > [0..1]
+        db_spectra = ((20*(numpy.log10(spectra + 1e-60))).clip(-spec_range, 0.0) + spec_range)/spec_range
+
+        energy = spectra.sum(axis=1)
+        has_energy = energy > 1e-60
+
+        spectral_centroids = numpy.zeros(image_width)
+        spectral_centroids[has_energy] = (spectra[has_energy] * numpy.arange(length)).sum(axis=1) / (energy[has_energy] * (length - 1)) * self.samplerate * 0.5
+
+        # clip > log10 > scale between 0 and 1
+        spectral_centroids[has_energy] = (numpy.log10(spectral_centroids[has_energy].clip(self.lower, self.higher)) - self.lower_log) / (self.higher_log - self.lower_log)
+
+        return (spectral_centroids, db_spectra)
+
+    def peaks(self, image_width):
+        """
+        find the minimum and maximum peak of the samples of each column. Returns a list
+        with a pair for each column, in the order they were found.
+        """
+        seek_points = self.seek_points(image_width)
+
+        peaks = []
+        for start_seek, end_seek in zip(seek_points[:-1], seek_points[1:]):
+            samples = self.samples[start_seek:max(end_seek, start_seek + 1)]
+
+            if not len(samples):
+                peaks.append((0.0, 0.0))
+                continue
+
+            max_index = numpy.argmax(samples)
+            min_index = numpy.argmin(samples)
+            if min_index < max_index:
+                peaks.append((samples[min_index], samples[max_index]))
+            else:
+                peaks.append((samples[max_index], samples[min_index]))
+
+        return peaks
+
+
 def interpolate_colors(colors, flat=False, num_colors=256):
     """ given a list of colors, create a larger list of colors interpolating
     the first one. If flatten is True a list of numers will be returned. If
@@ -437,6 +623,8 @@ class SpectrogramImage(object):
         # a lot slower than using image.putadata and then rotating the image
         # so we store all the pixels in an array and then create the image when saving
         self.pixels = []
+        # or, when drawing all spectra at once, the finished image
+        self.spectra_image = None
 
     def draw_spectrum(self, x, spectrum):
         # for all frequencies, draw the pixels
@@ -447,8 +635,28 @@ class SpectrogramImage(object):
         for y in range(len(self.y_to_bin), self.image_height): #@UnusedVariable
             self.pixels.append(self.palette[0])
 
+    def draw_spectra(self, db_spectra):
+        """
+        Draw the db spectra of all columns (one per row of db_spectra) at once,
+        as a single lookup in the palette instead of one per pixel.
+        """
+        bins = numpy.array([index for (index, alpha) in self.y_to_bin], dtype=numpy.intp)
+        alphas = numpy.array([alpha for (index, alpha) in self.y_to_bin])
+
+        # if the FFT is too small to fill up the image, the top stays black
+        colors = numpy.zeros((len(db_spectra), self.image_height), dtype=numpy.intp)
+        colors[:,:len(bins)] = (255.0 - alphas) * db_spectra[:,bins] + alphas * db_spectra[:,bins + 1]
+
+        # rows of the image are frequencies, lowest at the bottom
+        pixels = numpy.array(self.palette, dtype=numpy.uint8)[colors.T[::-1]]
+        self.spectra_image = Image.fromarray(numpy.ascontiguousarray(pixels), "RGB")
+
     def save(self, filename, quality=80):
         assert filename.lower().endswith(".jpg")
+        if self.spectra_image is not None:
+            self.spectra_image.save(filename, quality=quality)
+            return
+
         self.image.putdata(self.pixels)
         self.image.transpose(Image.ROTATE_90).save(filename, quality=quality)
 
@@ -457,25 +665,21 @@ def create_wave_images(input_filename, output_filename_w, output_filename_s, ima
     """
     Utility function for creating both wavefile and spectrum images from an audio input file.
     """
-    processor = AudioProcessor(input_filename, fft_size, numpy.hanning)
-    samples_per_pixel = processor.audio_file.nframes / float(image_width)
+    processor = BatchAudioProcessor(
+        input_filename, fft_size, numpy.hanning,
+        tmp_dir=os.path.dirname(os.path.abspath(output_filename_s)))
 
-    waveform = WaveformImage(image_width, image_height)
-    spectrogram = SpectrogramImage(image_width, image_height, fft_size)
-
-    for x in range(image_width):
-
-        if progress_callback and x % (image_width/10) == 0:
-            progress_callback((x*100)/image_width)
+    if progress_callback:
+        progress_callback(50)
 
-        seek_point = int(x * samples_per_pixel)
-        next_seek_point = int((x + 1) * samples_per_pixel)
+    (spectral_centroids, db_spectra) = processor.spectral_centroids(image_width)
 
-        (spectral_centroid, db_spectrum) = processor.spectral_centroid(seek_point)
-        peaks = processor.peaks(seek_point, next_seek_point)
+    waveform = WaveformImage(image_width, image_height)
+    for x, peaks in enumerate(processor.peaks(image_width)):
+        waveform.draw_peaks(x, peaks, spectral_centroids[x])
 
-        waveform.draw_peaks(x, peaks, spectral_centroid)
-        spectrogram.draw_spectrum(x, db_spectrum)
+    spectrogram = SpectrogramImage(image_width, image_height, fft_size)
+    spectrogram.draw_spectra(db_spectra)
 
     if progress_callback:
         progress_callback(100)
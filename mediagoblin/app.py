@@ -27,6 +27,7 @@ from werkzeug.routing import RequestRedirect
 from werkzeug.wsgi import SharedDataMiddleware
 
 from mediagoblin import meddleware, __version__
+from mediagoblin.db.lookup import RequestLookups
 from mediagoblin.db.util import check_db_up_to_date
 from mediagoblin.tools import common, session, translate, template
 from mediagoblin.tools.response import render_http_exception
@@ -38,7 +39,7 @@ from mediagoblin.init.celery import setup_celery_from_config
 from mediagoblin.init.plugins import setup_plugins
 from mediagoblin.init import (get_jinja_loader, get_staticdirector,
     setup_global_and_app_config, setup_locales, setup_workbench, setup_database,
-    setup_storage)
+    setup_storage, setup_derivative_cache, setup_lookup_cache)
 from mediagoblin.tools.pluginapi import PluginManager, hook_transform
 from mediagoblin.tools.crypto import setup_crypto
 from mediagoblin.auth.tools import check_auth_enabled, no_auth_logout
@@ -168,6 +169,8 @@ class MediaGoblinApp(object):
         # Workbench *currently* only used by celery, so this only
         # matters in always eager mode :)
         self.workbench_manager = setup_workbench()
+        self.derivative_cache = setup_derivative_cache()
+        self.lookup_cache = setup_lookup_cache()
 
         # instantiate application meddleware
         self.meddleware = [common.import_component(m)(self)
@@ -229,6 +232,8 @@ class MediaGoblinApp(object):
         request.template_env = template.get_jinja_env(
             self, self.template_loader, request.locale)
 
+        request.lookups = RequestLookups(self.lookup_cache)
+
         mg_request.setup_user_in_request(request)
 
         ## Routing / controller loading stuff
@@ -0,0 +1,160 @@
+# GNU MediaGoblin -- federated, autonomous media hosting
+# Copyright (C) 2011, 2012 MediaGoblin contributors.  See AUTHORS.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Caches for the lookups done on (nearly) every request
+
+The url decorators and views look up the same users, media entries and
+collections by username, slug or id over and over again.  RequestLookups
+remembers what was looked up during one request, and may be backed by a
+process-wide SharedLookupCache that keeps detached copies of the objects
+for a few seconds.  Objects are dropped from the shared cache whenever
+they are changed or deleted in this process.
+"""
+
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.orm import sessionmaker
+
+from mediagoblin import mg_globals as mgg
+from mediagoblin.tools.transition import DISABLE_GLOBALS
+
+if not DISABLE_GLOBALS:
+    from mediagoblin.db.base import Session
+
+# How many lookups the shared cache remembers at most
+SHARED_LOOKUP_CACHE_SIZE = 1000
+
+
+def _lookup_key(model, criteria):
+    return (model, tuple(sorted(criteria.items())))
+
+
+class SharedLookupCache(object):
+    """
+    Process-wide cache of lookups, each kept for at most ttl seconds.
+
+    Only objects that were found are cached, so a newly registered user
+    or newly uploaded media can't be hidden by an earlier miss.
+    """
+    def __init__(self, ttl, max_entries=SHARED_LOOKUP_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = {}
+        # (model, id) => lookup keys, for invalidation
+        self._keys_by_identity = {}
+        # An unbound session just for making detached copies
+        self._copy_session = sessionmaker()
+
+    def get(self, session, model, **criteria):
+        """
+        Return the cached object for criteria, merged into session, or
+        None if there's nothing (current) cached.
+        """
+        key = _lookup_key(model, criteria)
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        expires, obj = entry
+        if expires < time.time():
+            return None
+        # load=False keeps merge() from checking back with the database
+        return session.merge(obj, load=False)
+
+    def put(self, model, obj, **criteria):
+        """
+        Cache a detached copy of obj as the result of looking up criteria
+        """
+        copy_session = self._copy_session()
+        try:
+            obj_copy = copy_session.merge(obj, load=False)
+            copy_session.expunge(obj_copy)
+        finally:
+            copy_session.close()
+
+        key = _lookup_key(model, criteria)
+        identity = (model, obj.id)
+        with self._lock:
+            if len(self._entries) >= self.max_entries:
+                self._entries.clear()
+                self._keys_by_identity.clear()
+            self._entries[key] = (time.time() + self.ttl, obj_copy)
+            self._keys_by_identity.setdefault(identity, set()).add(key)
+
+    def invalidate(self, model, obj_id):
+        """
+        Forget all lookups that resulted in the object model.id == obj_id
+        """
+        with self._lock:
+            for key in self._keys_by_identity.pop((model, obj_id), ()):
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_identity.clear()
+
+
+class RequestLookups(object):
+    """
+    Identity map of the lookups done during a single request.
+
+    Use first(Model, **criteria) instead of
+    Model.query.filter_by(**criteria).first() for lookups which are
+    likely to be repeated, like the user in the url.
+    """
+    def __init__(self, shared_cache=None):
+        self.shared_cache = shared_cache
+        self._found = {}
+
+    def first(self, model, **criteria):
+        key = _lookup_key(model, criteria)
+        if key in self._found:
+            return self._found[key]
+
+        obj = None
+        if self.shared_cache is not None:
+            obj = self.shared_cache.get(Session(), model, **criteria)
+
+        if obj is None:
+            obj = model.query.filter_by(**criteria).first()
+            if obj is not None and self.shared_cache is not None:
+                self.shared_cache.put(model, obj, **criteria)
+
+        self._found[key] = obj
+        if obj is not None:
+            # Whatever we found can be found by id, too
+            self._found.setdefault(_lookup_key(model, {'id': obj.id}), obj)
+        return obj
+
+
+def _invalidate_flushed(session, flush_context):
+    if mgg.lookup_cache is None:
+        return
+
+    for obj in list(session.dirty) + list(session.deleted):
+        obj_id = getattr(obj, 'id', None)
+        if obj_id is not None:
+            mgg.lookup_cache.invalidate(type(obj), obj_id)
+
+
+if not DISABLE_GLOBALS:
+    event.listen(Session, 'after_flush', _invalidate_flushed)
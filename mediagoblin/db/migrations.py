@@ -27,10 +27,11 @@ from sqlalchemy import (MetaData, Table, Column, Boolean, SmallInteger,
                         ForeignKey, Date, Index)
 from sqlalchemy.exc import ProgrammingError
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.sql import and_
+from sqlalchemy.sql import and_, func, select
 from sqlalchemy.schema import UniqueConstraint
 
-from mediagoblin.db.extratypes import JSONEncoded, MutationDict
+from mediagoblin.db.extratypes import (JSONEncoded, MutationDict,
+                                       PathTupleWithSlashes)
 from mediagoblin.db.migration_tools import (
     RegisterMigration, inspect_table, replace_table_hack)
 from mediagoblin.db.models import (MediaEntry, Collection, MediaComment, User,
@@ -1123,3 +1124,91 @@ def add_location_model(db):
     col.create(media_comments)
 
     db.commit()
+
+@RegisterMigration(26, MIGRATIONS)
+def add_media_entry_updated(db):
+    """ Add updated to MediaEntry, starting out as the created date """
+    metadata = MetaData(bind=db.bind)
+    media_entry = inspect_table(metadata, "core__media_entries")
+
+    col = Column("updated", DateTime, default=datetime.datetime.now)
+    col.create(media_entry)
+    db.commit()
+
+    db.execute(media_entry.update().values(updated=media_entry.c.created))
+    db.commit()
+
+
+@RegisterMigration(27, MIGRATIONS)
+def add_rendered_markdown(db):
+    """
+    Add columns for the rendered markdown of bios, descriptions and comments
+
+    They start out empty, "gmg rendermarkdown" fills them in.
+    """
+    metadata = MetaData(bind=db.bind)
+
+    user = inspect_table(metadata, "core__users")
+    media_entry = inspect_table(metadata, "core__media_entries")
+    media_comments = inspect_table(metadata, "core__media_comments")
+
+    col = Column("rendered_bio", UnicodeText)
+    col.create(user)
+
+    col = Column("rendered_description", UnicodeText)
+    col.create(media_entry)
+
+    col = Column("rendered_content", UnicodeText)
+    col.create(media_comments)
+
+    db.commit()
+
+
+class PendingDeletion_V0(declarative_base()):
+    __tablename__ = "core__pending_deletions"
+    id = Column(Integer, primary_key=True)
+    store = Column(Unicode, nullable=False, default=u'public')
+    filepath = Column(PathTupleWithSlashes, nullable=False)
+    attempts = Column(Integer, nullable=False, default=0)
+    created = Column(DateTime, nullable=False, default=datetime.datetime.now)
+
+
+@RegisterMigration(28, MIGRATIONS)
+def add_pending_deletions(db):
+    """
+    Add the table of files waiting to be deleted
+    """
+    PendingDeletion_V0.__table__.create(db.bind)
+    db.commit()
+
+
+class ActivityCount_V0(declarative_base()):
+    __tablename__ = "core__activity_counts"
+    actor = Column(Integer, primary_key=True)
+    verb = Column(Unicode, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+
+@RegisterMigration(29, MIGRATIONS)
+def add_activity_counts(db):
+    """
+    Count activities per actor and verb, and index them for feed paging
+    """
+    metadata = MetaData(bind=db.bind)
+    activities = inspect_table(metadata, "core__activities")
+
+    Index("ix_core__activities_published_id",
+          activities.c.published, activities.c.id).create(db.bind)
+    Index("ix_core__activities_actor_published_id", activities.c.actor,
+          activities.c.published, activities.c.id).create(db.bind)
+
+    ActivityCount_V0.__table__.create(db.bind)
+    db.commit()
+
+    counts = db.execute(
+        select([activities.c.actor, activities.c.verb, func.count()])
+        .group_by(activities.c.actor, activities.c.verb))
+    for actor, verb, count in counts.fetchall():
+        db.execute(ActivityCount_V0.__table__.insert().values(
+            actor=actor, verb=verb, count=count))
+    db.commit()
@@ -47,6 +47,8 @@ class UserMixin(object):
 
     @property
     def bio_html(self):
+        if self.rendered_bio is not None:
+            return self.rendered_bio
         return cleaned_markdown_conversion(self.bio)
 
     def url_for_self(self, urlgen, **kwargs):
@@ -147,6 +149,8 @@ class MediaEntryMixin(GenerateSlugMixin):
         Rendered version of the description, run through
         Markdown and cleaned with our cleaning tool.
         """
+        if self.rendered_description is not None:
+            return self.rendered_description
         return cleaned_markdown_conversion(self.description)
 
     def get_display_media(self):
@@ -316,6 +320,8 @@ class MediaCommentMixin(object):
         the actual html-rendered version of the comment displayed.
         Run through Markdown and the HTML cleaner.
         """
+        if self.rendered_content is not None:
+            return self.rendered_content
         return cleaned_markdown_conversion(self.content)
 
     def __unicode__(self):
@@ -471,7 +477,18 @@ class ActivityMixin(object):
 
         return self.content
 
-    def serialize(self, request):
+    def serialize(self, request, objects=None):
+        """
+        objects can map activity intermediator ids to their objects, when
+        they have been looked up for many activities at once already.
+        """
+        if objects is None:
+            activity_object = self.get_object
+            target = self.get_target
+        else:
+            activity_object = objects.get(self.object)
+            target = objects.get(self.target)
+
         href = request.urlgen(
             "mediagoblin.federation.object",
             object_type=self.object_type,
@@ -488,7 +505,7 @@ class ActivityMixin(object):
             "updated": updated.isoformat(),
             "content": self.content,
             "url": self.get_url(request),
-            "object": self.get_object.serialize(request),
+            "object": activity_object.serialize(request),
             "objectType": self.object_type,
             "links": {
                 "self": {
@@ -503,7 +520,6 @@ class ActivityMixin(object):
         if self.title:
             obj["title"] = self.title
 
-        target = self.get_target
         if target is not None:
             obj["target"] = target.serialize(request)
 
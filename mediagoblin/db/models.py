@@ -25,7 +25,8 @@ import datetime
 
 from sqlalchemy import Column, Integer, Unicode, UnicodeText, DateTime, \
         Boolean, ForeignKey, UniqueConstraint, PrimaryKeyConstraint, \
-        SmallInteger, Date
+        SmallInteger, Date, Index, event, and_, inspect
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import relationship, backref, with_polymorphic, validates
 from sqlalchemy.orm.collections import attribute_mapped_collection
 from sqlalchemy.sql.expression import desc
@@ -38,9 +39,11 @@ from mediagoblin.db.base import Base, DictReadAttrProxy
 from mediagoblin.db.mixin import UserMixin, MediaEntryMixin, \
         MediaCommentMixin, CollectionMixin, CollectionItemMixin, \
         ActivityMixin
-from mediagoblin.tools.files import delete_media_files
+from mediagoblin.tools.files import (delete_media_files,
+                                     delete_queued_files_later)
 from mediagoblin.tools.common import import_component
 from mediagoblin.tools.routing import extract_url_arguments
+from mediagoblin.tools.text import stored_markdown_conversion
 
 import six
 from pytz import UTC
@@ -144,6 +147,7 @@ class User(Base, UserMixin):
     license_preference = Column(Unicode)
     url = Column(Unicode)
     bio = Column(UnicodeText)  # ??
+    rendered_bio = Column(UnicodeText)
     uploaded = Column(Integer, default=0)
     upload_limit = Column(Integer)
     location = Column(Integer, ForeignKey("core__locations.id"))
@@ -154,6 +158,12 @@ class User(Base, UserMixin):
     ## TODO
     # plugin data would be in a separate model
 
+    @validates("bio")
+    def _render_bio(self, key, value):
+        """ Keep the rendered bio in line with the bio """
+        self.rendered_bio = stored_markdown_conversion(value)
+        return value
+
     def __repr__(self):
         return '<{0} #{1} {2} {3} "{4}">'.format(
                 self.__class__.__name__,
@@ -179,6 +189,8 @@ class User(Base, UserMixin):
 
         # Delete user, pass through commit=False/True in kwargs
         super(User, self).delete(**kwargs)
+        if kwargs.get('commit', True):
+            delete_queued_files_later()
         _log.info('Deleted user "{0}" account'.format(self.username))
 
     def has_privilege(self, privilege, allow_admin=True):
@@ -347,7 +359,10 @@ class MediaEntry(Base, MediaEntryMixin):
     slug = Column(Unicode)
     created = Column(DateTime, nullable=False, default=datetime.datetime.now,
         index=True)
+    updated = Column(DateTime, default=datetime.datetime.now,
+        onupdate=datetime.datetime.now)
     description = Column(UnicodeText) # ??
+    rendered_description = Column(UnicodeText)
     media_type = Column(Unicode, nullable=False)
     state = Column(Unicode, default=u'unprocessed', nullable=False)
         # or use sqlalchemy.types.Enum?
@@ -407,6 +422,12 @@ class MediaEntry(Base, MediaEntryMixin):
     ## TODO
     # fail_error
 
+    @validates("description")
+    def _render_description(self, key, value):
+        """ Keep the rendered description in line with the description """
+        self.rendered_description = stored_markdown_conversion(value)
+        return value
+
     def get_comments(self, ascending=False):
         order_col = MediaComment.created
         if not ascending:
@@ -511,13 +532,8 @@ class MediaEntry(Base, MediaEntryMixin):
         # User's CollectionItems are automatically deleted via "cascade".
         # Comments on this Media are deleted by cascade, hopefully.
 
-        # Delete all related files/attachments
-        try:
-            delete_media_files(self)
-        except OSError as error:
-            # Returns list of files we failed to delete
-            _log.error('No such files from the user "{1}" to delete: '
-                       '{0}'.format(str(error), self.get_uploader))
+        # Have all related files/attachments deleted along with the entry
+        delete_media_files(self)
         _log.info('Deleted Media entry id "{0}"'.format(self.id))
         # Related MediaTag's are automatically cleaned, but we might
         # want to clean out unused Tag's too.
@@ -528,6 +544,8 @@ class MediaEntry(Base, MediaEntryMixin):
             clean_orphan_tags(commit=False)
         # pass through commit=False/True in kwargs
         super(MediaEntry, self).delete(**kwargs)
+        if kwargs.get('commit', True):
+            delete_queued_files_later()
 
     def serialize(self, request, show_comments=True):
         """ Unserialize MediaEntry to object """
@@ -689,6 +707,27 @@ class MediaAttachmentFile(Base):
         return DictReadAttrProxy(self)
 
 
+class PendingDeletion(Base):
+    """
+    A file waiting to be deleted from the public (or queue) store
+
+    Rows are added along with deleting whatever the file belonged to, and
+    removed by the delete_queued_files task once the file is gone.
+    """
+    __tablename__ = "core__pending_deletions"
+
+    id = Column(Integer, primary_key=True)
+    store = Column(Unicode, nullable=False, default=u'public')
+    filepath = Column(PathTupleWithSlashes, nullable=False)
+    attempts = Column(Integer, nullable=False, default=0)
+    created = Column(DateTime, nullable=False, default=datetime.datetime.now)
+
+    def __repr__(self):
+        return '<{0} #{1} {2}:{3}>'.format(
+            self.__class__.__name__, self.id, self.store,
+            '/'.join(self.filepath or ()))
+
+
 class Tag(Base):
     __tablename__ = "core__tags"
 
@@ -748,6 +787,7 @@ class MediaComment(Base, MediaCommentMixin):
     author = Column(Integer, ForeignKey(User.id), nullable=False)
     created = Column(DateTime, nullable=False, default=datetime.datetime.now)
     content = Column(UnicodeText, nullable=False)
+    rendered_content = Column(UnicodeText)
     location = Column(Integer, ForeignKey("core__locations.id"))
     get_location = relationship("Location", lazy="joined")
 
@@ -775,6 +815,12 @@ class MediaComment(Base, MediaCommentMixin):
 
     activity = Column(Integer, ForeignKey("core__activity_intermediators.id"))
 
+    @validates("content")
+    def _render_content(self, key, value):
+        """ Keep the rendered comment in line with the comment """
+        self.rendered_content = stored_markdown_conversion(value)
+        return value
+
     def serialize(self, request):
         """ Unserialize to python dictionary for API """
         href = request.urlgen(
@@ -1349,6 +1395,12 @@ class Activity(Base, ActivityMixin):
                                              cascade="all, delete-orphan"))
     get_generator = relationship(Generator)
 
+    # Feeds are paged newest first, by (published, id)
+    __table_args__ = (
+        Index("ix_core__activities_published_id", published, id),
+        Index("ix_core__activities_actor_published_id", actor, published, id),
+        {})
+
     def __repr__(self):
         if self.content is None:
             return "<{klass} verb:{verb}>".format(
@@ -1404,18 +1456,83 @@ class Activity(Base, ActivityMixin):
             self.updated = datetime.datetime.now()
         super(Activity, self).save(*args, **kwargs)
 
+
+class ActivityCount(Base):
+    """
+    How many activities of a verb an actor has, so the totals of feeds
+    don't need to count all activities.  Kept up to date along with every
+    Activity inserted, updated or deleted through the ORM.
+    """
+    __tablename__ = "core__activity_counts"
+
+    actor = Column(Integer, primary_key=True)
+    verb = Column(Unicode, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+
+def _add_activity_count(connection, actor, verb):
+    """
+    Make sure there's an ActivityCount row for actor and verb, even if
+    another transaction is adding it at the same time
+    """
+    counts = ActivityCount.__table__
+    insert = counts.insert().values(actor=actor, verb=verb, count=0)
+    if connection.dialect.name == 'sqlite':
+        connection.execute(insert.prefix_with('OR IGNORE'))
+        return
+
+    # A failed INSERT would abort the whole transaction (and flush of the
+    # activity) otherwise
+    savepoint = connection.begin_nested()
+    try:
+        connection.execute(insert)
+    except IntegrityError:
+        savepoint.rollback()
+    else:
+        savepoint.commit()
+
+
+def _count_activity(connection, actor, verb, change):
+    counts = ActivityCount.__table__
+    update = counts.update().where(and_(
+        counts.c.actor == actor, counts.c.verb == verb)).values(
+        count=counts.c.count + change)
+    if not connection.execute(update).rowcount and change > 0:
+        _add_activity_count(connection, actor, verb)
+        connection.execute(update)
+
+
+@event.listens_for(Activity, "after_insert")
+def _activity_inserted(mapper, connection, activity):
+    _count_activity(connection, activity.actor, activity.verb, 1)
+
+
+@event.listens_for(Activity, "after_update")
+def _activity_updated(mapper, connection, activity):
+    history = inspect(activity).attrs.verb.history
+    if history.deleted and history.added:
+        _count_activity(connection, activity.actor, history.deleted[0], -1)
+        _count_activity(connection, activity.actor, history.added[0], 1)
+
+
+@event.listens_for(Activity, "after_delete")
+def _activity_deleted(mapper, connection, activity):
+    _count_activity(connection, activity.actor, activity.verb, -1)
+
+
 with_polymorphic(
     Notification,
     [ProcessingNotification, CommentNotification])
 
 MODELS = [
     User, MediaEntry, Tag, MediaTag, MediaComment, Collection, CollectionItem,
-    MediaFile, FileKeynames, MediaAttachmentFile, ProcessingMetaData,
+    MediaFile, FileKeynames, MediaAttachmentFile, PendingDeletion,
+    ProcessingMetaData,
     Notification, CommentNotification, ProcessingNotification, Client,
     CommentSubscription, ReportBase, CommentReport, MediaReport, UserBan,
 	Privilege, PrivilegeUserAssociation,
     RequestToken, AccessToken, NonceTimestamp,
-    Activity, ActivityIntermediator, Generator,
+    Activity, ActivityIntermediator, ActivityCount, Generator,
     Location]
 
 """
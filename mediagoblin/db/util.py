@@ -16,6 +16,8 @@
 
 import sys
 
+from sqlalchemy import func
+
 from mediagoblin import mg_globals as mgg
 from mediagoblin.db.models import MediaEntry, Tag, MediaTag, Collection
 from mediagoblin.gmg_commands.dbupdate import gather_database_data
@@ -53,6 +55,19 @@ def media_entries_for_tag_slug(dummy_db, tag_slug):
             & (Tag.slug == tag_slug))
 
 
+def query_version(query, *timestamp_columns):
+    """
+    Summarize what query matches in a single, cheap aggregate query
+
+    Returns the number of matching rows followed by the latest value of
+    each of timestamp_columns, which together change whenever a row is
+    added, removed or updated.
+    """
+    return tuple(query.order_by(None).with_entities(
+        func.count(), *[func.max(column) for column in timestamp_columns]
+        ).one())
+
+
 def clean_orphan_tags(commit=True):
     """Search for unused MediaTags and delete them"""
     q1 = Session.query(Tag).outerjoin(MediaTag).filter(MediaTag.id==None)
@@ -23,7 +23,9 @@ from six.moves.urllib.parse import urljoin
 
 from mediagoblin import mg_globals as mgg
 from mediagoblin import messages
-from mediagoblin.db.models import MediaEntry, User, MediaComment, AccessToken
+from mediagoblin.db.models import (MediaEntry, User, MediaComment,
+    AccessToken, Collection)
+from mediagoblin.tools.pagination import get_pagination_marker
 from mediagoblin.tools.response import (
     redirect, render_404,
     render_user_banned, json_response)
@@ -111,7 +113,8 @@ def active_user_from_url(controller):
     Returns a 404 if no such active user has been found"""
     @wraps(controller)
     def wrapper(request, *args, **kwargs):
-        user = User.query.filter_by(username=request.matchdict['user']).first()
+        user = request.lookups.first(
+            User, username=request.matchdict['user'])
         if user is None:
             return render_404(request)
 
@@ -142,8 +145,8 @@ def user_may_alter_collection(controller):
     """
     @wraps(controller)
     def wrapper(request, *args, **kwargs):
-        creator_id = request.db.User.query.filter_by(
-            username=request.matchdict['user']).first().id
+        creator_id = request.lookups.first(
+            User, username=request.matchdict['user']).id
         if not (request.user.has_privilege(u'admin') or
                 request.user.id == creator_id):
             raise Forbidden()
@@ -156,6 +159,9 @@ def user_may_alter_collection(controller):
 def uses_pagination(controller):
     """
     Check request GET 'page' key for wrong values
+
+    Also decodes a 'before' or 'after' keyset marker, if any, into
+    request.pagination_marker for use with KeysetPagination.
     """
     @wraps(controller)
     def wrapper(request, *args, **kwargs):
@@ -163,6 +169,7 @@ def uses_pagination(controller):
             page = int(request.GET.get('page', 1))
             if page < 0:
                 return render_404(request)
+            request.pagination_marker = get_pagination_marker(request.GET)
         except ValueError:
             return render_404(request)
 
@@ -177,7 +184,8 @@ def get_user_media_entry(controller):
     """
     @wraps(controller)
     def wrapper(request, *args, **kwargs):
-        user = User.query.filter_by(username=request.matchdict['user']).first()
+        user = request.lookups.first(
+            User, username=request.matchdict['user'])
         if not user:
             raise NotFound()
 
@@ -189,18 +197,20 @@ def get_user_media_entry(controller):
         # if it starts with id: it actually isn't a slug, it's an id.
         if media_slug.startswith(u'id:'):
             try:
-                media = MediaEntry.query.filter_by(
+                media = request.lookups.first(
+                    MediaEntry,
                     id=int(media_slug[3:]),
                     state=u'processed',
-                    uploader=user.id).first()
+                    uploader=user.id)
             except ValueError:
                 raise NotFound()
         else:
             # no magical id: stuff?  It's a slug!
-            media = MediaEntry.query.filter_by(
+            media = request.lookups.first(
+                MediaEntry,
                 slug=media_slug,
                 state=u'processed',
-                uploader=user.id).first()
+                uploader=user.id)
 
         if not media:
             # Didn't find anything?  Okay, 404.
@@ -217,15 +227,16 @@ def get_user_collection(controller):
     """
     @wraps(controller)
     def wrapper(request, *args, **kwargs):
-        user = request.db.User.query.filter_by(
-            username=request.matchdict['user']).first()
+        user = request.lookups.first(
+            User, username=request.matchdict['user'])
 
         if not user:
             return render_404(request)
 
-        collection = request.db.Collection.query.filter_by(
+        collection = request.lookups.first(
+            Collection,
             slug=request.matchdict['collection'],
-            creator=user.id).first()
+            creator=user.id)
 
         # Still no collection?  Okay, 404.
         if not collection:
@@ -242,8 +253,8 @@ def get_user_collection_item(controller):
     """
     @wraps(controller)
     def wrapper(request, *args, **kwargs):
-        user = request.db.User.query.filter_by(
-            username=request.matchdict['user']).first()
+        user = request.lookups.first(
+            User, username=request.matchdict['user'])
 
         if not user:
             return render_404(request)
@@ -266,9 +277,10 @@ def get_media_entry_by_id(controller):
     """
     @wraps(controller)
     def wrapper(request, *args, **kwargs):
-        media = MediaEntry.query.filter_by(
+        media = request.lookups.first(
+                MediaEntry,
                 id=request.matchdict['media_id'],
-                state=u'processed').first()
+                state=u'processed')
         # Still no media?  Okay, 404.
         if not media:
             return render_404(request)
@@ -404,12 +416,19 @@ def oauth_required(controller):
             return json_response({"error": error}, status=400)
 
 
+        # Only urlencoded bodies are part of the OAuth signature, so don't
+        # pull anything else (like a media upload) into memory here.
+        if request.mimetype == 'application/x-www-form-urlencoded':
+            body = request.data
+        else:
+            body = u''
+
         request_validator = GMGRequestValidator()
         resource_endpoint = ResourceEndpoint(request_validator)
         valid, r = resource_endpoint.validate_protected_resource_request(
                 uri=request.base_url,
                 http_method=request.method,
-                body=request.data,
+                body=body,
                 headers=dict(request.headers),
                 )
 
@@ -422,7 +441,7 @@ def oauth_required(controller):
         request.access_token = AccessToken.query.filter_by(token=token).first()
         if request.access_token is not None and request.user is None:
             user_id = request.access_token.user
-            request.user = User.query.filter_by(id=user_id).first()
+            request.user = request.lookups.first(User, id=user_id)
 
         return controller(request, *args, **kwargs)
 
@@ -0,0 +1,241 @@
+# GNU MediaGoblin -- federated, autonomous media hosting
+# Copyright (C) 2011, 2012 MediaGoblin contributors.  See AUTHORS.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Pages of activities for the inbox and feed (outbox) endpoints
+
+Pages are newest first and ordered by (published, id), clients page
+through them with the pump.io 'before' and 'since' parameters, which take
+the id of an activity.  The objects of all activities on a page are
+looked up together, and the serialized activities are cached.
+"""
+
+import time
+
+from six.moves.urllib.parse import urlencode
+from sqlalchemy import and_, or_, func
+from sqlalchemy.orm import joinedload
+from werkzeug.exceptions import HTTPException
+
+from mediagoblin.db.models import Activity, ActivityCount, \
+    ActivityIntermediator
+from mediagoblin.tools.fragment_cache import FragmentCache
+from mediagoblin.tools.routing import extract_url_arguments
+
+FEED_DEFAULT_COUNT = 20
+# pump.io doesn't give out more than 200 activities at once, neither do we
+FEED_MAX_COUNT = 200
+
+# How long (in seconds) a serialized activity is reused.  Activities are
+# cached per version, but the objects and actors in them can change too.
+ACTIVITY_CACHE_TIME = 60
+
+activity_cache = FragmentCache()
+
+
+def activity_query(actor=None, verbs=None):
+    """
+    All activities, or the ones of actor and/or with one of verbs
+    """
+    query = Activity.query.options(
+        joinedload(Activity.get_actor), joinedload(Activity.get_generator))
+    if actor is not None:
+        query = query.filter(Activity.actor == actor.id)
+    if verbs is not None:
+        query = query.filter(Activity.verb.in_(verbs))
+    return query
+
+
+def count_activities(actor=None, verbs=None):
+    """
+    How many activities activity_query() has, from the counts kept in
+    ActivityCount rather than counting the activities themselves
+    """
+    query = ActivityCount.query.with_entities(
+        func.coalesce(func.sum(ActivityCount.count), 0))
+    if actor is not None:
+        query = query.filter(ActivityCount.actor == actor.id)
+    if verbs is not None:
+        query = query.filter(ActivityCount.verb.in_(verbs))
+    return int(query.scalar())
+
+
+def activity_href(request, activity):
+    return request.urlgen(
+        "mediagoblin.federation.object",
+        object_type=activity.object_type,
+        id=activity.id,
+        qualified=True)
+
+
+def get_cursor(request, value):
+    """
+    The (published, id) key of the activity a 'since' or 'before'
+    parameter points at, given by its id (url) or its number.
+
+    Raises ValueError if there is no such activity.
+    """
+    try:
+        activity_id = int(value)
+    except ValueError:
+        try:
+            arguments = extract_url_arguments(
+                url=value, urlmap=request.app.url_map)
+            if arguments.get("object_type") != Activity.object_type:
+                raise ValueError
+            activity_id = int(arguments["id"])
+        except (HTTPException, KeyError, ValueError):
+            raise ValueError("Invalid activity id: {0!r}".format(value))
+
+    activity = Activity.query.filter_by(id=activity_id).first()
+    if activity is None:
+        raise ValueError("No such activity: {0!r}".format(value))
+    return activity.published, activity.id
+
+
+def get_count(args):
+    try:
+        limit = int(args.get("count", FEED_DEFAULT_COUNT))
+    except ValueError:
+        limit = FEED_DEFAULT_COUNT
+    return max(min(limit, FEED_MAX_COUNT), 0)
+
+
+def _newer(published, activity_id):
+    return or_(Activity.published > published,
+               and_(Activity.published == published,
+                    Activity.id > activity_id))
+
+
+def _older(published, activity_id):
+    return or_(Activity.published < published,
+               and_(Activity.published == published,
+                    Activity.id < activity_id))
+
+
+def get_page(request, query):
+    """
+    The activities of query on the page request asks for, newest first.
+
+    Raises ValueError if the 'since' or 'before' parameter is invalid.
+    """
+    limit = get_count(request.args)
+    since = request.args.get("since")
+    before = request.args.get("before")
+
+    if before:
+        query = query.filter(_older(*get_cursor(request, before)))
+
+    if since:
+        # Take the activities right after since, not the newest ones, so
+        # a client following prev links doesn't skip over any
+        query = query.filter(_newer(*get_cursor(request, since)))
+        query = query.order_by(Activity.published.asc(), Activity.id.asc())
+        return list(reversed(query.limit(limit).all()))
+
+    query = query.order_by(Activity.published.desc(), Activity.id.desc())
+    if not before:
+        # Offsets are still understood for older clients
+        try:
+            query = query.offset(max(int(request.args.get("offset", 0)), 0))
+        except ValueError:
+            raise ValueError("Invalid offset")
+    return query.limit(limit).all()
+
+
+def get_objects(activities):
+    """
+    The objects and targets of activities, by their activity intermediator
+    id, looked up with a query per type of object
+    """
+    ids = set()
+    for activity in activities:
+        ids.add(activity.object)
+        if activity.target is not None:
+            ids.add(activity.target)
+    if not ids:
+        return {}
+
+    types = {}
+    for intermediator in ActivityIntermediator.query.filter(
+            ActivityIntermediator.id.in_(ids)):
+        types.setdefault(intermediator.type, []).append(intermediator.id)
+
+    objects = {}
+    for object_type, type_ids in types.items():
+        model = ActivityIntermediator.TYPES[object_type]
+        for obj in model.query.filter(model.activity.in_(type_ids)):
+            objects[obj.activity] = obj
+    return objects
+
+
+def serialize_activities(request, activities):
+    """
+    Serialize activities, skipping the ones whose object has been deleted
+    """
+    period = int(time.time() // ACTIVITY_CACHE_TIME)
+    keys = dict(
+        (activity.id,
+         (request.host_url, activity.id, activity.updated, period))
+        for activity in activities)
+
+    serialized = {}
+    for activity in activities:
+        cached = activity_cache.get(keys[activity.id])
+        if cached is not None:
+            serialized[activity.id] = cached
+
+    missing = [activity for activity in activities
+               if activity.id not in serialized]
+    objects = get_objects(missing)
+    for activity in missing:
+        # We hard delete, so the object of an activity can be gone.  The
+        # activity is kept in case someone looks it up, but isn't shown.
+        if objects.get(activity.object) is None:
+            continue
+        if activity.target is not None and activity.target not in objects:
+            continue
+        serialized[activity.id] = activity.serialize(request, objects)
+        activity_cache.set(keys[activity.id], serialized[activity.id])
+
+    return [serialized[activity.id] for activity in activities
+            if activity.id in serialized]
+
+
+def _page_url(request, **params):
+    args = dict((key, value) for key, value in request.args.items()
+                if key not in ("since", "before", "offset"))
+    args.update(params)
+    return "{0}?{1}".format(request.base_url, urlencode(args))
+
+
+def activity_feed(request, query, total_items):
+    """
+    The items, totalItems and links of a feed of the activities of query
+    """
+    activities = get_page(request, query)
+    links = {"self": {"href": request.url}}
+    if activities:
+        links["prev"] = {"href": _page_url(
+            request, since=activity_href(request, activities[0]))}
+        links["next"] = {"href": _page_url(
+            request, before=activity_href(request, activities[-1]))}
+
+    return {
+        "items": serialize_activities(request, activities),
+        "totalItems": total_items,
+        "links": links,
+    }
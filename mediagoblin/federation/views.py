@@ -15,13 +15,15 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import json
-import io
 import mimetypes
 
 from werkzeug.datastructures import FileStorage
+from werkzeug.http import parse_content_range_header
 
 from mediagoblin.decorators import oauth_required, require_active_login
 from mediagoblin.federation.decorators import user_has_privilege
+from mediagoblin.federation.feed import activity_feed, activity_query, \
+                                       count_activities
 from mediagoblin.db.models import User, MediaEntry, MediaComment, Activity
 from mediagoblin.tools.federation import create_activity, create_generator
 from mediagoblin.tools.routing import extract_url_arguments
@@ -29,11 +31,16 @@ from mediagoblin.tools.response import redirect, json_response, json_error, \
                                        render_404, render_to_response
 from mediagoblin.meddleware.csrf import csrf_exempt
 from mediagoblin.submit.lib import new_upload_entry, api_upload_request, \
-                                    api_add_to_feed
+                                    api_add_to_feed, FileUploadLimit, \
+                                    UserUploadLimit, UserPastUploadLimit
 
 # MediaTypes
 from mediagoblin.media_types.image import MEDIA_TYPE as IMAGE_MEDIA_TYPE
 
+# Verbs of the activities in the major and minor inboxes and feeds
+MAJOR_VERBS = [u"post"]
+MINOR_VERBS = [u"update", u"delete"]
+
 # Getters
 def get_profile(request):
     """
@@ -118,28 +125,61 @@ def uploads_endpoint(request):
         filename = mimetypes.guess_all_extensions(mimetype)
         filename = 'unknown' + filename[0] if filename else filename
         file_data = FileStorage(
-            stream=io.BytesIO(request.data),
+            stream=request.stream,
             filename=filename,
             content_type=mimetype
         )
 
-        # Find media manager
-        entry = new_upload_entry(request.user)
-        entry.media_type = IMAGE_MEDIA_TYPE
-        return api_upload_request(request, file_data, entry)
+        # A Content-Range header makes this one chunk of a resumable upload
+        content_range = request.headers.get("Content-Range")
+        if content_range is not None:
+            content_range = parse_content_range_header(content_range)
+            if content_range is None or content_range.units != "bytes" \
+                    or content_range.length is None:
+                return json_error("Invalid 'Content-Range' header.")
+
+        upload_id = request.args.get("upload_id")
+        if upload_id is None:
+            # Find media manager
+            entry = new_upload_entry(request.user)
+            entry.media_type = IMAGE_MEDIA_TYPE
+        else:
+            entry = MediaEntry.query.filter_by(
+                queued_task_id=upload_id,
+                uploader=request.user.id,
+                state=u"unprocessed"
+            ).first()
+
+            if entry is None:
+                return json_error(
+                    "No such upload with id '{0}'".format(upload_id),
+                    status=404
+                )
+
+        try:
+            return api_upload_request(request, file_data, entry, content_range)
+        except FileUploadLimit:
+            return json_error("Sorry, the file size is too big.")
+        except UserUploadLimit:
+            return json_error(
+                "Sorry, uploading this file will put you over your "
+                "upload limit."
+            )
+        except UserPastUploadLimit:
+            return json_error("Sorry, you have reached your upload limit.")
 
     return json_error("Not yet implemented", 501)
 
 @oauth_required
 @csrf_exempt
-def inbox_endpoint(request, inbox=None):
+def inbox_endpoint(request, verbs=None):
     """ This is the user's inbox
 
     Currently because we don't have the ability to represent the inbox in the
     database this is not a "real" inbox in the pump.io/Activity streams 1.0
     sense but instead just gives back all the data on the website
 
-    inbox: allows you to pass a query in to limit inbox scope
+    verbs: allows you to limit the inbox to activities with these verbs
     """
     username = request.matchdict["username"]
     user = User.query.filter_by(username=username).first()
@@ -155,51 +195,22 @@ def inbox_endpoint(request, inbox=None):
             403
         )
 
-    if inbox is None:
-        inbox = Activity.query
-
-    # Count how many items for the "totalItems" field
-    total_items = inbox.count()
-
-    # We want to make a query for all media on the site and then apply GET
-    # limits where we can.
-    inbox = inbox.order_by(Activity.published.desc())
-
-    # Limit by the "count" (default: 20)
-    try:
-        limit = int(request.args.get("count", 20))
-    except ValueError:
-        limit = 20
-
-    # Prevent the count being too big (pump uses 200 so we shall)
-    limit = limit if limit <= 200 else 200
-
-    # Apply the limit
-    inbox = inbox.limit(limit)
-
-    # Offset (default: no offset - first <count> results)
-    inbox = inbox.offset(request.args.get("offset", 0))
-
     # build the inbox feed
     feed = {
         "displayName": "Activities for {0}".format(user.username),
         "author": user.serialize(request),
         "objectTypes": ["activity"],
         "url": request.base_url,
-        "links": {"self": {"href": request.url}},
-        "items": [],
-        "totalItems": total_items,
     }
 
-    for activity in inbox:
-        try:
-            feed["items"].append(activity.serialize(request))
-        except AttributeError:
-            # As with the feed endpint this occurs because of how we our
-            # hard-deletion method. Some activites might exist where the
-            # Activity object and/or target no longer exist, for this case we
-            # should just skip them.
-            pass
+    try:
+        feed.update(activity_feed(
+            request,
+            activity_query(verbs=verbs),
+            count_activities(verbs=verbs)
+        ))
+    except ValueError as error:
+        return json_error(str(error))
 
     return json_response(feed)
 
@@ -207,22 +218,17 @@ def inbox_endpoint(request, inbox=None):
 @csrf_exempt
 def inbox_minor_endpoint(request):
     """ Inbox subset for less important Activities """
-    inbox = Activity.query.filter(
-        (Activity.verb == "update") | (Activity.verb == "delete")
-    )
-
-    return inbox_endpoint(request=request, inbox=inbox)
+    return inbox_endpoint(request=request, verbs=MINOR_VERBS)
 
 @oauth_required
 @csrf_exempt
 def inbox_major_endpoint(request):
     """ Inbox subset for most important Activities """
-    inbox = Activity.query.filter_by(verb="post")
-    return inbox_endpoint(request=request, inbox=inbox)
+    return inbox_endpoint(request=request, verbs=MAJOR_VERBS)
 
 @oauth_required
 @csrf_exempt
-def feed_endpoint(request, outbox=None):
+def feed_endpoint(request, verbs=None):
     """ Handles the user's outbox - /api/user/<username>/feed """
     username = request.matchdict["username"]
     requested_user = User.query.filter_by(username=username).first()
@@ -530,48 +536,17 @@ def feed_endpoint(request, outbox=None):
         ),
         "objectTypes": ["activity"],
         "url": request.base_url,
-        "links": {"self": {"href": request.url}},
         "author": request.user.serialize(request),
-        "items": [],
     }
 
-    # Create outbox
-    if outbox is None:
-        outbox = Activity.query.filter_by(actor=request.user.id)
-    else:
-        outbox = outbox.filter_by(actor=request.user.id)
-
-    # We want the newest things at the top (issue: #1055)
-    outbox = outbox.order_by(Activity.published.desc())
-
-    # Limit by the "count" (default: 20)
-    limit = request.args.get("count", 20)
-
     try:
-        limit = int(limit)
-    except ValueError:
-        limit = 20
-
-    # The upper most limit should be 200
-    limit = limit if limit < 200 else 200
-
-    # apply the limit
-    outbox = outbox.limit(limit)
-
-    # Offset (default: no offset - first <count>  result)
-    outbox = outbox.offset(request.args.get("offset", 0))
-
-    # Build feed.
-    for activity in outbox:
-        try:
-            feed["items"].append(activity.serialize(request))
-        except AttributeError:
-            # This occurs because of how we hard-deletion and the object
-            # no longer existing anymore. We want to keep the Activity
-            # in case someone wishes to look it up but we shouldn't display
-            # it in the feed.
-            pass
-    feed["totalItems"] = len(feed["items"])
+        feed.update(activity_feed(
+            request,
+            activity_query(actor=request.user, verbs=verbs),
+            count_activities(actor=request.user, verbs=verbs)
+        ))
+    except ValueError as error:
+        return json_error(str(error))
 
     return json_response(feed)
 
@@ -582,10 +557,7 @@ def feed_minor_endpoint(request):
     if request.method != "GET":
         return feed_endpoint(request)
 
-    outbox = Activity.query.filter(
-        (Activity.verb == "update") | (Activity.verb == "delete")
-    )
-    return feed_endpoint(request, outbox=outbox)
+    return feed_endpoint(request, verbs=MINOR_VERBS)
 
 @oauth_required
 def feed_major_endpoint(request):
@@ -594,8 +566,7 @@ def feed_major_endpoint(request):
     if request.method != "GET":
         return feed_endpoint(request)
 
-    outbox = Activity.query.filter_by(verb="post")
-    return feed_endpoint(request, outbox=outbox)
+    return feed_endpoint(request, verbs=MAJOR_VERBS)
 
 @oauth_required
 def object_endpoint(request):
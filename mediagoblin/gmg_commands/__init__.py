@@ -76,6 +76,14 @@ SUBCOMMAND_MAP = {
         'setup': 'mediagoblin.gmg_commands.batchaddmedia:parser_setup',
         'func': 'mediagoblin.gmg_commands.batchaddmedia:batchaddmedia',
         'help': 'Add many media entries at once'},
+    'dedupstorage': {
+        'setup': 'mediagoblin.gmg_commands.dedupstorage:parser_setup',
+        'func': 'mediagoblin.gmg_commands.dedupstorage:dedupstorage',
+        'help': 'Deduplicate the files of the public store'},
+    'rendermarkdown': {
+        'setup': 'mediagoblin.gmg_commands.rendermarkdown:parser_setup',
+        'func': 'mediagoblin.gmg_commands.rendermarkdown:rendermarkdown',
+        'help': 'Store the rendered markdown of existing text'},
     # 'theme': {
     #     'setup': 'mediagoblin.gmg_commands.theme:theme_parser_setup',
     #     'func': 'mediagoblin.gmg_commands.theme:theme',
@@ -0,0 +1,107 @@
+# GNU MediaGoblin -- federated, autonomous media hosting
+# Copyright (C) 2011, 2012 MediaGoblin contributors.  See AUTHORS.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import print_function
+import os
+import sys
+
+from mediagoblin.gmg_commands import util as commands_util
+from mediagoblin.storage.dedupstorage import DedupFileStorage, REF_PREFIX
+from mediagoblin.tools.files import file_hash
+
+
+def parser_setup(subparser):
+    subparser.description = """\
+Move the files of a BasicFileStorage tree into a DedupFileStorage blob store,
+keeping a single copy of identical files.  Set storage_class to
+mediagoblin.storage.dedupstorage:DedupFileStorage for the store afterwards."""
+    subparser.add_argument(
+        '--base_dir',
+        help=('Directory to convert.  Defaults to the base_dir of the '
+              'public store.'))
+    subparser.add_argument(
+        '--blob_dir', default=u'blobs',
+        help='Directory below base_dir the blobs go to.')
+    subparser.add_argument(
+        '--dry-run', action='store_true', dest='dry_run',
+        help="Only report how much space would be saved.")
+
+
+def walk_plain_files(storage):
+    """
+    Yield the filepaths of all files in storage which aren't deduplicated yet
+    """
+    for dirname, dirs, files in os.walk(storage.base_dir):
+        relative = os.path.relpath(dirname, storage.base_dir)
+        if relative == os.curdir:
+            relative = []
+            if storage.blob_dir in dirs:
+                dirs.remove(storage.blob_dir)
+        else:
+            relative = relative.split(os.sep)
+
+        for name in sorted(files):
+            filepath = relative + [name]
+            with open(storage._resolve_filepath(filepath), 'rb') as f:
+                if f.read(len(REF_PREFIX)) == REF_PREFIX:
+                    continue
+            yield filepath
+
+
+def format_size(size):
+    if size < 1024:
+        return '%d bytes' % size
+    for unit in ('KiB', 'MiB', 'GiB'):
+        size /= 1024.0
+        if size < 1024:
+            break
+    return '%.1f %s' % (size, unit)
+
+
+def dedupstorage(args):
+    app = commands_util.setup_app(args)
+
+    base_dir = args.base_dir or getattr(app.public_store, 'base_dir', None)
+    if not base_dir:
+        print('The public store has no base_dir, please pass --base_dir.')
+        sys.exit(1)
+
+    storage = DedupFileStorage(base_dir, blob_dir=args.blob_dir)
+
+    files = total_size = unique_size = 0
+    seen = set()
+    for filepath in walk_plain_files(storage):
+        size = os.stat(storage._resolve_filepath(filepath)).st_size
+        files += 1
+        total_size += size
+
+        if args.dry_run:
+            blob_name = file_hash(storage._resolve_filepath(filepath)) + \
+                os.path.splitext(filepath[-1])[1].lower()
+            known = blob_name in seen or \
+                os.path.exists(storage._blob_path(blob_name))
+            seen.add(blob_name)
+        else:
+            blob_name, known = storage.dedup_file(filepath)
+
+        if not known:
+            unique_size += size
+
+    print('Files:        %d' % files)
+    print('Total size:   %s' % format_size(total_size))
+    print('Unique size:  %s' % format_size(unique_size))
+    print('%s %s' % ('Would save: ' if args.dry_run else 'Saved:      ',
+                     format_size(total_size - unique_size)))
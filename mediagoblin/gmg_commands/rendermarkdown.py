@@ -0,0 +1,83 @@
+# GNU MediaGoblin -- federated, autonomous media hosting
+# Copyright (C) 2011, 2012 MediaGoblin contributors.  See AUTHORS.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import print_function
+import sys
+
+from mediagoblin.gmg_commands import util as commands_util
+from mediagoblin.tools.text import cleaned_markdown_conversion
+
+# (model, markdown column, rendered column)
+RENDERED_FIELDS = [
+    ('User', 'bio', 'rendered_bio'),
+    ('MediaEntry', 'description', 'rendered_description'),
+    ('MediaComment', 'content', 'rendered_content')]
+
+
+def parser_setup(subparser):
+    subparser.description = """\
+Store the rendered markdown of bios, media descriptions and comments that
+were saved before rendered markdown was stored.  Safe to run on a live
+instance, rows are committed in small batches."""
+    subparser.add_argument(
+        '--force', action='store_true',
+        help=('Render all rows again, eg. after the markdown or html '
+              'cleaning rules changed.'))
+    subparser.add_argument(
+        '--batch-size', type=int, default=100, dest='batch_size',
+        help='How many rows to render per commit.')
+
+
+def render_rows(db, model, source, rendered, batch_size=100, force=False):
+    """
+    Store the rendered markdown of model.source in model.rendered
+
+    Returns how many rows were rendered.
+    """
+    query = model.query
+    if not force:
+        query = query.filter(getattr(model, rendered) == None)
+
+    count = last_id = 0
+    while True:
+        rows = query.filter(model.id > last_id).order_by(model.id).limit(
+            batch_size).all()
+        if not rows:
+            break
+
+        for row in rows:
+            setattr(row, rendered,
+                    cleaned_markdown_conversion(getattr(row, source)))
+        db.commit()
+
+        last_id = rows[-1].id
+        count += len(rows)
+    return count
+
+
+def rendermarkdown(args):
+    app = commands_util.setup_app(args)
+
+    if not app.app_config['store_rendered_markdown']:
+        print('store_rendered_markdown is disabled in the config, '
+              'nothing to do.')
+        sys.exit(1)
+
+    for model_name, source, rendered in RENDERED_FIELDS:
+        count = render_rows(
+            app.db, getattr(app.db, model_name), source, rendered,
+            args.batch_size, args.force)
+        print('%s.%s: rendered %d' % (model_name, source, count))
@@ -17,9 +17,17 @@
 from __future__ import print_function
 
 import argparse
+import datetime
+import io
+import json
+import multiprocessing
 import os
+import time
+
+from sqlalchemy import func
 
 from mediagoblin import mg_globals
+from mediagoblin.db.base import Session
 from mediagoblin.db.models import MediaEntry
 from mediagoblin.gmg_commands import util as commands_util
 from mediagoblin.submit.lib import run_process_media
@@ -95,13 +103,17 @@ def reprocess_parser_setup(subparser):
         type=int,
         metavar=('max_width', 'max_height'))
 
+    bulk_parser_setup(thumbs)
+
     #################
     # initial command
     #################
-    subparsers.add_parser(
+    initial_parser = subparsers.add_parser(
         'initial',
         help='Reprocess all failed media')
 
+    bulk_parser_setup(initial_parser)
+
     ##################
     # bulk_run command
     ##################
@@ -120,6 +132,8 @@ def reprocess_parser_setup(subparser):
         help='The state of the media you would like to process. Defaults to' \
              " 'processed'")
 
+    bulk_parser_setup(bulk_run_parser)
+
     bulk_run_parser.add_argument(
         'reprocess_command',
         help='The reprocess command you intend to run')
@@ -216,70 +230,296 @@ def bulk_run(args):
     query = MediaEntry.query.filter_by(media_type=args.type,
                                        state=args.state)
 
-    for entry in query:
-        run(args, entry.id)
+    bulk_reprocess(args, query, run)
+
+
+def thumb(args, media_id):
+    """
+    Regenerate the thumb of a single media entry
+    """
+    try:
+        media_entry, manager = get_entry_and_processing_manager(media_id)
+
+        # TODO: (maybe?) This could probably be handled entirely by the
+        # processor class...
+        try:
+            processor_class = manager.get_processor(
+                'resize', media_entry)
+        except ProcessorDoesNotExist:
+            print('No such processor "%s" for media with id "%s"' % (
+                'resize', media_entry.id))
+            return
+        except ProcessorNotEligible:
+            print('Processor "%s" exists but media "%s" is not eligible' % (
+                'resize', media_entry.id))
+            return
+
+        reprocess_parser = processor_class.generate_parser()
+
+        # prepare filetype and size to be passed into reprocess_parser
+        if args.size:
+            extra_args = 'thumb --{0} {1} {2}'.format(
+                processor_class.thumb_size,
+                args.size[0],
+                args.size[1])
+        else:
+            extra_args = 'thumb'
+
+        reprocess_args = reprocess_parser.parse_args(extra_args.split())
+        reprocess_request = processor_class.args_to_request(reprocess_args)
+        run_process_media(
+            media_entry,
+            reprocess_action='resize',
+            reprocess_info=reprocess_request)
+
+    except ProcessingManagerDoesNotExist:
+        entry = MediaEntry.query.filter_by(id=media_id).first()
+        print('No such processing manager for {0}'.format(entry.media_type))
 
 
 def thumbs(args):
     """
     Regenerate thumbs for all processed media
     """
-    query = MediaEntry.query.filter_by(state='processed')
+    query = MediaEntry.query.filter_by(state=u'processed')
 
-    for entry in query:
-        try:
-            media_entry, manager = get_entry_and_processing_manager(entry.id)
-
-            # TODO: (maybe?) This could probably be handled entirely by the
-            # processor class...
-            try:
-                processor_class = manager.get_processor(
-                    'resize', media_entry)
-            except ProcessorDoesNotExist:
-                print('No such processor "%s" for media with id "%s"' % (
-                    'resize', media_entry.id))
-                return
-            except ProcessorNotEligible:
-                print('Processor "%s" exists but media "%s" is not eligible' % (
-                    'resize', media_entry.id))
-                return
-
-            reprocess_parser = processor_class.generate_parser()
-
-            # prepare filetype and size to be passed into reprocess_parser
-            if args.size:
-                extra_args = 'thumb --{0} {1} {2}'.format(
-                    processor_class.thumb_size,
-                    args.size[0],
-                    args.size[1])
-            else:
-                extra_args = 'thumb'
+    bulk_reprocess(args, query, thumb)
 
-            reprocess_args = reprocess_parser.parse_args(extra_args.split())
-            reprocess_request = processor_class.args_to_request(reprocess_args)
-            run_process_media(
-                media_entry,
-                reprocess_action='resize',
-                reprocess_info=reprocess_request)
 
-        except ProcessingManagerDoesNotExist:
-            print('No such processing manager for {0}'.format(entry.media_type))
+def initial_one(args, media_id):
+    """
+    Run the initial processing of a single media entry again
+    """
+    try:
+        media_entry, manager = get_entry_and_processing_manager(media_id)
+        run_process_media(
+            media_entry,
+            reprocess_action='initial')
+    except ProcessingManagerDoesNotExist:
+        entry = MediaEntry.query.filter_by(id=media_id).first()
+        print('No such processing manager for {0}'.format(entry.media_type))
 
 
 def initial(args):
     """
     Reprocess all failed media
     """
-    query = MediaEntry.query.filter_by(state='failed')
+    query = MediaEntry.query.filter_by(state=u'failed')
 
-    for entry in query:
-        try:
-            media_entry, manager = get_entry_and_processing_manager(entry.id)
-            run_process_media(
-                media_entry,
-                reprocess_action='initial')
-        except ProcessingManagerDoesNotExist:
-            print('No such processing manager for {0}'.format(entry.media_type))
+    bulk_reprocess(args, query, initial_one)
+
+
+#################
+# Bulk processing
+#################
+
+def bulk_parser_setup(subparser):
+    subparser.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help="Number of processes reprocessing media at once.  Ignored "
+             "with --celery.  Defaults to 1")
+
+    subparser.add_argument(
+        '--batch-size',
+        type=int,
+        default=100,
+        dest='batch_size',
+        help="How many media entries to read from the database at once. "
+             "Defaults to 100")
+
+    subparser.add_argument(
+        '--checkpoint',
+        help="File to record progress in.  An interrupted run started "
+             "again with the same file carries on where it stopped")
+
+    subparser.add_argument(
+        '--max-queued',
+        type=int,
+        dest='max_queued',
+        help="With --celery, wait while at least this many tasks are "
+             "waiting in the celery queue")
+
+
+class BulkProgress(object):
+    """
+    Keep track of what a bulk reprocessing run did, per media type
+    """
+    def __init__(self, totals):
+        self.totals = totals
+        self.done = dict((media_type, 0) for media_type in totals)
+        self.failed = dict((media_type, 0) for media_type in totals)
+        self.started = time.time()
+
+    def add(self, media_type, ok):
+        self.done[media_type] = self.done.get(media_type, 0) + 1
+        if not ok:
+            self.failed[media_type] = self.failed.get(media_type, 0) + 1
+
+    def report(self):
+        """
+        Return one line per media type with throughput and ETA
+        """
+        elapsed = max(time.time() - self.started, 0.001)
+        lines = []
+        for media_type in sorted(self.totals):
+            done = self.done.get(media_type, 0)
+            total = self.totals[media_type]
+            rate = done / elapsed
+            if done >= total:
+                eta = 'done'
+            elif rate:
+                eta = 'ETA {0}'.format(datetime.timedelta(
+                    seconds=int((total - done) / rate)))
+            else:
+                eta = 'ETA unknown'
+
+            lines.append('{0}: {1}/{2} ({3} failed), {4:.2f}/s, {5}'.format(
+                media_type, done, total, self.failed.get(media_type, 0),
+                rate, eta))
+        return lines
+
+
+class QueueThrottle(object):
+    """
+    Hold back sending tasks while the celery queue is too long
+    """
+    def __init__(self, max_queued, poll_interval=5):
+        self.max_queued = max_queued
+        self.poll_interval = poll_interval
+        self.room = 0
+
+    def queue_length(self):
+        from celery import current_app
+        with current_app.connection() as connection:
+            return connection.default_channel.queue_declare(
+                queue=current_app.conf.CELERY_DEFAULT_QUEUE,
+                passive=True).message_count
+
+    def wait(self):
+        """
+        Block until there's room for one more task in the queue
+        """
+        while self.room <= 0:
+            self.room = self.max_queued - self.queue_length()
+            if self.room <= 0:
+                time.sleep(self.poll_interval)
+        self.room -= 1
+
+
+def read_checkpoint(filename):
+    """
+    Return the last media id a bulk run got done with, or 0
+    """
+    if not filename or not os.path.exists(filename):
+        return 0
+    with io.open(filename, encoding='utf-8') as checkpoint:
+        return json.load(checkpoint)['last_id']
+
+
+def write_checkpoint(filename, last_id):
+    # Replace the file in one go, so an interruption never leaves it empty
+    tmp_filename = filename + '.tmp'
+    with io.open(tmp_filename, 'w', encoding='utf-8') as checkpoint:
+        checkpoint.write(u'{0}\n'.format(json.dumps({'last_id': last_id})))
+    os.rename(tmp_filename, filename)
+
+
+def iter_batches(query, batch_size, last_id=0):
+    """
+    Yield lists of (id, media_type) of the entries in query, in ascending
+    id order, reading batch_size at a time
+    """
+    while True:
+        batch = query.filter(MediaEntry.id > last_id).order_by(
+            MediaEntry.id).with_entities(
+                MediaEntry.id, MediaEntry.media_type).limit(batch_size).all()
+        if not batch:
+            return
+        yield batch
+        last_id = batch[-1][0]
+        # Don't keep the batch's objects around in the session
+        Session.remove()
+
+
+def bulk_reprocess_one(job):
+    """
+    Run process_one for one media entry, in a pool worker or right here.
+
+    Returns the media id and whether things went well.
+    """
+    process_one, args, media_id = job
+    try:
+        process_one(args, media_id)
+        entry = MediaEntry.query.filter_by(id=media_id).first()
+        return media_id, entry is not None and entry.state != u'failed'
+    except Exception as exc:
+        print('Reprocessing media {0} failed: {1}'.format(media_id, exc))
+        return media_id, False
+    finally:
+        Session.remove()
+
+
+def bulk_reprocess(args, query, process_one):
+    """
+    Call process_one(args, media_id) for every entry of query.
+
+    Entries are read in batches by id, processed by a pool of
+    args.workers processes, progress is recorded in args.checkpoint and
+    reported per media type after every batch.
+    """
+    last_id = read_checkpoint(args.checkpoint)
+    if last_id:
+        print('Resuming after media {0}'.format(last_id))
+
+    totals = dict(query.filter(MediaEntry.id > last_id).with_entities(
+        MediaEntry.media_type, func.count(MediaEntry.id)).group_by(
+            MediaEntry.media_type).all())
+    progress = BulkProgress(totals)
+
+    throttle = None
+    if args.celery and args.max_queued:
+        throttle = QueueThrottle(args.max_queued)
+
+    pool = None
+    if args.workers > 1 and not args.celery:
+        # The workers get forked, so make sure they don't share any
+        # database connection with us
+        Session.remove()
+        mg_globals.database.engine.dispose()
+        pool = multiprocessing.Pool(args.workers)
+
+    try:
+        for batch in iter_batches(query, args.batch_size, last_id):
+            media_types = dict(batch)
+            jobs = [(process_one, args, media_id)
+                    for media_id, media_type in batch]
+
+            if pool is not None:
+                results = pool.imap(bulk_reprocess_one, jobs)
+            else:
+                results = []
+                for job in jobs:
+                    if throttle is not None:
+                        throttle.wait()
+                    results.append(bulk_reprocess_one(job))
+
+            for media_id, ok in results:
+                progress.add(media_types[media_id], ok)
+
+            if args.checkpoint:
+                write_checkpoint(args.checkpoint, batch[-1][0])
+            for line in progress.report():
+                print(line)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    # All done, so the next run starts from the beginning again
+    if args.checkpoint and os.path.exists(args.checkpoint):
+        os.remove(args.checkpoint)
 
 
 def reprocess(args):
@@ -24,8 +24,9 @@ from mediagoblin import mg_globals
 from mediagoblin.mg_globals import setup_globals
 from mediagoblin.db.open import setup_connection_and_db_from_config, \
     check_db_migrations_current, load_models
+from mediagoblin.db.lookup import SharedLookupCache
 from mediagoblin.tools.pluginapi import hook_runall
-from mediagoblin.tools.workbench import WorkbenchManager
+from mediagoblin.tools.workbench import WorkbenchManager, RemoteFileCache
 from mediagoblin.storage import storage_system_from_config
 
 from mediagoblin.tools.transition import DISABLE_GLOBALS
@@ -156,9 +157,49 @@ def setup_storage():
 def setup_workbench():
     app_config = mg_globals.app_config
 
-    workbench_manager = WorkbenchManager(app_config['workbench_path'])
+    if app_config['workbench_cache_size']:
+        cache = RemoteFileCache(
+            app_config['workbench_cache_path'],
+            app_config['workbench_cache_size'] * 1024 * 1024)
+    else:
+        cache = None
+
+    workbench_manager = WorkbenchManager(app_config['workbench_path'], cache)
 
     if not DISABLE_GLOBALS:
         setup_globals(workbench_manager=workbench_manager)
 
     return workbench_manager
+
+
+def setup_derivative_cache():
+    # mediagoblin.processing pulls in the models, so import it late
+    from mediagoblin.processing.cache import DerivativeCache
+
+    app_config = mg_globals.app_config
+
+    if app_config['derivative_cache_size']:
+        derivative_cache = DerivativeCache(
+            app_config['derivative_cache_path'],
+            app_config['derivative_cache_size'] * 1024 * 1024)
+    else:
+        derivative_cache = None
+
+    if not DISABLE_GLOBALS:
+        setup_globals(derivative_cache=derivative_cache)
+
+    return derivative_cache
+
+
+def setup_lookup_cache():
+    app_config = mg_globals.app_config
+
+    if app_config['lookup_cache_ttl']:
+        lookup_cache = SharedLookupCache(app_config['lookup_cache_ttl'])
+    else:
+        lookup_cache = None
+
+    if not DISABLE_GLOBALS:
+        setup_globals(lookup_cache=lookup_cache)
+
+    return lookup_cache
@@ -71,7 +71,14 @@ def get_celery_settings_dict(app_config, global_config,
             'garbage-collection': {
                 'task': 'mediagoblin.submit.task.collect_garbage',
                 'schedule': datetime.timedelta(minutes=frequency),
-            }
+            },
+            # Picks up files queued for deletion without starting the task,
+            # and files which could not be deleted before
+            'file-deletion': {
+                'task': 'mediagoblin.submit.task.delete_queued_files',
+                'schedule': datetime.timedelta(minutes=frequency),
+                'kwargs': {'count_attempts': True},
+            },
         }
         celery_settings['BROKER_HEARTBEAT'] = 1
 
@@ -33,12 +33,13 @@ def setup_plugins():
     global_config = mg_globals.global_config
     plugin_section = global_config.get('plugins', {})
 
+    pman = pluginapi.PluginManager()
+
     if not plugin_section:
         _log.info("No plugins to load")
+        pman.freeze_hooks()
         return
 
-    pman = pluginapi.PluginManager()
-
     # Go through and import all the modules that are subsections of
     # the [plugins] section and read in the hooks.
     for plugin_module, config in plugin_section.items():
@@ -60,3 +61,6 @@ def setup_plugins():
 
     # Execute anything registered to the setup hook.
     pluginapi.hook_runall('setup')
+
+    # All hooks are in now, speed up calling them
+    pman.freeze_hooks()
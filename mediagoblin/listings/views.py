@@ -16,9 +16,9 @@
 
 from mediagoblin import mg_globals
 from mediagoblin.db.models import MediaEntry
-from mediagoblin.db.util import media_entries_for_tag_slug
-from mediagoblin.tools.pagination import Pagination
-from mediagoblin.tools.response import render_to_response
+from mediagoblin.db.util import media_entries_for_tag_slug, query_version
+from mediagoblin.tools.pagination import KeysetPagination
+from mediagoblin.tools.response import render_to_response, cached_feed_response
 from mediagoblin.decorators import uses_pagination
 
 from werkzeug.contrib.atom import AtomFeed
@@ -48,7 +48,8 @@ def tag_listing(request, page):
     cursor = media_entries_for_tag_slug(request.db, tag_slug)
     cursor = cursor.order_by(MediaEntry.created.desc())
 
-    pagination = Pagination(page, cursor)
+    pagination = KeysetPagination(page, cursor,
+                                  marker=request.pagination_marker)
     media_entries = pagination()
 
     tag_name = _get_tag_name_from_entries(media_entries, tag_slug)
@@ -81,41 +82,49 @@ def atom_feed(request):
         link = request.urlgen('index', qualified=True)
         feed_title += "for all recent items"
 
-    atomlinks = [
-        {'href': link,
-         'rel': 'alternate',
-         'type': 'text/html'}]
-
-    if mg_globals.app_config["push_urls"]:
-        for push_url in mg_globals.app_config["push_urls"]:
-            atomlinks.append({
-                'rel': 'hub',
-                'href': push_url})
-
-    cursor = cursor.order_by(MediaEntry.created.desc())
-    cursor = cursor.limit(ATOM_DEFAULT_NR_OF_UPDATED_ITEMS)
-
-    feed = AtomFeed(
-        feed_title,
-        feed_url=request.url,
-        id=link,
-        links=atomlinks)
-
-    for entry in cursor:
-        feed.add(entry.get('title'),
-            entry.description_html,
-            id=entry.url_for_self(request.urlgen,qualified=True),
-            content_type='html',
-            author={'name': entry.get_uploader.username,
-                'uri': request.urlgen(
-                    'mediagoblin.user_pages.user_home',
-                    qualified=True, user=entry.get_uploader.username)},
-            updated=entry.get('created'),
-            links=[{
-                'href':entry.url_for_self(
-                   request.urlgen,
-                   qualified=True),
-                'rel': 'alternate',
-                'type': 'text/html'}])
-
-    return feed.get_response()
+    count, last_modified = query_version(cursor, MediaEntry.updated)
+
+    def make_feed():
+        atomlinks = [
+            {'href': link,
+             'rel': 'alternate',
+             'type': 'text/html'}]
+
+        if mg_globals.app_config["push_urls"]:
+            for push_url in mg_globals.app_config["push_urls"]:
+                atomlinks.append({
+                    'rel': 'hub',
+                    'href': push_url})
+
+        entries = cursor.order_by(MediaEntry.created.desc())
+        entries = entries.limit(ATOM_DEFAULT_NR_OF_UPDATED_ITEMS)
+
+        feed = AtomFeed(
+            feed_title,
+            feed_url=request.base_url,
+            id=link,
+            links=atomlinks)
+
+        for entry in entries:
+            feed.add(entry.get('title'),
+                entry.description_html,
+                id=entry.url_for_self(request.urlgen,qualified=True),
+                content_type='html',
+                author={'name': entry.get_uploader.username,
+                    'uri': request.urlgen(
+                        'mediagoblin.user_pages.user_home',
+                        qualified=True, user=entry.get_uploader.username)},
+                updated=entry.get('created'),
+                links=[{
+                    'href':entry.url_for_self(
+                       request.urlgen,
+                       qualified=True),
+                    'rel': 'alternate',
+                    'type': 'text/html'}])
+
+        return feed
+
+    return cached_feed_response(
+        request,
+        (u'tag_feed', tag_slug, request.base_url, count, last_modified),
+        make_feed)
@@ -15,14 +15,22 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import shutil
 import logging
 import tempfile
+from contextlib import contextmanager
+
+import six
 
 from mediagoblin.tools.pluginapi import hook_handle
 from mediagoblin.tools.translate import lazy_pass_to_ugettext as _
 
 _log = logging.getLogger(__name__)
 
+# Files without a name on disk are copied for the sniffers in chunks of
+# this many bytes
+SNIFF_COPY_CHUNK_SIZE = 1024 * 1024
+
 class FileTypeNotSupported(Exception):
     pass
 
@@ -60,14 +68,9 @@ def sniff_media(media_file, filename):
         return get_media_type_and_manager(filename)
     except FileTypeNotSupported:
         _log.info('No media handler found by file extension. Doing it the expensive way...')
-        # Create a temporary file for sniffers suchs as GStreamer-based
-        # Audio video
-        tmp_media_file = tempfile.NamedTemporaryFile()
-        tmp_media_file.write(media_file.read())
-        tmp_media_file.seek(0)
-        media_file.seek(0)
+        with sniffable_file(media_file) as sniff_file:
+            media_type = hook_handle('sniff_handler', sniff_file, filename)
 
-        media_type = hook_handle('sniff_handler', tmp_media_file, filename)
         if media_type:
             _log.info('{0} accepts the file'.format(media_type))
             return media_type, hook_handle(('media_manager', media_type))
@@ -79,6 +82,30 @@ def sniff_media(media_file, filename):
         _(u'Sorry, I don\'t support that file type :('))
 
 
+@contextmanager
+def sniffable_file(media_file):
+    """
+    Give sniffers (such as the GStreamer-based audio and video ones) a file
+    which exists on disk under media_file.name.
+
+    A media_file which already is such a file is used as is; anything else
+    is copied to a temporary file in bounded chunks.
+    """
+    name = getattr(media_file, 'name', None)
+    if isinstance(name, six.string_types) and os.path.isfile(name):
+        yield media_file
+        return
+
+    tmp_media_file = tempfile.NamedTemporaryFile()
+    try:
+        shutil.copyfileobj(media_file, tmp_media_file, SNIFF_COPY_CHUNK_SIZE)
+        tmp_media_file.seek(0)
+        media_file.seek(0)
+        yield tmp_media_file
+    finally:
+        tmp_media_file.close()
+
+
 def get_media_type_and_manager(filename):
     '''
     Try to find the media type based on the file name, extension
@@ -91,8 +118,9 @@ def get_media_type_and_manager(filename):
 
         # Omit the dot from the extension and match it against
         # the media manager
-        if hook_handle('get_media_type_and_manager', ext[1:]):
-            return hook_handle('get_media_type_and_manager', ext[1:])
+        type_and_manager = hook_handle('get_media_type_and_manager', ext[1:])
+        if type_and_manager:
+            return type_and_manager
     else:
         _log.info('File {0} has no file extension, let\'s hope the sniffers get it.'.format(
             filename))
@@ -24,6 +24,8 @@ from mediagoblin.processing import (
     ProgressCallback, MediaProcessor, ProcessingManager,
     request_from_args, get_process_filename,
     store_public, copy_original)
+from mediagoblin.processing.cache import (
+    derivative_cache_key, get_cached_derivative, cache_derivative)
 
 from mediagoblin.media_types.audio.transcoders import (
     AudioTranscoder, AudioThumbnailer)
@@ -70,6 +72,11 @@ class CommonAudioProcessor(MediaProcessor):
         self.transcoder = AudioTranscoder()
         self.thumbnailer = AudioThumbnailer()
 
+        # Raw PCM of the audio for the spectrogram, decoded while
+        # transcoding if possible, see transcode(keep_pcm=True)
+        self.pcm_tmp = None
+        self.pcm_samplerate = None
+
     def copy_original(self):
         if self.audio_config['keep_original']:
             copy_original(
@@ -108,7 +115,25 @@ class CommonAudioProcessor(MediaProcessor):
 
         return skip
 
-    def transcode(self, quality=None):
+    def _pcm_filename(self):
+        return os.path.join(self.workbench.dir,
+                            self.name_builder.fill('{basename}.pcm'))
+
+    def _remove_pcm(self):
+        """
+        Remove the decoded audio, it's huge, so it isn't kept around in the
+        workbench any longer than needed
+        """
+        if self.pcm_tmp is not None:
+            if os.path.exists(self.pcm_tmp):
+                os.remove(self.pcm_tmp)
+            self.pcm_tmp = None
+
+    def transcode(self, quality=None, keep_pcm=False):
+        """
+        Transcode the web version.  If keep_pcm, keep the decoded audio
+        around for create_spectrogram() too.
+        """
         if not quality:
             quality = self.audio_config['quality']
 
@@ -120,13 +145,27 @@ class CommonAudioProcessor(MediaProcessor):
                                       self.name_builder.fill(
                                           '{basename}{ext}'))
 
-        self.transcoder.transcode(
-            self.process_filename,
-            webm_audio_tmp,
-            quality=quality,
-            progress_callback=progress_callback)
+        cache_key = derivative_cache_key(
+            self.process_filename, MEDIA_TYPE + ':webm_audio',
+            quality=quality)
+        if get_cached_derivative(cache_key, webm_audio_tmp) is None:
+            data = self.transcoder.discover(self.process_filename)
+            pcm_tmp = self._pcm_filename() if keep_pcm else None
+
+            self.transcoder.transcode(
+                self.process_filename,
+                webm_audio_tmp,
+                data=data,
+                quality=quality,
+                progress_callback=progress_callback,
+                pcm_dst=pcm_tmp)
+
+            if keep_pcm:
+                self.pcm_tmp = pcm_tmp
+                self.pcm_samplerate = data.audiorate
 
-        self.transcoder.discover(webm_audio_tmp)
+            self.transcoder.discover(webm_audio_tmp)
+            cache_derivative(cache_key, webm_audio_tmp)
 
         self._keep_best()
 
@@ -144,27 +183,34 @@ class CommonAudioProcessor(MediaProcessor):
 
         if self._skip_processing('spectrogram', max_width=max_width,
                                  fft_size=fft_size):
+            self._remove_pcm()
             return
 
-        wav_tmp = os.path.join(self.workbench.dir, self.name_builder.fill(
-            '{basename}.ogg'))
-
-        _log.info('Creating OGG source for spectrogram')
-        self.transcoder.transcode(
-            self.process_filename,
-            wav_tmp,
-            mux_string='vorbisenc quality={0} ! oggmux'.format(
-                self.audio_config['quality']))
-
         spectrogram_tmp = os.path.join(self.workbench.dir,
                                        self.name_builder.fill(
                                            '{basename}-spectrogram.jpg'))
 
-        self.thumbnailer.spectrogram(
-            wav_tmp,
-            spectrogram_tmp,
-            width=max_width,
-            fft_size=fft_size)
+        cache_key = derivative_cache_key(
+            self.process_filename, MEDIA_TYPE + ':spectrogram',
+            max_width=max_width, fft_size=fft_size)
+        if get_cached_derivative(cache_key, spectrogram_tmp) is None:
+            if self.pcm_tmp is None:
+                _log.info('Decoding PCM source for spectrogram')
+                data = self.transcoder.discover(self.process_filename)
+                self.pcm_tmp = self._pcm_filename()
+                self.pcm_samplerate = data.audiorate
+                self.transcoder.decode(
+                    self.process_filename, self.pcm_tmp, data=data)
+
+            self.thumbnailer.spectrogram(
+                self.pcm_tmp,
+                spectrogram_tmp,
+                width=max_width,
+                fft_size=fft_size,
+                samplerate=self.pcm_samplerate)
+            cache_derivative(cache_key, spectrogram_tmp)
+
+        self._remove_pcm()
 
         _log.debug('Saving spectrogram...')
         store_public(self.entry, 'spectrogram', spectrogram_tmp,
@@ -263,7 +309,7 @@ class InitialProcessor(CommonAudioProcessor):
                 medium_width=None):
         self.common_setup()
 
-        self.transcode(quality=quality)
+        self.transcode(quality=quality, keep_pcm=True)
         self.copy_original()
 
         self.create_spectrogram(max_width=medium_width, fft_size=fft_size)
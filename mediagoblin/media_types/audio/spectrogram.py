@@ -24,6 +24,7 @@ try:
 except ImportError:
     import Image
 import math
+import os
 import numpy
 
 try:
@@ -31,6 +32,8 @@ try:
 except ImportError:
     print "WARNING: audiolab is not installed so wav2png will not work"
 
+from mediagoblin.media_types.audio.audioprocessing import BatchAudioProcessor
+
 
 class AudioProcessingException(Exception):
     pass
@@ -79,6 +82,8 @@ class SpectrogramImage(object):
         # a lot slower than using image.putadata and then rotating the image
         # so we store all the pixels in an array and then create the image when saving
         self.pixels = []
+        # or, when drawing all spectra at once, the finished image
+        self.spectra_image = None
 
     def draw_spectrum(self, x, spectrum):
         # for all frequencies, draw the pixels
@@ -91,7 +96,32 @@ class SpectrogramImage(object):
         for y in range(len(self.y_to_bin), self.image_height):
             self.pixels.append(self.palette[0])
 
+    def draw_spectra(self, db_spectra):
+        '''
+        Draw the db spectra of all columns (one per row of db_spectra)
+        at once, as a single lookup in the palette.
+        '''
+        bins = numpy.array(
+                [index for index, alpha in self.y_to_bin], dtype=numpy.intp)
+        alphas = numpy.array([alpha for index, alpha in self.y_to_bin])
+
+        # If the FFT is too small to fill up the image, the top stays black
+        colors = numpy.zeros(
+                (len(db_spectra), self.image_height), dtype=numpy.intp)
+        colors[:, :len(bins)] = (
+                (255.0 - alphas) * db_spectra[:, bins]
+                + alphas * db_spectra[:, bins + 1])
+
+        # Rows of the image are frequencies, lowest at the bottom
+        pixels = numpy.array(self.palette, dtype=numpy.uint8)[colors.T[::-1]]
+        self.spectra_image = Image.fromarray(
+                numpy.ascontiguousarray(pixels), 'RGB')
+
     def save(self, filename, quality=90):
+        if self.spectra_image is not None:
+            self.spectra_image.save(filename, quality=quality)
+            return
+
         self.image = Image.new(
                 'RGBA',
                 (self.image_height, self.image_width))
@@ -257,21 +287,18 @@ class AudioProcessor(object):
 def create_spectrogram_image(source_filename, output_filename,
         image_size, fft_size, progress_callback=None):
 
-    processor = AudioProcessor(source_filename, fft_size, numpy.hamming)
-    samples_per_pixel = processor.audio_file.nframes / float(image_size[0])
-
-    spectrogram = SpectrogramImage(image_size, fft_size)
-
-    for x in range(image_size[0]):
-        if progress_callback and x % (image_size[0] / 10) == 0:
-            progress_callback((x * 100) / image_size[0])
+    processor = BatchAudioProcessor(
+            source_filename, fft_size, numpy.hamming,
+            tmp_dir=os.path.dirname(os.path.abspath(output_filename)))
 
-        seek_point = int(x * samples_per_pixel)
-        next_seek_point = int((x + 1) * samples_per_pixel)
+    if progress_callback:
+        progress_callback(50)
 
-        (spectral_centroid, db_spectrum) = processor.spectral_centroid(seek_point)
+    (spectral_centroids, db_spectra) = processor.spectral_centroids(
+            image_size[0])
 
-        spectrogram.draw_spectrum(x, db_spectrum)
+    spectrogram = SpectrogramImage(image_size, fft_size)
+    spectrogram.draw_spectra(db_spectra)
 
     if progress_callback:
         progress_callback(100)
@@ -15,6 +15,8 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
+import os
+import time
 try:
     from PIL import Image
 except ImportError:
@@ -62,36 +64,43 @@ except ImportError:
 
 import numpy
 
+from mediagoblin.media_types import gstengine
+
+# Raw PCM as expected by audioprocessing.BatchAudioProcessor
+PCM_CAPS = 'audio/x-raw-float,channels={0},width={1},endianness=1234'.format(
+    audioprocessing.PCM_CHANNELS, audioprocessing.PCM_DTYPE.itemsize * 8)
+
 
 class AudioThumbnailer(object):
     def __init__(self):
         _log.info('Initializing {0}'.format(self.__class__.__name__))
 
     def spectrogram(self, src, dst, **kw):
+        """
+        Create a spectrogram of src in dst.  If samplerate is given, src is
+        raw PCM as decoded by AudioTranscoder.transcode(pcm_dst=...).
+        """
         width = kw['width']
         height = int(kw.get('height', float(width) * 0.3))
         fft_size = kw.get('fft_size', 2048)
         callback = kw.get('progress_callback')
 
-        processor = audioprocessing.AudioProcessor(
+        # Decode once and do all the FFTs in batches, the memory-mapped
+        # samples live next to dst in the workbench
+        processor = audioprocessing.BatchAudioProcessor(
             src,
             fft_size,
-            numpy.hanning)
+            numpy.hanning,
+            tmp_dir=os.path.dirname(os.path.abspath(dst)),
+            samplerate=kw.get('samplerate'))
 
-        samples_per_pixel = processor.audio_file.nframes / float(width)
-
-        spectrogram = audioprocessing.SpectrogramImage(width, height, fft_size)
-
-        for x in range(width):
-            if callback and x % (width / 10) == 0:
-                callback((x * 100) / width)
-
-            seek_point = int(x * samples_per_pixel)
+        if callback:
+            callback(50)
 
-            (spectral_centroid, db_spectrum) = processor.spectral_centroid(
-                seek_point)
+        (spectral_centroids, db_spectra) = processor.spectral_centroids(width)
 
-            spectrogram.draw_spectrum(x, db_spectrum)
+        spectrogram = audioprocessing.SpectrogramImage(width, height, fft_size)
+        spectrogram.draw_spectra(db_spectra)
 
         if callback:
             callback(100)
@@ -131,8 +140,9 @@ class AudioTranscoder(object):
     def __init__(self):
         _log.info('Initializing {0}'.format(self.__class__.__name__))
 
-        # Instantiate MainLoop
-        self._loop = gobject.MainLoop()
+        # The main loop of the worker, see gstengine
+        self._engine = gstengine.get_engine()
+        self._loop = self._engine.loop()
         self._failed = None
 
     def discover(self, src):
@@ -140,12 +150,14 @@ class AudioTranscoder(object):
         _log.info('Discovering {0}'.format(src))
         self._discovery_path = src
 
+        started = time.time()
         self._discoverer = gst.extend.discoverer.Discoverer(
             self._discovery_path)
         self._discoverer.connect('discovered', self.__on_discovered)
         self._discoverer.discover()
 
-        self._loop.run()  # Run MainLoop
+        self._loop.run()  # Wait for the MainLoop of the engine
+        self._engine.record('audio discover', 0, time.time() - started)
 
         if self._failed:
             raise self._failed
@@ -167,8 +179,15 @@ class AudioTranscoder(object):
         self.halt()
 
     def transcode(self, src, dst, **kw):
+        """
+        Transcode src into dst.
+
+        If pcm_dst is given, the decoded audio is also written to it as raw
+        PCM (see audioprocessing.PCM_DTYPE), for the spectrogram, so src
+        doesn't need to be decoded again.
+        """
         _log.info('Transcoding {0} into {1}'.format(src, dst))
-        self._discovery_data = kw.get('data', self.discover(src))
+        self._discovery_data = kw.get('data') or self.discover(src)
 
         self.__on_progress = kw.get('progress_callback')
 
@@ -178,26 +197,58 @@ class AudioTranscoder(object):
             'mux_string',
             'vorbisenc quality={0} ! webmmux'.format(quality))
 
-        # Set up pipeline
-        self.pipeline = gst.parse_launch(
-            'filesrc location="{src}" ! '
-            'decodebin2 ! queue ! audiorate tolerance={tolerance} ! '
-            'audioconvert ! audio/x-raw-float,channels=2 ! '
-            '{mux_string} ! '
-            'progressreport silent=true ! '
-            'filesink location="{dst}"'.format(
-                src=src,
-                tolerance=80000000,
-                mux_string=mux_string,
-                dst=dst))
-
-        self.bus = self.pipeline.get_bus()
-        self.bus.add_signal_watch()
-        self.bus.connect('message', self.__on_bus_message)
-
-        self.pipeline.set_state(gst.STATE_PLAYING)
-
-        self._loop.run()
+        pcm_dst = kw.get('pcm_dst')
+
+        # Set up pipeline.  The files are set per use, so the engine can
+        # reuse the pipeline for the next file.
+        pipeline = (
+            'filesrc name=src ! decodebin2 name=decoder '
+            'queue name=decoded ! audiorate tolerance={tolerance} ! '
+            'audioconvert ! audio/x-raw-float,channels=2 ! ')
+        if pcm_dst:
+            pipeline += (
+                'tee name=tee ! queue ! '
+                '{mux_string} ! '
+                'progressreport silent=true ! '
+                'filesink name=dst '
+                'tee. ! queue ! audioconvert ! {pcm_caps} ! '
+                'filesink name=pcm_dst')
+        else:
+            pipeline += (
+                '{mux_string} ! '
+                'progressreport silent=true ! '
+                'filesink name=dst')
+
+        locations = {'src.location': src, 'dst.location': dst}
+        if pcm_dst:
+            locations['pcm_dst.location'] = pcm_dst
+
+        with self._engine.pipeline(
+                pipeline.format(
+                    tolerance=80000000,
+                    mux_string=mux_string,
+                    pcm_caps=PCM_CAPS),
+                name='audio transcode', **locations) as self.pipeline:
+            bus = self.pipeline.get_bus()
+            handler = bus.connect('message', self.__on_bus_message)
+            try:
+                self.pipeline.set_state(gst.STATE_PLAYING)
+
+                self._loop.run()
+
+                # Raised here, so the engine doesn't keep the pipeline
+                if self._failed:
+                    raise self._failed
+            finally:
+                bus.disconnect(handler)
+                del self.pipeline
+
+    def decode(self, src, pcm_dst, **kw):
+        """
+        Only decode src, into raw PCM for the spectrogram
+        """
+        self.transcode(src, pcm_dst, mux_string='audioconvert ! ' + PCM_CAPS,
+                       **kw)
 
     def __on_bus_message(self, bus, message):
         _log.debug(message)
@@ -214,11 +265,14 @@ class AudioTranscoder(object):
         elif message.type == gst.MESSAGE_EOS:
             _log.info('Done')
             self.halt()
+        elif message.type == gst.MESSAGE_ERROR:
+            _log.error('Transcoding failed: {0}'.format(
+                message.parse_error()))
+            self._failed = BadMediaFail()
+            self.halt()
 
     def halt(self):
-        if getattr(self, 'pipeline', False):
-            self.pipeline.set_state(gst.STATE_NULL)
-            del self.pipeline
+        # The pipeline is reset by the engine, once the loop returns
         _log.info('Quitting MainLoop gracefully...')
         gobject.idle_add(self._loop.quit)
 
@@ -0,0 +1,238 @@
+# GNU MediaGoblin -- federated, autonomous media hosting
+# Copyright (C) 2011, 2012 MediaGoblin contributors.  See AUTHORS.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+The GStreamer side of a processing worker, shared by all its tasks
+
+Instead of every transcoder and thumbnailer running (and tearing down)
+its own gobject.MainLoop, one main loop runs for the lifetime of the
+worker process in a thread of its own.  The transcoders get a
+MainLoop-like EngineLoop from get_engine().loop(), whose run() just
+waits for quit() while bus messages are handled by the engine thread.
+
+Pipelines described by a template can be kept around and reused by
+later tasks, instead of parsing and constructing them for every file:
+see MediaEngine.pipeline().  Both keep timing statistics, see
+MediaEngine.get_stats(), which are logged when the worker process shuts
+down.
+
+Only import this where GStreamer 0.10 is used anyway.
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from celery.signals import worker_process_shutdown
+
+import gobject
+gobject.threads_init()
+
+import pygst
+pygst.require('0.10')
+import gst
+
+_log = logging.getLogger(__name__)
+
+# How many idle pipelines to keep per template
+PIPELINE_POOL_SIZE = 2
+
+
+class EngineLoop(object):
+    """
+    Stands in for a gobject.MainLoop which is run by the engine thread
+
+    quit() may be called (from any thread) before run() is reached, so
+    callbacks that fire early don't leave run() waiting forever.
+    """
+    def __init__(self):
+        self._quit = threading.Event()
+        self._running = False
+
+    def run(self):
+        self._running = True
+        try:
+            self._quit.wait()
+        finally:
+            self._running = False
+            self._quit.clear()
+
+    def quit(self):
+        self._quit.set()
+
+    def is_running(self):
+        return self._running and not self._quit.is_set()
+
+
+class MediaEngine(object):
+    """
+    One long-lived GLib main loop thread and pool of pipelines per process
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+        self._mainloop = None
+        self._thread = None
+        self._pool = defaultdict(list)
+        self._stats = defaultdict(lambda: {
+            'count': 0, 'reused': 0, 'setup': 0.0, 'run': 0.0})
+
+    def start(self):
+        """
+        Start the main loop thread, if it isn't running in this process
+
+        After a fork (like celery's prefork pool does), the thread and
+        pipelines of the parent are gone, so everything starts afresh.
+        """
+        with self._lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+
+            self._pid = os.getpid()
+            self._pool.clear()
+            self._mainloop = gobject.MainLoop()
+            self._thread = threading.Thread(
+                target=self._mainloop.run, name='gst-mainloop')
+            self._thread.daemon = True
+            self._thread.start()
+            _log.debug('Started the GStreamer main loop thread')
+
+    def loop(self):
+        """
+        A MainLoop-like object for transcoders, see EngineLoop
+        """
+        self.start()
+        return EngineLoop()
+
+    def _link_decoder(self, decoder, pad, islast, decoded):
+        sink = decoded.get_pad('sink')
+        if not sink.is_linked() and \
+                not sink.get_caps().intersect(pad.get_caps()).is_empty():
+            pad.link(sink)
+
+    def _build(self, template):
+        pipeline = gst.parse_launch(template)
+        # Users connect to 'message' of the bus, and disconnect when done
+        pipeline.get_bus().add_signal_watch()
+
+        # parse_launch only links the dynamic pads of decodebin2 once,
+        # so link them ourselves, again after every reset
+        decoder = pipeline.get_by_name('decoder')
+        decoded = pipeline.get_by_name('decoded')
+        if decoder is not None and decoded is not None:
+            decoder.connect('new-decoded-pad', self._link_decoder, decoded)
+
+        return pipeline
+
+    def _discard(self, pipeline):
+        """
+        Stop a pipeline which won't be reused.  The signal watch of its
+        bus would keep it alive for as long as the main loop runs.
+        """
+        pipeline.set_state(gst.STATE_NULL)
+        pipeline.get_bus().remove_signal_watch()
+
+    @contextmanager
+    def pipeline(self, template, name=None, **properties):
+        """
+        Use a pipeline described by template, a gst-launch description.
+
+        properties are set on the elements of the pipeline by name, with
+        'element.property' keys, eg. {'src.location': '/tmp/a.ogg'}, so the
+        same template can be reused for different files.
+
+        If the template has a decodebin2 named 'decoder', its decoded pads
+        are linked to the element named 'decoded', which must not be
+        linked with '!'.  The bus of the pipeline already has a signal
+        watch, handlers connected to it have to be disconnected again.
+        The pipeline is reset to NULL when done and kept for a later task,
+        unless it failed or the pool is full.
+        """
+        self.start()
+        stats = self._stats[name or template]
+
+        started = time.time()
+        with self._lock:
+            pool = self._pool[template]
+            pipeline = pool.pop() if pool else None
+        if pipeline is None:
+            pipeline = self._build(template)
+        else:
+            stats['reused'] += 1
+
+        for key, value in properties.items():
+            element_name, prop = key.split('.', 1)
+            pipeline.get_by_name(element_name).set_property(prop, value)
+        prepared = time.time()
+        stats['setup'] += prepared - started
+
+        try:
+            yield pipeline
+        except:
+            self._discard(pipeline)
+            raise
+        else:
+            pipeline.set_state(gst.STATE_NULL)
+            with self._lock:
+                pool = self._pool[template]
+                if len(pool) < PIPELINE_POOL_SIZE:
+                    pool.append(pipeline)
+                    pipeline = None
+            if pipeline is not None:
+                self._discard(pipeline)
+        finally:
+            stats['count'] += 1
+            stats['run'] += time.time() - prepared
+
+    def record(self, name, setup, run):
+        """
+        Add the timings of a pipeline that was not made by pipeline()
+        """
+        stats = self._stats[name]
+        stats['count'] += 1
+        stats['setup'] += setup
+        stats['run'] += run
+
+    def get_stats(self):
+        """
+        Timings per pipeline (template) name, as a dict of dicts with
+        how many ran, how many of those were reused, and the total
+        setup and run time in seconds.
+        """
+        return dict((name, dict(stats))
+                    for name, stats in self._stats.items())
+
+
+_engine = MediaEngine()
+
+
+def get_engine():
+    return _engine
+
+
+def log_stats(**kwargs):
+    """
+    Log the timings of the pipelines this process ran
+    """
+    for name, stats in sorted(_engine.get_stats().items()):
+        _log.info(
+            '{0}: {count} pipelines, {reused} reused, {setup:.2f}s setting '
+            'up, {run:.2f}s running'.format(name, **stats))
+
+worker_process_shutdown.connect(log_stats)
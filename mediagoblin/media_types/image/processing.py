@@ -23,6 +23,7 @@ except ImportError:
 import os
 import logging
 import argparse
+from multiprocessing.pool import ThreadPool
 
 import six
 
@@ -32,7 +33,9 @@ from mediagoblin.processing import (
     BadMediaFail, FilenameBuilder,
     MediaProcessor, ProcessingManager,
     request_from_args, get_process_filename,
-    store_public, copy_original)
+    copy_original, create_pub_filepath, copy_to_public_store)
+from mediagoblin.processing.cache import (
+    derivative_cache_key, get_cached_derivative, cache_derivative)
 from mediagoblin.tools.exif import exif_fix_image_orientation, \
     extract_exif, clean_exif, get_gps_data, get_useful, \
     exif_image_needs_rotation
@@ -47,24 +50,32 @@ PIL_FILTERS = {
 
 MEDIA_TYPE = 'mediagoblin.media_types.image'
 
+# How many resized versions of an image are encoded and stored at once
+RESIZE_THREADS = 4
 
-def resize_image(entry, resized, keyname, target_name, new_size,
-                 exif_tags, workdir, quality, filter):
+
+def resize_tool(entry,
+                force, keyname, orig_file, target_name,
+                conversions_subdir, exif_tags, quality, filter, new_size=None):
+    multi_resize_tool(
+        entry, orig_file, [(keyname, force, target_name, new_size)],
+        conversions_subdir, exif_tags, quality, filter)
+
+
+def multi_resize_tool(entry, orig_file, targets, conversions_subdir,
+                      exif_tags, quality, filter):
     """
-    Store a resized version of an image and return its pathname.
-
-    Arguments:
-    proc_state -- the processing state for the image to resize
-    resized -- an image from Image.open() of the original image being resized
-    keyname -- Under what key to save in the db.
-    target_name -- public file path for the new resized image
-    exif_tags -- EXIF data for the original image
-    workdir -- directory path for storing converted image files
-    new_size -- 2-tuple size for the resized image
-    quality -- level of compression used when resizing images
-    filter -- One of BICUBIC, BILINEAR, NEAREST, ANTIALIAS
+    Store several resized versions of orig_file, decoding it only once.
+
+    targets is a list of (keyname, force, target_name, new_size) tuples,
+    with the same meaning as the arguments of resize_tool().  Every size is
+    scaled down from the smallest already resized version which is still
+    big enough, and the results are encoded and stored on a thread pool.
     """
-    resized = exif_fix_image_orientation(resized, exif_tags)  # Fix orientation
+    try:
+        im = Image.open(orig_file)
+    except IOError:
+        raise BadMediaFail()
 
     try:
         resize_filter = PIL_FILTERS[filter.upper()]
@@ -73,56 +84,102 @@ def resize_image(entry, resized, keyname, target_name, new_size,
             six.text_type(filter),
             u', '.join(PIL_FILTERS.keys())))
 
-    resized.thumbnail(new_size, resize_filter)
-
-    # Copy the new file to the conversion subdir, then remotely.
-    tmp_resized_filename = os.path.join(workdir, target_name)
-    with open(tmp_resized_filename, 'wb') as resized_file:
-        resized.save(resized_file, quality=quality)
-    store_public(entry, keyname, tmp_resized_filename, target_name)
-
-    # store the thumb/medium info
-    image_info = {'width': new_size[0],
-                  'height': new_size[1],
-                  'quality': quality,
-                  'filter': filter}
-
-    entry.set_file_metadata(keyname, **image_info)
-
-
-def resize_tool(entry,
-                force, keyname, orig_file, target_name,
-                conversions_subdir, exif_tags, quality, filter, new_size=None):
-    # Use the default size if new_size was not given
-    if not new_size:
-        max_width = mgg.global_config['media:' + keyname]['max_width']
-        max_height = mgg.global_config['media:' + keyname]['max_height']
-        new_size = (max_width, max_height)
-
-    # If thumb or medium is already the same quality and size, then don't
-    # reprocess
-    if _skip_resizing(entry, keyname, new_size, quality, filter):
-        _log.info('{0} of same size and quality already in use, skipping '
-                  'resizing of media {1}.'.format(keyname, entry.id))
-        return
-
-    # If the size of the original file exceeds the specified size for the desized
-    # file, a target_name file is created and later associated with the media
-    # entry.
-    # Also created if the file needs rotation, or if forced.
-    try:
-        im = Image.open(orig_file)
-    except IOError:
-        raise BadMediaFail()
-    if force \
-        or im.size[0] > new_size[0]\
-        or im.size[1] > new_size[1]\
-        or exif_image_needs_rotation(exif_tags):
-        resize_image(
-            entry, im, six.text_type(keyname), target_name,
-            tuple(new_size),
-            exif_tags, conversions_subdir,
-            quality, filter)
+    jobs = []
+    for keyname, force, target_name, new_size in targets:
+        keyname = six.text_type(keyname)
+
+        # Use the default size if new_size was not given
+        if not new_size:
+            new_size = (mgg.global_config['media:' + keyname]['max_width'],
+                        mgg.global_config['media:' + keyname]['max_height'])
+        new_size = tuple(new_size)
+
+        # If thumb or medium is already the same quality and size, then
+        # don't reprocess
+        if _skip_resizing(entry, keyname, new_size, quality, filter):
+            _log.info('{0} of same size and quality already in use, skipping '
+                      'resizing of media {1}.'.format(keyname, entry.id))
+            continue
+
+        # Only resize if the original exceeds the size, if it needs
+        # rotation, or if forced.
+        if not (force
+                or im.size[0] > new_size[0]
+                or im.size[1] > new_size[1]
+                or exif_image_needs_rotation(exif_tags)):
+            continue
+
+        tmp_resized_filename = os.path.join(conversions_subdir, target_name)
+        cache_key = derivative_cache_key(
+            orig_file, MEDIA_TYPE + ':resize', size=new_size,
+            quality=quality, filter=filter)
+        jobs.append({
+            'keyname': keyname,
+            'size': new_size,
+            'filename': tmp_resized_filename,
+            'filepath': create_pub_filepath(entry, target_name),
+            'cache_key': cache_key,
+            'cached': get_cached_derivative(
+                cache_key, tmp_resized_filename) is not None,
+            'image': None})
+
+    to_resize = sorted(
+        [job for job in jobs if not job['cached']],
+        key=lambda job: job['size'][0] * job['size'][1], reverse=True)
+    if to_resize:
+        # Let JPEGs decode at 1/2, 1/4 or 1/8 of their size right away if
+        # that's still bigger than what we need
+        im.draft(None, to_resize[0]['size'])
+        im = exif_fix_image_orientation(im, exif_tags)  # Fix orientation
+
+        intermediates = [im]
+        for job in to_resize:
+            # thumbnail() never scales up, so the source must reach the
+            # target size in at least one dimension
+            source = [image for image in intermediates
+                      if image.size[0] >= job['size'][0]
+                      or image.size[1] >= job['size'][1]]
+            source = source[-1] if source else im
+
+            resized = source.copy()
+            resized.thumbnail(job['size'], resize_filter)
+            job['image'] = resized
+            intermediates.append(resized)
+
+    def encode_and_store(job):
+        if job['image'] is not None:
+            with open(job['filename'], 'wb') as resized_file:
+                job['image'].save(resized_file, quality=quality)
+            cache_derivative(job['cache_key'], job['filename'])
+        copy_to_public_store(job['filename'], job['filepath'], job['keyname'])
+
+    if len(jobs) > 1:
+        pool = ThreadPool(min(len(jobs), RESIZE_THREADS))
+        try:
+            pool.map(encode_and_store, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for job in jobs:
+            encode_and_store(job)
+
+    # Only now touch the entry, the database session isn't thread safe
+    for job in jobs:
+        keyname = job['keyname']
+        if keyname in entry.media_files:
+            _log.warn("multi_resize_tool: keyname %r already used for file "
+                      "%r, replacing with %r", keyname,
+                      entry.media_files[keyname], job['filepath'])
+            mgg.public_store.delete_file(entry.media_files[keyname])
+        entry.media_files[keyname] = job['filepath']
+
+        # store the thumb/medium info
+        entry.set_file_metadata(keyname, **{
+            'width': job['size'][0],
+            'height': job['size'][1],
+            'quality': quality,
+            'filter': filter})
 
 
 def _skip_resizing(entry, keyname, size, quality, filter):
@@ -209,6 +266,25 @@ class CommonImageProcessor(MediaProcessor):
                     self.conversions_subdir, self.exif_tags, quality,
                     filter, size)
 
+    def generate_medium_and_thumb(self, size=None, thumb_size=None,
+                                  quality=None, filter=None):
+        """
+        Generate the medium (if applicable) and the thumbnail in one go
+        """
+        if not quality:
+            quality = self.image_config['quality']
+        if not filter:
+            filter = self.image_config['resize_filter']
+
+        multi_resize_tool(
+            self.entry, self.process_filename, [
+                ('medium', False,
+                 self.name_builder.fill('{basename}.medium{ext}'), size),
+                ('thumb', True,
+                 self.name_builder.fill('{basename}.thumbnail{ext}'),
+                 thumb_size)],
+            self.conversions_subdir, self.exif_tags, quality, filter)
+
     def generate_thumb(self, size=None, quality=None, filter=None):
         if not quality:
             quality = self.image_config['quality']
@@ -313,9 +389,8 @@ class InitialProcessor(CommonImageProcessor):
 
     def process(self, size=None, thumb_size=None, quality=None, filter=None):
         self.common_setup()
-        self.generate_medium_if_applicable(size=size, filter=filter,
-                                           quality=quality)
-        self.generate_thumb(size=thumb_size, filter=filter, quality=quality)
+        self.generate_medium_and_thumb(size=size, thumb_size=thumb_size,
+                                       filter=filter, quality=quality)
         self.copy_original()
         self.extract_metadata('original')
         self.delete_queue_file()
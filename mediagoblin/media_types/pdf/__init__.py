@@ -17,12 +17,22 @@
 from mediagoblin.media_types import MediaManagerBase
 from mediagoblin.media_types.pdf.processing import PdfProcessingManager, \
     sniff_handler
+# Imported for the celery workers, which need to know the render_page task
+from mediagoblin.media_types.pdf import pages
+from mediagoblin.tools import pluginapi
 
 
 ACCEPTED_EXTENSIONS = ['pdf']
 MEDIA_TYPE = 'mediagoblin.media_types.pdf'
 
 
+def setup_plugin():
+    pluginapi.register_routes([
+        ('mediagoblin.media_types.pdf.page',
+         '/u/<string:user>/m/<string:media>/page/<int:page>/',
+         'mediagoblin.media_types.pdf.views:pdf_page')])
+
+
 class PDFMediaManager(MediaManagerBase):
     human_readable = "PDF"
     display_template = "mediagoblin/media_displays/pdf.html"
@@ -35,6 +45,7 @@ def get_media_type_and_manager(ext):
 
 
 hooks = {
+    'setup': setup_plugin,
     'get_media_type_and_manager': get_media_type_and_manager,
     'sniff_handler': sniff_handler,
     ('media_manager', MEDIA_TYPE): lambda: PDFMediaManager,
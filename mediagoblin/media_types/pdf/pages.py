@@ -0,0 +1,174 @@
+# GNU MediaGoblin -- federated, autonomous media hosting
+# Copyright (C) 2011, 2012 MediaGoblin contributors.  See AUTHORS.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Pages of pdfs, rendered when they are first asked for
+
+Processing only renders the first page, as the medium.  Other pages are
+rendered by the render_page task the first time someone views them, see
+views.pdf_page, and stored in the public store as the media file
+'page_<number>'.  At most page_cache_size pages of a document are kept,
+the least recently viewed ones are deleted when more are rendered.
+
+Pages being rendered, or which could not be rendered, are noted in the
+file metadata of the original, so a page is only rendered once at a time
+and a broken one isn't tried again and again.
+"""
+
+import logging
+import os
+import time
+
+import celery
+import six
+
+from mediagoblin import mg_globals as mgg
+from mediagoblin.media_types.pdf.processing import MEDIA_TYPE, render_pages
+from mediagoblin.processing import BadMediaFail
+
+_log = logging.getLogger(__name__)
+
+# Seconds between writing down when a page was last viewed, so not
+# every view of a page costs a database write
+LAST_VIEWED_RESOLUTION = 60 * 60
+
+# Seconds after which a page still noted as being rendered is rendered
+# again, in case its task got lost
+RENDERING_TIMEOUT = 10 * 60
+
+PAGE_RENDERING = u'rendering'
+PAGE_FAILED = u'failed'
+
+
+def page_key(page):
+    return u'page_{0}'.format(page)
+
+
+def page_filepath(entry, page):
+    return ['media_entries', six.text_type(entry.id),
+            u'page-{0}.png'.format(page)]
+
+
+def page_count(entry):
+    return entry.media_data and entry.media_data.pdf_pages or 1
+
+
+def rendered_pages(entry):
+    """
+    The numbers of the rendered pages of entry, least recently viewed first
+    """
+    pages = [int(key[len(u'page_'):]) for key in entry.media_files
+             if key.startswith(u'page_')]
+    return sorted(pages, key=lambda page: _last_viewed(entry, page) or 0)
+
+
+def _last_viewed(entry, page):
+    media_file = entry.media_files_helper[page_key(page)]
+    return (media_file.file_metadata or {}).get('last_viewed')
+
+
+def mark_viewed(entry, page):
+    """
+    Move page to the end of the least recently viewed order
+    """
+    now = time.time()
+    last_viewed = _last_viewed(entry, page)
+    if last_viewed is None or now - last_viewed > LAST_VIEWED_RESOLUTION:
+        entry.set_file_metadata(page_key(page), last_viewed=now)
+
+
+def _page_states(entry):
+    return (entry.get_file_metadata(u'original') or {}).get(
+        'page_states') or {}
+
+
+def page_state(entry, page):
+    """
+    PAGE_RENDERING, PAGE_FAILED or None if page is neither
+    """
+    state = _page_states(entry).get(six.text_type(page))
+    if state is None:
+        return None
+    if state['state'] == PAGE_RENDERING and \
+            time.time() - state['since'] > RENDERING_TIMEOUT:
+        return None
+    return state['state']
+
+
+def set_page_state(entry, page, state):
+    states = dict(_page_states(entry))
+    if state is None:
+        if six.text_type(page) not in states:
+            return
+        del states[six.text_type(page)]
+    else:
+        states[six.text_type(page)] = {'state': state, 'since': time.time()}
+    entry.set_file_metadata(u'original', page_states=states)
+
+
+def evict_pages(entry, keep):
+    """
+    Delete the least recently viewed pages of entry, but the last keep
+    """
+    pages = rendered_pages(entry)
+    for page in pages[:max(len(pages) - keep, 0)]:
+        _log.debug('Evicting page {0} of {1}'.format(page, entry))
+        try:
+            mgg.public_store.delete_file(entry.media_files[page_key(page)])
+        except OSError:
+            pass
+        del entry.media_files[page_key(page)]
+
+
+@celery.task()
+def render_page(media_id, page):
+    """
+    Render page of a processed pdf at the medium size and store it
+    """
+    entry = mgg.database.MediaEntry.query.filter_by(id=media_id).first()
+    if entry is None or page_key(page) in entry.media_files:
+        return
+
+    config = mgg.global_config['plugins'][MEDIA_TYPE]
+    size = (mgg.global_config['media:medium']['max_width'],
+            mgg.global_config['media:medium']['max_height'])
+
+    workbench = mgg.workbench_manager.create()
+    try:
+        pdf_filename = workbench.localized_file(
+            mgg.public_store,
+            entry.media_files.get('pdf') or entry.media_files['original'])
+        filename = os.path.join(workbench.dir, u'page-{0}.png'.format(page))
+        render_pages(pdf_filename, [(min(size), filename)], page=page)
+
+        filepath = page_filepath(entry, page)
+        mgg.public_store.copy_local_to_storage(filename, filepath)
+    except BadMediaFail:
+        _log.warn('Could not render page {0} of {1}'.format(page, entry))
+        set_page_state(entry, page, PAGE_FAILED)
+        raise
+    except:
+        # Maybe it works out next time someone asks for the page
+        set_page_state(entry, page, None)
+        raise
+    finally:
+        workbench.destroy()
+
+    evict_pages(entry, config['page_cache_size'] - 1)
+    entry.media_files[page_key(page)] = filepath
+    entry.save()
+    set_page_state(entry, page, None)
+    mark_viewed(entry, page)
@@ -16,8 +16,15 @@
 import argparse
 import os
 import logging
+import socket
+import time
 import dateutil.parser
 from subprocess import PIPE, Popen
+from celery.signals import worker_process_shutdown
+try:
+    from PIL import Image
+except ImportError:
+    import Image
 
 from mediagoblin import mg_globals as mgg
 from mediagoblin.processing import (
@@ -25,13 +32,27 @@ from mediagoblin.processing import (
     MediaProcessor, ProcessingManager,
     request_from_args, get_process_filename,
     store_public, copy_original)
+from mediagoblin.processing.cache import (
+    derivative_cache_key, get_cached_derivative, cache_derivative)
 from mediagoblin.tools.translate import fake_ugettext_passthrough as _
 
 _log = logging.getLogger(__name__)
 
 MEDIA_TYPE = 'mediagoblin.media_types.pdf'
 
-# TODO - cache (memoize) util
+# Where the tools were found, by (name, PATH), see where()
+_tool_paths = {}
+
+# Where unoconv listeners accept connections, unless told otherwise
+UNOCONV_LISTENER_ADDRESS = ('127.0.0.1', 2002)
+
+# How many seconds a new unoconv listener gets to start LibreOffice and
+# accept connections, and how often to check whether it does
+UNOCONV_LISTENER_STARTUP = 60
+UNOCONV_LISTENER_POLL = 0.5
+
+# The unoconv listener of this process, see unoconv_listener()
+_listener = {'pid': None, 'process': None}
 
 # This is a list created via uniconv --show and hand removing some types that
 # we already support via other media types better.
@@ -130,8 +151,13 @@ unoconv_supported = [
   #xpm      - X PixMap [.xpm]
 ]
 
-def is_unoconv_working():
+def is_unoconv_working(cache={}):
     # TODO: must have libreoffice-headless installed too, need to check for it
+    if 'working' not in cache:
+        cache['working'] = _is_unoconv_working()
+    return cache['working']
+
+def _is_unoconv_working():
     unoconv = where('unoconv')
     if not unoconv:
         return False
@@ -153,11 +179,21 @@ def supported_extensions(cache=[None]):
     return cache
 
 def where(name):
-    for p in os.environ['PATH'].split(os.pathsep):
-        fullpath = os.path.join(p, name)
-        if os.path.exists(fullpath):
-            return fullpath
-    return None
+    """
+    The full path of the executable name on PATH, or None
+
+    Lookups are cached for as long as PATH stays the same.
+    """
+    path = os.environ['PATH']
+    key = (name, path)
+    if key not in _tool_paths:
+        _tool_paths[key] = None
+        for p in path.split(os.pathsep):
+            fullpath = os.path.join(p, name)
+            if os.path.exists(fullpath):
+                _tool_paths[key] = fullpath
+                break
+    return _tool_paths[key]
 
 def check_prerequisites():
     if not where('pdfinfo'):
@@ -179,15 +215,101 @@ def sniff_handler(media_file, filename):
     if clean_ext in supported_extensions():
         return MEDIA_TYPE
 
-def create_pdf_thumb(original, thumb_filename, width, height):
-    # Note: pdftocairo adds '.png', remove it
-    thumb_filename = thumb_filename[:-4]
+def render_pages(original, outputs, page=1):
+    """
+    Render a page of original into pngs, with a single pdftocairo run.
+
+    outputs is a list of (scale, filename), the page is scaled to fit in
+    a square of scale pixels like 'pdftocairo -scale-to' does.  Only the
+    largest one is rendered by pdftocairo, the rest are scaled down from
+    it.
+    """
+    outputs = sorted(outputs, reverse=True)
+    largest_scale, largest_filename = outputs[0]
+
+    # Note: pdftocairo adds '.png', so don't include an ext
     executable = where('pdftocairo')
-    args = [executable, '-scale-to', str(min(width, height)),
-            '-singlefile', '-png', original, thumb_filename]
+    args = [executable, '-f', str(page), '-l', str(page),
+            '-scale-to', str(largest_scale),
+            '-singlefile', '-png', original, largest_filename[:-4]]
     _log.debug('calling {0}'.format(repr(' '.join(args))))
     Popen(executable=executable, args=args).wait()
 
+    if not os.path.exists(largest_filename):
+        _log.debug('pdftocairo failed to render page {0}'.format(page))
+        raise BadMediaFail()
+
+    if len(outputs) > 1:
+        rendered = Image.open(largest_filename)
+        for scale, filename in outputs[1:]:
+            resized = rendered.copy()
+            resized.thumbnail((scale, scale), Image.ANTIALIAS)
+            resized.save(filename)
+
+def create_pdf_thumb(original, thumb_filename, width, height):
+    render_pages(original, [(min(width, height), thumb_filename)])
+
+def unoconv_listener():
+    """
+    Make sure this process has a running unoconv listener, so conversions
+    don't have to start LibreOffice for every document
+
+    Returns whether a listener is running.
+    """
+    config = mgg.global_config['plugins'][MEDIA_TYPE]
+    if not config['unoconv_listener']:
+        return False
+
+    process = _listener['process']
+    if _listener['pid'] == os.getpid() and process.poll() is None:
+        if _unoconv_listener_accepts():
+            return True
+        # It stopped accepting connections, start over with a new one
+        _stop_unoconv_listener()
+
+    unoconv = where('unoconv')
+    _log.info('Starting an unoconv listener')
+    try:
+        process = Popen([unoconv, '--listener'])
+    except OSError:
+        _log.warn('Could not start an unoconv listener')
+        return False
+
+    _listener['pid'] = os.getpid()
+    _listener['process'] = process
+
+    deadline = time.time() + UNOCONV_LISTENER_STARTUP
+    while time.time() < deadline:
+        if _unoconv_listener_accepts():
+            return True
+        if process.poll() is not None:
+            break
+        time.sleep(UNOCONV_LISTENER_POLL)
+
+    _log.warn('The unoconv listener is not accepting connections')
+    _stop_unoconv_listener()
+    return False
+
+def _unoconv_listener_accepts():
+    try:
+        socket.create_connection(
+            UNOCONV_LISTENER_ADDRESS, timeout=UNOCONV_LISTENER_POLL).close()
+    except socket.error:
+        return False
+    return True
+
+def _stop_unoconv_listener(**kwargs):
+    process = _listener['process']
+    if _listener['pid'] == os.getpid() and process.poll() is None:
+        process.terminate()
+        process.wait()
+    _listener['pid'] = None
+    _listener['process'] = None
+
+# Celery's pool processes leave through os._exit(), which doesn't run
+# atexit handlers
+worker_process_shutdown.connect(_stop_unoconv_listener)
+
 def pdf_info(original):
     """
     Extract dictionary of pdf information. This could use a library instead
@@ -287,31 +409,56 @@ class CommonPdfProcessor(MediaProcessor):
             self.name_builder.fill('{basename}{ext}'))
 
     def generate_thumb(self, thumb_size=None):
+        self.generate_previews(keys=['thumb'], thumb_size=thumb_size)
+
+    def generate_previews(self, keys=('medium', 'thumb'), size=None,
+                          thumb_size=None):
+        """
+        Generate the medium and/or thumb image of the first page, with a
+        single pdftocairo run for all of them
+        """
+        if not size:
+            size = (mgg.global_config['media:medium']['max_width'],
+                    mgg.global_config['media:medium']['max_height'])
         if not thumb_size:
             thumb_size = (mgg.global_config['media:thumb']['max_width'],
                           mgg.global_config['media:thumb']['max_height'])
 
-        if self._skip_processing('thumb', thumb_size=thumb_size):
-            return
-
-        # Note: pdftocairo adds '.png', so don't include an ext
-        thumb_filename = os.path.join(self.workbench.dir,
-                                      self.name_builder.fill(
-                                          '{basename}.thumbnail'))
-
-        executable = where('pdftocairo')
-        args = [executable, '-scale-to', str(min(thumb_size)),
-                '-singlefile', '-png', self.pdf_filename, thumb_filename]
-
-        _log.debug('calling {0}'.format(repr(' '.join(args))))
-        Popen(executable=executable, args=args).wait()
-
-        # since pdftocairo added '.png', we need to include it with the
-        # filename
-        store_public(self.entry, 'thumb', thumb_filename + '.png',
-                     self.name_builder.fill('{basename}.thumbnail.png'))
-
-        self.entry.set_file_metadata('thumb', thumb_size=thumb_size)
+        # keyname: (filename suffix, file metadata key, size)
+        previews = {
+            'medium': ('medium', 'size', size),
+            'thumb': ('thumbnail', 'thumb_size', thumb_size)}
+
+        to_store = []
+        to_render = []
+        for keyname in keys:
+            suffix, size_key, preview_size = previews[keyname]
+            metadata = {size_key: preview_size}
+            if self._skip_processing(keyname, **metadata):
+                continue
+
+            filename = os.path.join(
+                self.workbench.dir, self.name_builder.fill(
+                    '{basename}.' + suffix + '.png'))
+            scale = min(preview_size)
+
+            cache_key = derivative_cache_key(
+                self.pdf_filename, MEDIA_TYPE + ':' + keyname, **metadata)
+            if get_cached_derivative(cache_key, filename) is None:
+                to_render.append((scale, filename, cache_key))
+            to_store.append((keyname, suffix, filename, metadata))
+
+        if to_render:
+            render_pages(self.pdf_filename, [
+                (scale, filename) for scale, filename, key in to_render])
+            for scale, filename, cache_key in to_render:
+                cache_derivative(cache_key, filename)
+
+        for keyname, suffix, filename, metadata in to_store:
+            store_public(self.entry, keyname, filename,
+                         self.name_builder.fill(
+                             '{basename}.' + suffix + '.png'))
+            self.entry.set_file_metadata(keyname, **metadata)
 
     def _generate_pdf(self):
         """
@@ -321,11 +468,16 @@ class CommonPdfProcessor(MediaProcessor):
 
         unoconv = where('unoconv')
         args = [unoconv, '-v', '-f', 'pdf', self.process_filename]
-        _log.debug('calling %s' % repr(args))
-        Popen(executable=unoconv,
-              args=args).wait()
-
-        if not os.path.exists(tmp_pdf):
+        converted = False
+        if unoconv_listener():
+            converted = self._unoconv(
+                [unoconv, '--no-launch'] + args[1:], tmp_pdf)
+            if not converted:
+                _log.warn('unoconv failed to convert through the listener, '
+                          'trying again without it')
+
+        # Without a listener unoconv starts (and stops) LibreOffice itself
+        if not converted and not self._unoconv(args, tmp_pdf):
             _log.debug('unoconv failed to convert file to pdf')
             raise BadMediaFail()
 
@@ -335,35 +487,23 @@ class CommonPdfProcessor(MediaProcessor):
         return self.workbench.localized_file(
             mgg.public_store, self.entry.media_files['pdf'])
 
+    def _unoconv(self, args, tmp_pdf):
+        """
+        Run unoconv with args, and return whether it made tmp_pdf
+        """
+        _log.debug('calling %s' % repr(args))
+        returncode = Popen(executable=args[0], args=args).wait()
+        if returncode:
+            _log.debug('unoconv exited with {0}'.format(returncode))
+            return False
+        return os.path.exists(tmp_pdf)
+
     def extract_pdf_info(self):
         pdf_info_dict = pdf_info(self.pdf_filename)
         self.entry.media_data_init(**pdf_info_dict)
 
     def generate_medium(self, size=None):
-        if not size:
-            size = (mgg.global_config['media:medium']['max_width'],
-                    mgg.global_config['media:medium']['max_height'])
-
-        if self._skip_processing('medium', size=size):
-            return
-
-        # Note: pdftocairo adds '.png', so don't include an ext
-        filename = os.path.join(self.workbench.dir,
-                                self.name_builder.fill('{basename}.medium'))
-
-        executable = where('pdftocairo')
-        args = [executable, '-scale-to', str(min(size)),
-                '-singlefile', '-png', self.pdf_filename, filename]
-
-        _log.debug('calling {0}'.format(repr(' '.join(args))))
-        Popen(executable=executable, args=args).wait()
-
-        # since pdftocairo added '.png', we need to include it with the
-        # filename
-        store_public(self.entry, 'medium', filename + '.png',
-                     self.name_builder.fill('{basename}.medium.png'))
-
-        self.entry.set_file_metadata('medium', size=size)
+        self.generate_previews(keys=['medium'], size=size)
 
 
 class InitialProcessor(CommonPdfProcessor):
@@ -412,8 +552,7 @@ class InitialProcessor(CommonPdfProcessor):
         self.common_setup()
         self.extract_pdf_info()
         self.copy_original()
-        self.generate_medium(size=size)
-        self.generate_thumb(thumb_size=thumb_size)
+        self.generate_previews(size=size, thumb_size=thumb_size)
         self.delete_queue_file()
 
 
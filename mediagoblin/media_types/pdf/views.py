@@ -0,0 +1,69 @@
+# GNU MediaGoblin -- federated, autonomous media hosting
+# Copyright (C) 2011, 2012 MediaGoblin contributors.  See AUTHORS.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from werkzeug.wrappers import Response
+
+from mediagoblin.decorators import get_user_media_entry, user_not_banned
+from mediagoblin.media_types.pdf.pages import (
+    page_count, page_key, page_state, set_page_state, mark_viewed,
+    render_page, PAGE_FAILED, PAGE_RENDERING)
+from mediagoblin.tools.response import redirect, render_404, render_error
+from mediagoblin.tools.translate import pass_to_ugettext as _
+
+# Seconds after which browsers should ask for a page being rendered again
+RENDERING_RETRY_AFTER = 5
+
+
+@user_not_banned
+@get_user_media_entry
+def pdf_page(request, media):
+    """
+    Redirect to the image of a page of a pdf, rendering it first if needed
+    """
+    page = request.matchdict['page']
+    if not 1 <= page <= page_count(media):
+        return render_404(request)
+
+    # The first page is what the medium is made of
+    if page == 1:
+        return redirect(request, location=request.app.public_store.file_url(
+            media.media_files['medium']))
+
+    if page_key(page) not in media.media_files:
+        # Every viewer keeps asking until the page is there, but it only
+        # has to be rendered once
+        if page_state(media, page) is None:
+            set_page_state(media, page, PAGE_RENDERING)
+            render_page.apply_async([media.id, page])
+
+        if page_state(media, page) == PAGE_FAILED:
+            return render_error(
+                request, 500,
+                err_msg=_('Sorry, this page could not be rendered.'))
+
+        # Unless celery runs the task right away, come back later
+        if page_key(page) not in media.media_files:
+            return Response(
+                _('This page is being rendered, please try again in a '
+                  'few seconds.'),
+                status=202,
+                headers={'Retry-After': str(RENDERING_RETRY_AFTER),
+                         'Refresh': str(RENDERING_RETRY_AFTER)})
+    else:
+        mark_viewed(media, page)
+
+    return redirect(request, location=request.app.public_store.file_url(
+        media.media_files[page_key(page)]))
@@ -15,8 +15,22 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import array
+import io
+import os
 import struct
 
+import numpy
+
+
+# A triangle of a binary stl: normal, three vertices and attribute bytes
+STL_TRIANGLE = numpy.dtype([
+    ('normal', '<f4', (3,)),
+    ('vertices', '<f4', (3, 3)),
+    ('attributes', '<u2')])
+
+STL_HEADER_SIZE = 84
+
 
 class ThreeDeeParseError(Exception):
     pass
@@ -27,10 +41,22 @@ class ThreeDee(object):
     3D model parser base class.  Derrived classes are used for basic
     analysis of 3D models, and are not intended to be used for 3D
     rendering.
+
+    self.verts is an (n, 3) array of the vertices.  Models with more than
+    max_vertices vertices are sampled: self.verts only keeps every so
+    many vertices (whole triangles for stl), but min, max and average
+    are still computed from all of them.
     """
+    # How many vertices belong together and are sampled as one
+    group = 1
+
+    # How many vertices of text models to parse at once
+    batch_size = 100000
 
-    def __init__(self, fileob):
-        self.verts = []
+    def __init__(self, fileob, max_vertices=None):
+        self.max_vertices = max_vertices
+        self.sampled = False
+        self.vertex_count = 0
         self.average = [0, 0, 0]
         self.min = [None, None, None]
         self.max = [None, None, None]
@@ -38,35 +64,119 @@ class ThreeDee(object):
         self.depth = 0  # y axis
         self.height = 0 # z axis
 
+        self._sum = numpy.zeros(3)
+        self._min = numpy.empty(3)
+        self._max = numpy.empty(3)
+        self._stride = 1
+        self._kept = []
+        self._kept_count = 0
+
         self.load(fileob)
-        if not len(self.verts):
+        if not self.vertex_count:
             raise ThreeDeeParseError("Empty model.")
 
-        for vector in self.verts:
-            for i in range(3):
-                num = vector[i]
-                self.average[i] += num
-                if not self.min[i]:
-                    self.min[i] = num
-                    self.max[i] = num
-                else:
-                    if self.min[i] > num:
-                        self.min[i] = num
-                    if self.max[i] < num:
-                        self.max[i] = num
-
-        for i in range(3):
-            self.average[i]/=len(self.verts)
+        if self._kept:
+            self.verts = numpy.concatenate(self._kept).reshape(-1, 3)
+        else:
+            self.verts = numpy.empty((0, 3), numpy.float32)
+        del self._kept
+
+        self.average = (self._sum / self.vertex_count).tolist()
+        self.min = self._min.tolist()
+        self.max = self._max.tolist()
 
         self.width = abs(self.min[0] - self.max[0])
         self.depth = abs(self.min[1] - self.max[1])
         self.height = abs(self.min[2] - self.max[2])
 
-
     def load(self, fileob):
         """Override this method in your subclass."""
         pass
 
+    def triangles(self):
+        """
+        The triangles of the model as an (n, 3, 3) array, or None if only
+        the vertices are known
+        """
+        if self.group == 3:
+            return self.verts.reshape(-1, 3, 3)
+        return None
+
+    def add_bounds(self, verts):
+        """
+        Count the (n, 3) array verts into the bounds and average
+        """
+        if not len(verts):
+            return
+
+        if self.vertex_count:
+            numpy.minimum(self._min, verts.min(axis=0), out=self._min)
+            numpy.maximum(self._max, verts.max(axis=0), out=self._max)
+        else:
+            self._min[:] = verts.min(axis=0)
+            self._max[:] = verts.max(axis=0)
+        self._sum += verts.sum(axis=0, dtype=numpy.float64)
+        self.vertex_count += len(verts)
+
+    def add_verts(self, verts):
+        """
+        Count in and keep the (n, 3) array verts, sampled if needed
+        """
+        groups = verts.reshape(-1, self.group, 3)
+        # Keep the groups whose number (in the whole model) is a
+        # multiple of the stride
+        first = (-(self.vertex_count // self.group)) % self._stride
+        self.add_bounds(verts)
+        self.keep(groups[first::self._stride])
+
+        while self.max_vertices and \
+                self._kept_count * self.group > self.max_vertices:
+            # Halve what is kept, and keep half as much from now on
+            kept = numpy.concatenate(self._kept)[::2]
+            self._kept = [kept]
+            self._kept_count = len(kept)
+            self._stride *= 2
+            self.sampled = True
+
+    def keep(self, groups):
+        self._kept.append(groups)
+        self._kept_count += len(groups)
+
+    def parse_text(self, fileob, keyword):
+        """
+        Add the vertices of the lines of fileob starting with keyword
+        """
+        fileob.seek(0)
+        batch = []
+        for line in fileob:
+            tokens = line.split(None, 4)
+            if not tokens:
+                continue
+            if tokens[0] == keyword:
+                batch.append(b' '.join(tokens[1:4]))
+                if len(batch) == self.batch_size:
+                    self.add_verts(self._parse_batch(batch))
+                    batch = []
+            else:
+                self.parse_line(line, tokens[0], self.vertex_count + len(batch))
+        if batch:
+            self.add_verts(self._parse_batch(batch))
+
+    def parse_line(self, line, keyword, vertex_count):
+        """
+        Called by parse_text for the other lines, vertex_count vertices
+        were read before line
+        """
+        pass
+
+    def _parse_batch(self, batch):
+        values = numpy.fromstring(b' '.join(batch), sep=' ')
+        if len(values) != 3 * len(batch):
+            raise ThreeDeeParseError("Bad vertex.")
+        if len(batch) % self.group:
+            raise ThreeDeeParseError("Incomplete face.")
+        return values.reshape(-1, 3)
+
 
 class ObjModel(ThreeDee):
     """
@@ -74,64 +184,149 @@ class ObjModel(ThreeDee):
     reference: http://en.wikipedia.org/wiki/Wavefront_.obj_file
     """
 
-    def __vector(self, line, expected=3):
-        nums = map(float, line.strip().split(" ")[1:])
-        return tuple(nums[:expected])
-    
     def load(self, fileob):
-        for line in fileob:
-            line = line.strip()
-            if line[0] == "v":
-                self.verts.append(self.__vector(line))
-            
+        self._faces = array.array('l')
+        self.parse_text(fileob, b'v')
 
-class BinaryStlModel(ThreeDee):
+        self.faces = numpy.frombuffer(self._faces, dtype=numpy.dtype('l'))
+        self.faces = self.faces.reshape(-1, 3)
+        del self._faces
+
+    def parse_line(self, line, keyword, vertex_count):
+        if keyword != b'f':
+            return
+
+        # Indices may be like v, v/vt, v//vn or v/vt/vn, and negative for
+        # counting back from the last vertex
+        try:
+            indices = [int(token.split(b'/', 1)[0])
+                       for token in line.split()[1:]]
+        except ValueError:
+            raise ThreeDeeParseError("Bad face.")
+        indices = [index - 1 if index > 0 else vertex_count + index
+                   for index in indices]
+
+        # Polygons are split into a fan of triangles
+        for i in range(1, len(indices) - 1):
+            self._faces.extend(
+                (indices[0], indices[i], indices[i + 1]))
+
+    def triangles(self):
+        # The vertices of sampled models don't match the faces anymore
+        if self.sampled or not len(self.faces) or \
+                self.faces.min() < 0 or self.faces.max() >= len(self.verts):
+            return None
+        return self.verts[self.faces]
+
+
+class AsciiStlModel(ThreeDee):
     """
     Parser for ascii-encoded stl files.  File format reference:
+    http://en.wikipedia.org/wiki/STL_%28file_format%29#ASCII_STL
+    """
+    group = 3
+
+    # batch_size has to be a multiple of group
+    batch_size = 99999
+
+    def load(self, fileob):
+        self.parse_text(fileob, b'vertex')
+
+
+def _file_size(fileob):
+    fileob.seek(0, os.SEEK_END)
+    return fileob.tell()
+
+
+def _triangle_count(fileob):
+    fileob.seek(80) # skip the header
+    count = fileob.read(4)
+    if len(count) < 4:
+        raise ThreeDeeParseError("Truncated binary stl.")
+    return struct.unpack("<I", count)[0]
+
+
+def is_binary_stl(fileob):
+    """
+    Whether the size of fileob is exactly right for a binary stl
+    """
+    try:
+        count = _triangle_count(fileob)
+    except ThreeDeeParseError:
+        return False
+    return _file_size(fileob) == STL_HEADER_SIZE + count * STL_TRIANGLE.itemsize
+
+
+class BinaryStlModel(ThreeDee):
+    """
+    Parser for binary stl files.  File format reference:
     http://en.wikipedia.org/wiki/STL_%28file_format%29#Binary_STL
+
+    The triangles are memory mapped, not read, and the bounds computed
+    in chunks of chunk_size triangles.
     """
+    group = 3
+    chunk_size = 1000000
 
     def load(self, fileob):
-        fileob.seek(80) # skip the header
-        count = struct.unpack("<I", fileob.read(4))[0]
-        for i in range(count):
-            fileob.read(12) # skip the normal vector
-            for v in range(3):
-                self.verts.append(struct.unpack("<3f", fileob.read(12)))
-            fileob.read(2) # skip the attribute bytes
+        count = _triangle_count(fileob)
+        if _file_size(fileob) < \
+                STL_HEADER_SIZE + count * STL_TRIANGLE.itemsize:
+            raise ThreeDeeParseError("Truncated binary stl.")
+        if not count:
+            return
+
+        try:
+            triangles = numpy.memmap(
+                fileob, dtype=STL_TRIANGLE, mode='r',
+                offset=STL_HEADER_SIZE, shape=(count,))
+        except (AttributeError, io.UnsupportedOperation):
+            # Not a real file
+            fileob.seek(STL_HEADER_SIZE)
+            triangles = numpy.frombuffer(
+                fileob.read(count * STL_TRIANGLE.itemsize), STL_TRIANGLE)
 
+        for start in range(0, count, self.chunk_size):
+            chunk = triangles['vertices'][start:start + self.chunk_size]
+            self.add_bounds(chunk.reshape(-1, 3))
 
-def auto_detect(fileob, hint):
+        if self.max_vertices and count * 3 > self.max_vertices:
+            # Keep at most max_vertices vertices, in whole triangles
+            self._stride = -(-count // max(self.max_vertices // 3, 1))
+            self.sampled = True
+        # Copied, so the file can be closed
+        self.keep(numpy.array(triangles['vertices'][::self._stride]))
+
+
+def auto_detect(fileob, hint, max_vertices=None):
     """
     Attempt to divine which parser to use to divine information about
     the model / verify the file."""
 
     if hint == "obj" or not hint:
         try:
-            return ObjModel(fileob)
+            return ObjModel(fileob, max_vertices)
         except ThreeDeeParseError:
             pass
 
     if hint == "stl" or not hint:
+        # Ascii stls could be mistaken for binary ones by their size, but
+        # it is very unlikely
+        if is_binary_stl(fileob):
+            try:
+                return BinaryStlModel(fileob, max_vertices)
+            except ThreeDeeParseError:
+                pass
         try:
-            # HACK Ascii formatted stls are similar enough to obj
-            # files that we can just use the same parser for both.
-            # Isn't that something?
-            return ObjModel(fileob)
+            return AsciiStlModel(fileob, max_vertices)
         except ThreeDeeParseError:
             pass
-        except ValueError:
-            pass
-        except IndexError:
-            pass
         try:
             # It is pretty important that the binary stl model loader
-            # is tried second, because its possible for it to parse
+            # is tried last, because its possible for it to parse
             # total garbage from plaintext =)
-            return BinaryStlModel(fileob)
+            return BinaryStlModel(fileob, max_vertices)
         except ThreeDeeParseError:
             pass
-        except MemoryError:
-            pass
 
     raise ThreeDeeParseError("Could not successfully parse the model :(")
@@ -28,7 +28,7 @@ from mediagoblin.processing import (
     get_process_filename, store_public,
     copy_original)
 
-from mediagoblin.media_types.stl import model_loader
+from mediagoblin.media_types.stl import model_loader, renderer
 
 
 _log = logging.getLogger(__name__)
@@ -65,7 +65,8 @@ def sniff_handler(media_file, filename):
 
 def blender_render(config):
     """
-    Called to prerender a model.
+    Called to prerender a model with blender, if it is the configured
+    renderer.  Needs a running X display.
     """
     env = {"RENDER_SETUP" : json.dumps(config), "DISPLAY":":0"}
     subprocess.call(
@@ -92,6 +93,9 @@ class CommonStlProcessor(MediaProcessor):
         self._set_model()
         self._set_greatest()
 
+        # Shots to render, see _snap() and render_snaps()
+        self.shots = []
+
     def _set_ext(self):
         ext = self.name_builder.ext[1:]
 
@@ -105,8 +109,10 @@ class CommonStlProcessor(MediaProcessor):
         Attempt to parse the model file and divine some useful
         information about it.
         """
+        config = mgg.global_config['plugins'][MEDIA_TYPE]
         with open(self.process_filename, 'rb') as model_file:
-            self.model = model_loader.auto_detect(model_file, self.ext)
+            self.model = model_loader.auto_detect(
+                model_file, self.ext, config['max_vertices'])
 
     def _set_greatest(self):
         greatest = [self.model.width, self.model.height, self.model.depth]
@@ -118,7 +124,12 @@ class CommonStlProcessor(MediaProcessor):
             self.entry, self.process_filename,
             self.name_builder.fill('{basename}{ext}'))
 
-    def _snap(self, keyname, name, camera, size, project="ORTHO"):
+    def _snap(self, keyname, name, camera, size, project="ORTHO",
+              metadata=None):
+        """
+        Add a shot of the model, to be rendered by render_snaps() and
+        stored as keyname, with metadata as its file metadata
+        """
         filename = self.name_builder.fill(name)
         workbench_path = self.workbench.joinpath(filename)
         shot = {
@@ -133,13 +144,37 @@ class CommonStlProcessor(MediaProcessor):
             "height": size[1],
             "out_file": workbench_path,
             }
-        blender_render(shot)
+        self.shots.append((keyname, filename, shot, metadata))
+
+    def render_snaps(self):
+        """
+        Render all shots added by _snap() and store them
+        """
+        if not self.shots:
+            return
+
+        shots = [shot for keyname, filename, shot, metadata in self.shots]
+        config = mgg.global_config['plugins'][MEDIA_TYPE]
+        if config['renderer'] == 'blender':
+            for shot in shots:
+                blender_render(shot)
+        else:
+            # All views at once
+            triangles = self.model.triangles()
+            renderer.render_views(
+                triangles, shots,
+                points=self.model.verts if triangles is None else None)
 
-        # make sure the image rendered to the workbench path
-        assert os.path.exists(workbench_path)
+        for keyname, filename, shot, metadata in self.shots:
+            # make sure the image rendered to the workbench path
+            assert os.path.exists(shot['out_file'])
 
-        # copy it up!
-        store_public(self.entry, keyname, workbench_path, filename)
+            # copy it up!
+            store_public(self.entry, keyname, shot['out_file'], filename)
+            if metadata:
+                self.entry.set_file_metadata(keyname, **metadata)
+
+        self.shots = []
 
     def _skip_processing(self, keyname, **kwargs):
         file_metadata = self.entry.get_file_metadata(keyname)
@@ -170,9 +205,8 @@ class CommonStlProcessor(MediaProcessor):
             "{basename}.thumb.jpg",
             [0, self.greatest*-1.5, self.greatest],
             thumb_size,
-            project="PERSP")
-
-        self.entry.set_file_metadata('thumb', thumb_size=thumb_size)
+            project="PERSP",
+            metadata={'thumb_size': thumb_size})
 
     def generate_perspective(self, size=None):
         if not size:
@@ -187,9 +221,8 @@ class CommonStlProcessor(MediaProcessor):
             "{basename}.perspective.jpg",
             [0, self.greatest*-1.5, self.greatest],
             size,
-            project="PERSP")
-
-        self.entry.set_file_metadata('perspective', size=size)
+            project="PERSP",
+            metadata={'size': size})
 
     def generate_topview(self, size=None):
         if not size:
@@ -204,9 +237,8 @@ class CommonStlProcessor(MediaProcessor):
             "{basename}.top.jpg",
             [self.model.average[0], self.model.average[1],
              self.greatest*2],
-            size)
-
-        self.entry.set_file_metadata('top', size=size)
+            size,
+            metadata={'size': size})
 
     def generate_frontview(self, size=None):
         if not size:
@@ -221,9 +253,8 @@ class CommonStlProcessor(MediaProcessor):
             "{basename}.front.jpg",
             [self.model.average[0], self.greatest*-2,
              self.model.average[2]],
-            size)
-
-        self.entry.set_file_metadata('front', size=size)
+            size,
+            metadata={'size': size})
 
     def generate_sideview(self, size=None):
         if not size:
@@ -238,9 +269,8 @@ class CommonStlProcessor(MediaProcessor):
             "{basename}.side.jpg",
             [self.greatest*-2, self.model.average[1],
              self.model.average[2]],
-            size)
-
-        self.entry.set_file_metadata('side', size=size)
+            size,
+            metadata={'size': size})
 
     def store_dimensions(self):
         """
@@ -307,6 +337,7 @@ class InitialProcessor(CommonStlProcessor):
         self.generate_topview(size=size)
         self.generate_frontview(size=size)
         self.generate_sideview(size=size)
+        self.render_snaps()
         self.store_dimensions()
         self.copy_original()
         self.delete_queue_file()
@@ -361,6 +392,7 @@ class Resizer(CommonStlProcessor):
             self.generate_sideview(size=size)
         elif file == 'thumb':
             self.generate_thumb(thumb_size=size)
+        self.render_snaps()
 
 
 class StlProcessingManager(ProcessingManager):
@@ -0,0 +1,291 @@
+# GNU MediaGoblin -- federated, autonomous media hosting
+# Copyright (C) 2011, 2012 MediaGoblin contributors.  See AUTHORS.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+A small software renderer for the previews of 3d models
+
+Renders the triangles of a model (see model_loader.ThreeDee.triangles)
+with a z-buffer and flat shading, using the same shot descriptions as
+the blender backend (see processing.CommonStlProcessor._snap), so it
+needs neither blender nor a display.  The normals and shading terms are
+computed once for all views.
+
+Rasterizing is done with NumPy: triangles are grouped by the size of
+their (screen) bounding box, and all pixels in the bounding boxes of a
+group are tested at once.
+"""
+
+import math
+
+import numpy
+try:
+    from PIL import Image
+except ImportError:
+    import Image
+
+
+BACKGROUND = (0x30, 0x30, 0x30)
+MODEL_COLOR = (0xc8, 0xcc, 0xd0)
+AMBIENT = 0.25
+
+# Like the default blender camera
+PERSPECTIVE_FOV = math.radians(49.13)
+
+# blender_render.py turns models a bit for the perspective views
+PERSPECTIVE_ROTATION = -.3
+
+# Rendered at this many times the size, and scaled down for smoothing
+SUPERSAMPLE = 2
+
+# About how many candidate pixels to test at once
+BATCH_PIXELS = 1 << 20
+
+# Triangles with larger bounding boxes (in pixels) are drawn one by one
+LARGE_BOX = 1 << 14
+
+
+def _normalized(vectors):
+    lengths = numpy.sqrt((vectors ** 2).sum(axis=-1, keepdims=True))
+    return vectors / numpy.where(lengths == 0, 1, lengths)
+
+
+def _rotated(points, focus, angle):
+    """
+    points turned by angle around the vertical axis through focus
+    """
+    cos, sin = math.cos(angle), math.sin(angle)
+    rotation = numpy.array([[cos, -sin, 0], [sin, cos, 0], [0, 0, 1]])
+    return (points - focus).dot(rotation.T) + focus
+
+
+def _camera_axes(camera, focus):
+    """
+    The right, up and forward unit vectors of a camera looking at focus
+    """
+    forward = _normalized(numpy.asarray(focus, float) - camera)
+    # Like a blender "track to" constraint, keep z up, unless looking
+    # straight up or down
+    world_up = numpy.array([0., 0., 1.])
+    if abs(forward.dot(world_up)) > 0.999:
+        world_up = numpy.array([0., 1., 0.])
+    right = _normalized(numpy.cross(forward, world_up))
+    up = numpy.cross(right, forward)
+    return right, up, forward
+
+
+class Frame(object):
+    """
+    A z-buffer and the shade of the nearest fragment of each pixel
+    """
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.depth = numpy.empty(width * height)
+        self.depth.fill(numpy.inf)
+        self.shade = numpy.zeros(width * height)
+
+    def add(self, pixels, depths, shades):
+        """
+        Draw fragments, given by their pixel index, depth and shade
+        """
+        if not len(pixels):
+            return
+
+        # The nearest fragment of each pixel
+        order = numpy.lexsort((depths, pixels))
+        pixels, depths, shades = pixels[order], depths[order], shades[order]
+        first = numpy.ones(len(pixels), bool)
+        first[1:] = pixels[1:] != pixels[:-1]
+        pixels, depths, shades = pixels[first], depths[first], shades[first]
+
+        nearer = depths < self.depth[pixels]
+        pixels = pixels[nearer]
+        self.depth[pixels] = depths[nearer]
+        self.shade[pixels] = shades[nearer]
+
+    def image(self):
+        drawn = numpy.isfinite(self.depth)
+        rgb = numpy.empty((self.width * self.height, 3))
+        rgb[:] = BACKGROUND
+        rgb[drawn] = self.shade[drawn, numpy.newaxis] * MODEL_COLOR
+        rgb = rgb.reshape(self.height, self.width, 3)
+        return Image.fromarray(rgb.round().astype(numpy.uint8), 'RGB')
+
+
+def _draw_boxes(frame, batch, box_size, low, high, triangles):
+    """
+    Draw the triangles in batch, testing the pixels in boxes of box_size
+    from their low corners
+    """
+    corners, area, depth, shades = triangles
+    box_w, box_h = box_size
+    offset_y, offset_x = numpy.divmod(numpy.arange(box_w * box_h), box_w)
+
+    px = low[batch, 0, numpy.newaxis] + offset_x
+    py = low[batch, 1, numpy.newaxis] + offset_y
+    inside = (px <= high[batch, 0, numpy.newaxis]) & \
+        (py <= high[batch, 1, numpy.newaxis])
+
+    # Barycentric coordinates of the pixel centers
+    a = area[batch, numpy.newaxis]
+    weights = []
+    for i in range(2):
+        (ax, ay), (bx, by) = [
+            (x[batch, numpy.newaxis], y[batch, numpy.newaxis])
+            for x, y in (corners[i - 2], corners[i - 1])]
+        weights.append(((bx - ax) * (py + 0.5 - ay)
+                        - (by - ay) * (px + 0.5 - ax)) / a)
+    weights.append(1 - weights[0] - weights[1])
+    for weight in weights:
+        inside &= weight >= 0
+
+    z = sum(weight * depth[batch, i, numpy.newaxis]
+            for i, weight in enumerate(weights))
+    frame.add(
+        (py * frame.width + px)[inside], z[inside],
+        numpy.broadcast_to(
+            shades[batch, numpy.newaxis], inside.shape)[inside])
+
+
+def rasterize(frame, screen, depth, shades):
+    """
+    Draw triangles into frame
+
+    screen is an (n, 3, 2) array of the pixel coordinates of the corners,
+    depth an (n, 3) array of their depths and shades the (n,) shades.
+    """
+    low = numpy.floor(screen.min(axis=1) - 0.5).astype(int) + 1
+    high = numpy.floor(screen.max(axis=1) - 0.5).astype(int)
+    low = numpy.maximum(low, 0)
+    high = numpy.minimum(high, [frame.width - 1, frame.height - 1])
+
+    # Twice the signed area, for the barycentric coordinates
+    corners = [screen[:, i].T for i in range(3)]
+    (x0, y0), (x1, y1), (x2, y2) = corners
+    area = (x1 - x0) * (y2 - y0) - (x2 - x0) * (y1 - y0)
+    triangles = (corners, area, depth, shades)
+
+    visible = (high >= low).all(axis=1) & (abs(area) > 1e-12)
+    size = high - low + 1
+
+    # Group by bounding boxes rounded up to powers of two
+    visible = numpy.flatnonzero(visible)
+    classes = numpy.ceil(numpy.log2(size[visible])).astype(int)
+    keys = classes[:, 0] * 64 + classes[:, 1]
+    order = numpy.argsort(keys, kind='mergesort')
+    keys, visible = keys[order], visible[order]
+    bounds = numpy.flatnonzero(numpy.diff(keys)) + 1
+    for group in numpy.split(numpy.arange(len(keys)), bounds):
+        if not len(group):
+            continue
+        members = visible[group]
+        box_size = (1 << (keys[group[0]] // 64), 1 << (keys[group[0]] % 64))
+        box_area = box_size[0] * box_size[1]
+
+        if box_area > LARGE_BOX:
+            # Few, but rounding up would test up to four times the pixels
+            for member in members:
+                _draw_boxes(frame, members[member == members],
+                            size[member], low, high, triangles)
+            continue
+
+        step = max(1, BATCH_PIXELS // box_area)
+        for start in range(0, len(members), step):
+            _draw_boxes(frame, members[start:start + step], box_size,
+                        low, high, triangles)
+
+
+def render_view(triangles, normals, shot, points=None):
+    """
+    Render a shot (see processing.CommonStlProcessor._snap) of the
+    triangles, an (n, 3, 3) array with their (n, 3) unit normals.  If
+    there are no triangles, the (n, 3) array of points is drawn instead.
+
+    Returns a PIL image.
+    """
+    width = shot['width'] * SUPERSAMPLE
+    height = shot['height'] * SUPERSAMPLE
+    focus = numpy.asarray(shot['camera_focus'], float)
+    camera = numpy.asarray(shot['camera_coord'], float)
+    perspective = shot['projection'] == 'PERSP'
+
+    if perspective:
+        if triangles is not None:
+            triangles = _rotated(triangles, focus, PERSPECTIVE_ROTATION)
+            normals = _rotated(normals, 0, PERSPECTIVE_ROTATION)
+        else:
+            points = _rotated(points, focus, PERSPECTIVE_ROTATION)
+
+    right, up, forward = _camera_axes(camera, focus)
+    axes = numpy.array([right, up, forward]).T
+
+    frame = Frame(width, height)
+    corners = (triangles if triangles is not None else points) - camera
+    view = corners.dot(axes)
+    x, y, z = view[..., 0], view[..., 1], view[..., 2]
+
+    if perspective:
+        scale = max(width, height) / (2 * math.tan(PERSPECTIVE_FOV / 2))
+        # Nothing behind (or right next to) the camera
+        near = shot['greatest'] * 1e-3
+        safe_z = numpy.maximum(z, near)
+        sx = width / 2. + scale * x / safe_z
+        sy = height / 2. - scale * y / safe_z
+        in_front = z > near
+    else:
+        # Like blender's ortho_scale, what the wider side shows
+        scale = max(width, height) / (shot['greatest'] * 1.5)
+        sx = width / 2. + scale * x
+        sy = height / 2. - scale * y
+        in_front = z > 0
+
+    if triangles is None:
+        inside = in_front & (sx >= 0) & (sx < width) & \
+            (sy >= 0) & (sy < height)
+        frame.add(
+            (sy[inside].astype(int) * width + sx[inside].astype(int)),
+            z[inside], numpy.ones(inside.sum()))
+    else:
+        # Two sided lighting from the camera, a bit from the top left
+        light = _normalized(-forward + 0.5 * up - 0.3 * right)
+        shades = AMBIENT + (1 - AMBIENT) * abs(normals.dot(light))
+
+        keep = in_front.all(axis=1)
+        rasterize(frame, numpy.dstack([sx, sy])[keep], z[keep],
+                  shades[keep])
+
+    image = frame.image()
+    if SUPERSAMPLE > 1:
+        image = image.resize((shot['width'], shot['height']), Image.ANTIALIAS)
+    return image
+
+
+def render_views(triangles, shots, points=None):
+    """
+    Render all shots of triangles (or points, if triangles is None) and
+    save them to their out_file
+    """
+    normals = None
+    if triangles is not None:
+        triangles = triangles.astype(numpy.float64)
+        normals = _normalized(numpy.cross(
+            triangles[:, 1] - triangles[:, 0],
+            triangles[:, 2] - triangles[:, 0]))
+
+    for shot in shots:
+        image = render_view(triangles, normals, shot, points)
+        image.save(shot['out_file'], 'JPEG', quality=90)
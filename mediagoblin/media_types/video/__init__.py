@@ -17,6 +17,7 @@
 from mediagoblin.media_types import MediaManagerBase
 from mediagoblin.media_types.video.processing import VideoProcessingManager, \
     sniff_handler
+from mediagoblin.media_types.video.util import RENDITION_KEY_RE
 
 
 MEDIA_TYPE = 'mediagoblin.media_types.video'
@@ -33,6 +34,24 @@ class VideoMediaManager(MediaManagerBase):
     media_fetch_order = [u'webm_video', u'original']
     default_webm_type = 'video/webm; codecs="vp8, vorbis"'
 
+    def get_renditions(self):
+        """
+        The smaller renditions of the video, as a list of
+        (width, height, media file path), smallest first.
+
+        Offered before the display media, so the player can pick the
+        smallest rendition that still fits the screen.
+        """
+        renditions = []
+        for key, filepath in self.entry.media_files.items():
+            if RENDITION_KEY_RE.match(key):
+                file_metadata = self.entry.get_file_metadata(key) or {}
+                if 'width' in file_metadata:
+                    renditions.append((file_metadata['width'],
+                                       file_metadata['height'], filepath))
+
+        return sorted(renditions)
+
 
 def get_media_type_and_manager(ext):
     if ext in ACCEPTED_EXTENSIONS:
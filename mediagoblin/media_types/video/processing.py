@@ -26,9 +26,11 @@ from mediagoblin.processing import (
     ProcessingManager, request_from_args,
     get_process_filename, store_public,
     copy_original)
+from mediagoblin.processing.cache import (
+    derivative_cache_key, get_cached_derivative, cache_derivative)
 from mediagoblin.tools.translate import lazy_pass_to_ugettext as _
 
-from . import transcoders
+from . import segments, transcoders, util
 from .util import skip_transcode
 
 _log = logging.getLogger(__name__)
@@ -183,6 +185,10 @@ class CommonVideoProcessor(MediaProcessor):
         elif keyname == 'thumb':
             if kwargs.get('thumb_size') != file_metadata.get('thumb_size'):
                 skip = False
+        elif util.RENDITION_KEY_RE.match(keyname):
+            for key in ('size', 'vp8_quality', 'vorbis_quality'):
+                if kwargs.get(key) != file_metadata.get(key):
+                    skip = False
 
         return skip
 
@@ -209,19 +215,60 @@ class CommonVideoProcessor(MediaProcessor):
                          'vp8_quality': vp8_quality,
                          'vorbis_quality': vorbis_quality}
 
-        if self._skip_processing('webm_video', **file_metadata):
+        skip_medium = self._skip_processing('webm_video', **file_metadata)
+        rendition_sizes = util.rendition_sizes(self.video_config['renditions'])
+
+        # Renditions bigger than the video are never made, so they can't
+        # be skipped either.  Leave them out already if the video has been
+        # looked at before.
+        known_metadata = self.entry.media_data and \
+            self.entry.media_data.orig_metadata or {}
+        if 'videowidth' in known_metadata and \
+                'videoheight' in known_metadata:
+            rendition_sizes = [
+                size for size in rendition_sizes
+                if util.rendition_fits(known_metadata, size)]
+
+        rendition_sizes = [
+            size for size in rendition_sizes
+            if not self._skip_processing(
+                util.rendition_key(size), size=list(size),
+                vp8_quality=vp8_quality, vorbis_quality=vorbis_quality)]
+
+        if skip_medium and not rendition_sizes:
             return
 
         # Extract metadata and keep a record of it
         metadata = self.transcoder.discover(self.process_filename)
         store_metadata(self.entry, metadata)
 
+        # Everything store_transcoded() needs to know, also when the
+        # transcoding is done in segments by other tasks
+        job = {'metadata': dict(
+                   (key, metadata[key])
+                   for key in ('videowidth', 'videoheight')),
+               'file_metadata': file_metadata,
+               'vp8_quality': vp8_quality,
+               'vp8_threads': vp8_threads,
+               'vorbis_quality': vorbis_quality,
+               'medium': None,
+               'renditions': [],
+               # What has to be transcoded in this pass, as
+               # (media_files key, dimensions), the medium video first
+               'outputs': []}
+        files = {}
+
         # Figure out whether or not we need to transcode this video or
         # if we can skip it
-        if skip_transcode(metadata, medium_size):
+        if skip_medium:
+            pass
+        elif skip_transcode(metadata, medium_size):
             _log.debug('Skipping transcoding')
 
-            dst_dimensions = metadata['videowidth'], metadata['videoheight']
+            # Save the width and height of the original video
+            self.entry.media_data_init(
+                width=metadata['videowidth'],
+                height=metadata['videoheight'])
 
             # If there is an original and transcoded, delete the transcoded
             # since it must be of lower quality then the original
@@ -230,32 +277,140 @@ class CommonVideoProcessor(MediaProcessor):
                 self.entry.media_files['webm_video'].delete()
 
         else:
-            self.transcoder.transcode(self.process_filename, tmp_dst,
+            # vp8_threads doesn't change the result, so leave it out
+            job['medium'] = {'cache_key': derivative_cache_key(
+                self.process_filename, MEDIA_TYPE + ':webm_video',
+                medium_size=medium_size, vp8_quality=vp8_quality,
+                vorbis_quality=vorbis_quality)}
+            cached = get_cached_derivative(job['medium']['cache_key'], tmp_dst)
+
+            if cached is not None:
+                job['medium']['dimensions'] = cached['width'], cached['height']
+                files['webm_video'] = tmp_dst
+            else:
+                job['outputs'].append((u'webm_video', tuple(medium_size)))
+
+            self.did_transcode = True
+
+        for key, size in self._setup_renditions(metadata, rendition_sizes):
+            job['renditions'].append((key, size))
+
+            rendition_tmp = self._rendition_filename(key)
+            if get_cached_derivative(
+                    self._rendition_cache_key(size, job), rendition_tmp):
+                files[key] = rendition_tmp
+            else:
+                job['outputs'].append((key, size))
+
+        boundaries = segments.segment_boundaries(
+            metadata.get('videolength') or 0,
+            self.video_config['segment_length'])
+        if job['outputs'] and self.video_config['segment_length'] and \
+                len(boundaries) > 1:
+            # Long video, let all workers transcode a segment and store it
+            # all when they're done
+            job['segment_count'] = len(boundaries)
+            self.deferred = segments.transcode_in_segments(
+                self.entry, boundaries, job)
+            return
+
+        if job['outputs']:
+            outputs = [
+                (key, size, tmp_dst if key == u'webm_video'
+                 else self._rendition_filename(key))
+                for key, size in job['outputs']]
+
+            # Decode once, for the medium sized video and all renditions
+            self.transcoder.transcode(self.process_filename, outputs[0][2],
                                       vp8_quality=vp8_quality,
                                       vp8_threads=vp8_threads,
                                       vorbis_quality=vorbis_quality,
                                       progress_callback=progress_callback,
-                                      dimensions=tuple(medium_size))
+                                      dimensions=outputs[0][1],
+                                      renditions=[
+                                          (size, path)
+                                          for key, size, path in outputs[1:]])
+
+            for key, size, path in outputs:
+                files[key] = path
+
+            if outputs[0][0] == u'webm_video':
+                job['medium']['dimensions'] = (
+                    self.transcoder.dst_data.videowidth,
+                    self.transcoder.dst_data.videoheight)
+
+        self.store_transcoded(job, files)
+
+    def store_transcoded(self, job, files):
+        """
+        Store what transcode() set out to make, files being the local
+        files per media_files key.
+        """
+        transcoded = [key for key, size in job['outputs']]
+
+        if job['medium'] is not None:
+            dimensions = job['medium'].get('dimensions')
+            if dimensions is None:
+                # Joined from segments, see the segments module
+                dst_data = self.transcoder.discover(files['webm_video'])
+                dimensions = dst_data['videowidth'], dst_data['videoheight']
 
-            dst_dimensions = self.transcoder.dst_data.videowidth,\
-                self.transcoder.dst_data.videoheight
+            if u'webm_video' in transcoded:
+                cache_derivative(
+                    job['medium']['cache_key'], files['webm_video'], {
+                        'width': dimensions[0],
+                        'height': dimensions[1]})
 
             self._keep_best()
 
             # Push transcoded video to public storage
             _log.debug('Saving medium...')
-            store_public(self.entry, 'webm_video', tmp_dst,
+            store_public(self.entry, 'webm_video', files['webm_video'],
                          self.name_builder.fill('{basename}.medium.webm'))
             _log.debug('Saved medium')
 
-            self.entry.set_file_metadata('webm_video', **file_metadata)
-
-            self.did_transcode = True
-
-        # Save the width and height of the transcoded video
-        self.entry.media_data_init(
-            width=dst_dimensions[0],
-            height=dst_dimensions[1])
+            self.entry.set_file_metadata('webm_video', **job['file_metadata'])
+
+            # Save the width and height of the transcoded video
+            self.entry.media_data_init(
+                width=dimensions[0],
+                height=dimensions[1])
+
+        for key, size in job['renditions']:
+            if key in transcoded:
+                cache_derivative(
+                    self._rendition_cache_key(size, job), files[key])
+
+            _log.debug('Saving {0}...'.format(key))
+            store_public(self.entry, key, files[key],
+                         self.name_builder.fill(
+                             '{basename}.%s.webm' % key))
+
+            width, height = util.rendition_dimensions(job['metadata'], size)
+            self.entry.set_file_metadata(
+                key, size=list(size), width=width, height=height,
+                vp8_quality=job['vp8_quality'],
+                vorbis_quality=job['vorbis_quality'])
+
+    def _rendition_filename(self, key):
+        return os.path.join(
+            self.workbench.dir,
+            self.name_builder.fill('{basename}.%s.webm' % key))
+
+    def _rendition_cache_key(self, size, job):
+        return derivative_cache_key(
+            self.process_filename, MEDIA_TYPE + ':rendition',
+            size=tuple(size), vp8_quality=job['vp8_quality'],
+            vorbis_quality=job['vorbis_quality'])
+
+    def _setup_renditions(self, metadata, sizes):
+        """
+        The renditions to make, as (key, size).  No point in making
+        renditions that aren't smaller than the video.
+        """
+        return [
+            (util.rendition_key(size), size) for size in sizes
+            if util.rendition_fits(metadata, size)]
 
     def generate_thumb(self, thumb_size=None):
         # Temporary file for the video thumbnail (cleaned up with workbench)
@@ -269,16 +424,29 @@ class CommonVideoProcessor(MediaProcessor):
         if self._skip_processing('thumb', thumb_size=thumb_size):
             return
 
-        # We will only use the width so that the correct scale is kept
-        transcoders.VideoThumbnailerMarkII(
-            self.process_filename,
-            tmp_thumb,
-            thumb_size[0])
-
-        # Checking if the thumbnail was correctly created.  If it was not,
-        # then just give up.
-        if not os.path.exists (tmp_thumb):
-            return
+        cache_key = derivative_cache_key(
+            self.process_filename, MEDIA_TYPE + ':thumb',
+            thumb_size=thumb_size)
+        if get_cached_derivative(cache_key, tmp_thumb) is None:
+            # We will only use the width so that the correct scale is kept
+            thumbnailer = transcoders.KeyframeThumbnailer(
+                self.process_filename,
+                tmp_thumb,
+                thumb_size[0])
+
+            if not thumbnailer.saved:
+                _log.info('Keyframe thumbnailer failed, retrying the slow '
+                          'way...')
+                transcoders.VideoThumbnailerMarkII(
+                    self.process_filename,
+                    tmp_thumb,
+                    thumb_size[0])
+
+            # Checking if the thumbnail was correctly created.  If it was
+            # not, then just give up.
+            if not os.path.exists (tmp_thumb):
+                return
+            cache_derivative(cache_key, tmp_thumb)
 
         # Push the thumbnail to public storage
         _log.debug('Saving thumbnail...')
@@ -351,7 +519,10 @@ class InitialProcessor(CommonVideoProcessor):
 
         self.copy_original()
         self.generate_thumb(thumb_size=thumb_size)
-        self.delete_queue_file()
+
+        # Transcoding in segments needs the queued file until it's done
+        if self.deferred is None:
+            self.delete_queue_file()
 
 
 class Resizer(CommonVideoProcessor):
@@ -0,0 +1,236 @@
+# GNU MediaGoblin -- federated, autonomous media hosting
+# Copyright (C) 2011, 2012 MediaGoblin contributors.  See AUTHORS.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Transcoding long videos in segments, in parallel on all celery workers
+
+ 1. The length of the video is known from discover(), the video is cut
+    into segments of segment_length seconds.
+ 2. Each segment is transcoded by a transcode_segment task, into every
+    output (the medium video and the renditions), and stored in the
+    queue store, which all workers share.
+ 3. The segment tasks run as the header of a celery chord, whose
+    callback, merge_segments, concatenates the segments of each output
+    without transcoding them again.
+ 4. merge_segments stores the outputs like a normal transcode and
+    finishes the processing of the media entry.
+"""
+
+import logging
+import os
+import subprocess
+
+import celery
+import six
+
+from mediagoblin import mg_globals as mgg
+from mediagoblin.processing import (
+    ProgressCallback, get_entry_and_processing_manager, get_process_filename,
+    mark_entry_failed)
+from mediagoblin.processing.task import finish_processing
+from mediagoblin.media_types.video import transcoders
+from mediagoblin.tools.processing import json_processing_callback
+
+_log = logging.getLogger(__name__)
+
+# Used to join the transcoded segments, without transcoding them again
+FFMPEG_COMMAND = 'ffmpeg'
+
+
+def segment_boundaries(videolength, segment_length):
+    """
+    Cut a video of videolength nanoseconds (as discovered) into segments
+    of segment_length seconds, as a list of (start, stop) in nanoseconds.
+    The last segment runs to the end, its stop is None.
+
+    A short tail is added to the last segment instead of being a segment
+    of its own.
+    """
+    step = segment_length * 1000000000
+    boundaries = []
+    start = 0
+    while videolength - start >= 2 * step:
+        boundaries.append((start, start + step))
+        start += step
+
+    boundaries.append((start, None))
+    return boundaries
+
+
+def segment_filepath(media_id, key, index):
+    return ['media_entries', u'segments', six.text_type(media_id),
+            u'{0}-{1:04d}.webm'.format(key, index)]
+
+
+def transcode_in_segments(entry, boundaries, job):
+    """
+    Returns a function, which given the feed url of the entry sends off
+    the chord transcoding the segments of entry and merging them.
+
+    job is what the processor needs to store the outputs afterwards, see
+    CommonVideoProcessor.store_transcoded().  job['outputs'] is a list of
+    (media_files key, (width, height)) to transcode to.
+    """
+    def dispatch(feed_url):
+        header = [
+            transcode_segment.s(entry.id, index, start, stop, job)
+            for index, (start, stop) in enumerate(boundaries)]
+        callback = merge_segments.s(entry.id, job, feed_url)
+        callback.link_error(segmented_transcode_failed.s(entry.id))
+
+        _log.info('Transcoding {0} in {1} segments'.format(
+            entry, len(boundaries)))
+        return celery.chord(header)(callback)
+
+    return dispatch
+
+
+def _segment_progress(entry, key, count):
+    """
+    How many percent of the segments are done, as far as this worker can
+    tell from the queue store
+    """
+    done = len([
+        index for index in range(count)
+        if mgg.queue_store.file_exists(segment_filepath(entry.id, key, index))])
+    return done * 100 // count
+
+
+@celery.task()
+def transcode_segment(media_id, index, start, stop, job):
+    """
+    Transcode the part of the video between start and stop (nanoseconds)
+    into all outputs, and keep the results in the queue store.
+
+    Returns the queue store filepaths of the segments per output key.
+    """
+    entry, manager = get_entry_and_processing_manager(media_id)
+    workbench = mgg.workbench_manager.create()
+    try:
+        source = get_process_filename(
+            entry, workbench, ['original', 'best_quality', 'webm_video'])
+
+        outputs = [
+            (key, tuple(size),
+             os.path.join(workbench.dir, u'{0}.webm'.format(key)))
+            for key, size in job['outputs']]
+
+        transcoder = transcoders.VideoTranscoder()
+        transcoder.transcode(source, outputs[0][2],
+                             vp8_quality=job['vp8_quality'],
+                             vp8_threads=job['vp8_threads'],
+                             vorbis_quality=job['vorbis_quality'],
+                             dimensions=outputs[0][1],
+                             renditions=[(size, path)
+                                         for key, size, path in outputs[1:]],
+                             segment=(start, stop))
+
+        filepaths = {}
+        for key, size, path in outputs:
+            filepath = segment_filepath(media_id, key, index)
+            mgg.queue_store.copy_local_to_storage(path, filepath)
+            filepaths[key] = filepath
+    finally:
+        workbench.destroy()
+
+    ProgressCallback(entry)(
+        _segment_progress(entry, outputs[0][0], job['segment_count']))
+    mgg.database.reset_after_request()
+
+    return filepaths
+
+
+def concat_webm(segments, dst, workbench):
+    """
+    Join the WebM files in segments into dst by remuxing them
+    """
+    list_filename = os.path.join(workbench.dir, 'segments.txt')
+    with open(list_filename, 'w') as list_file:
+        for segment in segments:
+            list_file.write("file '{0}'\n".format(
+                segment.replace("'", "'\\''")))
+
+    try:
+        subprocess.check_call([
+            FFMPEG_COMMAND, '-loglevel', 'error', '-y',
+            '-f', 'concat', '-safe', '0', '-i', list_filename,
+            '-c', 'copy', dst])
+    except (OSError, subprocess.CalledProcessError) as exc:
+        from mediagoblin.media_types.video.processing import \
+            VideoTranscodingFail
+        _log.error('Could not join the segments into {0}: {1}'.format(
+            dst, exc))
+        raise VideoTranscodingFail()
+
+
+@celery.task()
+def merge_segments(segment_filepaths, media_id, job, feed_url):
+    """
+    The callback of the chord: join the segments of each output, store
+    the outputs and finish processing the media entry.
+
+    segment_filepaths are the results of the transcode_segment tasks, in
+    the order of the segments.
+    """
+    entry, manager = get_entry_and_processing_manager(media_id)
+    processor_class = manager.get_processor(u'transcode')
+
+    try:
+        with processor_class(manager, entry) as processor:
+            processor.common_setup()
+
+            files = {}
+            for key, size in job['outputs']:
+                segments = [
+                    processor.workbench.localized_file(
+                        mgg.queue_store, filepaths[key],
+                        u'{0}-{1:04d}'.format(key, index))
+                    for index, filepaths in enumerate(segment_filepaths)]
+                files[key] = os.path.join(
+                    processor.workbench.dir, u'{0}.webm'.format(key))
+                concat_webm(segments, files[key], processor.workbench)
+
+            processor.store_transcoded(job, files)
+            processor.delete_queue_file()
+
+        for filepaths in segment_filepaths:
+            for filepath in filepaths.values():
+                mgg.queue_store.delete_file(filepath)
+        mgg.queue_store.delete_dir(segment_filepath(media_id, u'', 0)[:-1])
+
+        finish_processing(entry, feed_url)
+    except Exception as exc:
+        _log.error('Merging the segments of {0} failed: {1}'.format(
+            entry, exc))
+        mark_entry_failed(entry.id, exc)
+        json_processing_callback(entry)
+        raise
+    finally:
+        mgg.database.reset_after_request()
+
+
+@celery.task()
+def segmented_transcode_failed(task_id, media_id):
+    """
+    Errback of the chord, when a segment couldn't be transcoded
+    """
+    _log.error('Transcoding a segment of media {0} failed (task {1})'.format(
+        media_id, task_id))
+    mark_entry_failed(media_id, None)
+
+    entry = mgg.database.MediaEntry.query.filter_by(id=media_id).first()
+    json_processing_callback(entry)
+    mgg.database.reset_after_request()
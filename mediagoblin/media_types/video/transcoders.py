@@ -18,6 +18,8 @@ from __future__ import division
 
 import os
 import sys
+import math
+import time
 import logging
 import urllib
 import multiprocessing
@@ -39,6 +41,8 @@ except ImportError:
 
 from gst.extend import discoverer
 
+from mediagoblin.media_types import gstengine
+
 _log = logging.getLogger(__name__)
 
 gobject.threads_init()
@@ -94,6 +98,8 @@ class VideoThumbnailerMarkII(object):
 
         self.errors = []
 
+        self.scaling_failed = False
+
         self.source_path = os.path.abspath(source_path)
         self.dest_path = os.path.abspath(dest_path)
 
@@ -102,7 +108,8 @@ class VideoThumbnailerMarkII(object):
         self.position_callback = position_callback \
                 or self.wadsworth_position_callback
 
-        self.mainloop = gobject.MainLoop()
+        # The main loop of the worker, see gstengine
+        self.mainloop = gstengine.get_engine().loop()
 
         self.playbin = gst.element_factory_make('playbin')
 
@@ -135,6 +142,20 @@ class VideoThumbnailerMarkII(object):
             self.disconnect()
             raise
 
+        if self.scaling_failed:
+            # Manually scale the destination dimensions.  Not done in
+            # on_thumbnail_error, which runs in the main loop thread.
+            _log.info('Retrying with manually set sizes...')
+
+            info = VideoTranscoder().discover(self.source_path)
+
+            h = info['videoheight']
+            w = info['videowidth']
+            ratio = 180 / int(w)
+            h = int(h * ratio)
+
+            self.__init__(self.source_path, self.dest_path, 180, h)
+
     def wadsworth_position_callback(self, duration, gst):
         return self.duration / 100 * 30
 
@@ -309,7 +330,6 @@ pending: {2}'.format(
         return False
 
     def on_thumbnail_error(self, message):
-        scaling_failed = False
 
         if 'Error calculating the output scaled size - integer overflow' \
            in message.parse_error()[1]:
@@ -317,28 +337,15 @@ pending: {2}'.format(
             # given only one of the destination dimensions and the source
             # dimensions. This is a workaround in case videoscale returns an
             # error that indicates this has happened.
-            scaling_failed = True
+            self.scaling_failed = True
             _log.error('Thumbnailing failed because of videoscale integer'
                        ' overflow. Will retry with fallback.')
         else:
             _log.error('Thumbnailing failed: {0}'.format(message.parse_error()))
 
-        # Kill the current mainloop
+        # Kill the current mainloop, __init__ retries if scaling failed
         self.disconnect()
 
-        if scaling_failed:
-            # Manually scale the destination dimensions
-            _log.info('Retrying with manually set sizes...')
-
-            info = VideoTranscoder().discover(self.source_path)
-
-            h = info['videoheight']
-            w = info['videowidth']
-            ratio = 180 / int(w)
-            h = int(h * ratio)
-
-            self.__init__(self.source_path, self.dest_path, 180, h)
-
     def disconnect(self):
         self.state = self.STATE_HALTING
 
@@ -362,6 +369,7 @@ pending: {2}'.format(
 
         if self.playbin_message_bus is not None:
             self.playbin_message_bus.disconnect(self.playbin_bus_watch_id)
+            self.playbin_message_bus.remove_signal_watch()
             self.playbin_message_bus = None
 
         self.halt()
@@ -387,6 +395,128 @@ pending: {2}'.format(
             return self.get_duration(pipeline, attempt + 1)
 
 
+class KeyframeThumbnailer(object):
+    '''
+    Creates a thumbnail from a video file, quickly.
+
+    Instead of prerolling a playbin to get the duration and then setting
+    up a second pipeline with buffer probes like VideoThumbnailerMarkII,
+    a single pipeline is prerolled and then seeked with key unit seeks
+    to a few candidate positions, so only the keyframe nearest to each
+    of them is decoded.  The frame with the most varied histogram is
+    saved, which skips black and other flat frames.
+
+    All waiting is synchronous and bounded by timeout seconds in total.
+    If no frame could be grabbed in time, nothing is saved and
+    self.saved is False.
+    '''
+    # Candidate positions, as fractions of the duration, best first
+    positions = (0.3, 0.15, 0.5, 0.7)
+
+    def __init__(self, source_path, dest_path, width=None, height=None,
+                 timeout=10, positions=None):
+        self.source_path = os.path.abspath(source_path)
+        self.dest_path = os.path.abspath(dest_path)
+        self.width = width
+        self.height = height
+        self.deadline = time.time() + timeout
+        if positions is not None:
+            self.positions = positions
+        self.saved = False
+
+        # The source is set per use, so the engine can reuse the pipeline
+        pipeline = ''.join([
+            'filesrc name=src ! decodebin2 name=decoder ',
+            'ffmpegcolorspace name=decoded ! videoscale ! ',
+            'video/x-raw-rgb,depth=24,bpp=24,pixel-aspect-ratio=1/1',
+            ',width={0}'.format(self.width) if self.width else '',
+            ',height={0}'.format(self.height) if self.height else '',
+            ' ! ',
+            'appsink name=sink sync=false max-buffers=1 drop=true'])
+
+        _log.debug('keyframe thumbnail pipeline: {0}'.format(pipeline))
+
+        with gstengine.get_engine().pipeline(
+                pipeline, name='keyframe thumbnail',
+                **{'src.location': self.source_path}) as self.pipeline:
+            self.sink = self.pipeline.get_by_name('sink')
+            self.run()
+
+    def _wait(self):
+        '''
+        Wait for the pipeline to preroll, at most until the deadline
+        '''
+        remaining = self.deadline - time.time()
+        if remaining <= 0:
+            return False
+
+        result = self.pipeline.get_state(int(remaining * gst.SECOND))[0]
+        return result == gst.STATE_CHANGE_SUCCESS
+
+    def run(self):
+        self.pipeline.set_state(gst.STATE_PAUSED)
+        if not self._wait():
+            _log.error('Could not preroll {0} for a thumbnail'.format(
+                self.source_path))
+            return
+
+        try:
+            duration = self.pipeline.query_duration(gst.FORMAT_TIME)[0]
+        except gst.QueryError:
+            duration = 0
+
+        best_score, best_image = None, None
+        for position in self.positions:
+            if duration:
+                self.pipeline.seek_simple(
+                    gst.FORMAT_TIME,
+                    gst.SEEK_FLAG_FLUSH | gst.SEEK_FLAG_KEY_UNIT,
+                    int(duration * position))
+                if not self._wait():
+                    _log.warn('Thumbnail deadline reached at position '
+                              '{0}'.format(position))
+                    break
+
+            image = self.buffer_to_image(self.sink.emit('pull-preroll'))
+            if image is not None:
+                score = histogram_score(image)
+                if best_score is None or score > best_score:
+                    best_score, best_image = score, image
+
+            # Without a duration there's nowhere to seek to
+            if not duration:
+                break
+
+        if best_image is not None:
+            best_image.save(self.dest_path)
+            self.saved = True
+            _log.info('Saved thumbnail (score {0:.2f})'.format(best_score))
+
+    def buffer_to_image(self, buff):
+        if buff is None or buff.caps is None:
+            return None
+
+        width = buff.caps[0]['width']
+        height = buff.caps[0]['height']
+        # Rows of RGB video are padded to a multiple of four bytes
+        stride = (width * 3 + 3) & ~3
+
+        return Image.frombuffer(
+            'RGB', (width, height), buff.data, 'raw', 'RGB', stride, 1)
+
+
+def histogram_score(image):
+    '''
+    How interesting image is: the entropy (in bits) of its luminance
+    histogram.  Black, white and other flat frames score near 0.
+    '''
+    histogram = image.convert('L').histogram()
+    total = float(sum(histogram))
+
+    return -sum(count / total * math.log(count / total, 2)
+                for count in histogram if count)
+
+
 class VideoTranscoder(object):
     '''
     Video transcoder
@@ -402,7 +532,10 @@ class VideoTranscoder(object):
     def __init__(self):
         _log.info('Initializing VideoTranscoder...')
         self.progress_percentage = None
-        self.loop = gobject.MainLoop()
+        # The main loop of the worker, see gstengine.  The pipeline is
+        # built for each transcode, it depends on too much of the source.
+        self.engine = gstengine.get_engine()
+        self.loop = self.engine.loop()
 
     def transcode(self, src, dst, **kwargs):
         '''
@@ -430,13 +563,27 @@ class VideoTranscoder(object):
         # vorbisenc options
         self.vorbis_quality = kwargs.get('vorbis_quality', 0.3)
 
+        # Other sizes to transcode to in the same pass, as a list of
+        # ((width, height), dst)
+        self.renditions = kwargs.get('renditions') or []
+        self.rendition_elements = []
+
+        # Only transcode the part between these positions (in ns, stop may
+        # be None for the end of the video), see the segments module
+        self.segment = kwargs.get('segment')
+        self._segment_seeked = False
+
         self._progress_callback = kwargs.get('progress_callback') or None
 
         if not type(self.destination_dimensions) == tuple:
             raise Exception('dimensions must be tuple: (width, height)')
 
+        started = time.time()
         self._setup()
+        prepared = time.time()
         self._run()
+        self.engine.record(
+            'video transcode', prepared - started, time.time() - prepared)
 
     # XXX: This could be a static method.
     def discover(self, src):
@@ -446,11 +593,13 @@ class VideoTranscoder(object):
         _log.info('Discovering {0}'.format(src))
 
         self.source_path = src
+        started = time.time()
         self._setup_discover(discovered_callback=self.__on_discovered)
 
         self.discoverer.discover()
 
         self.loop.run()
+        self.engine.record('video discover', 0, time.time() - started)
 
         if hasattr(self, '_discovered_data'):
             return self._discovered_data.__dict__
@@ -504,9 +653,13 @@ class VideoTranscoder(object):
         self._link_elements()
         self.__setup_videoscale_capsfilter()
 
-        # Tell the transcoding pipeline to start running
-        self.pipeline.set_state(gst.STATE_PLAYING)
-        _log.info('Transcoding...')
+        if self.segment:
+            # Seek to the segment once prerolled, see _on_message
+            self.pipeline.set_state(gst.STATE_PAUSED)
+        else:
+            # Tell the transcoding pipeline to start running
+            self.pipeline.set_state(gst.STATE_PLAYING)
+            _log.info('Transcoding...')
 
     def _setup_pipeline(self):
         _log.debug('Setting up transcoding pipeline')
@@ -588,6 +741,44 @@ class VideoTranscoder(object):
         self.progressreport.set_property('silent', True)
         self.pipeline.add(self.progressreport)
 
+        if self.renditions:
+            self._setup_rendition_elements()
+
+    def _setup_rendition_elements(self):
+        '''
+        Create the tees and a scaler, encoder and muxer for each rendition
+
+        The decoded video and the encoded audio are split up with tees,
+        so the source is decoded and the audio is encoded only once.
+        '''
+        def make(factory, name):
+            element = gst.element_factory_make(factory, name)
+            self.pipeline.add(element)
+            return element
+
+        self.videotee = make('tee', 'videotee')
+        self.audiotee = make('tee', 'audiotee')
+        self.mainvideoqueue = make('queue', 'mainvideoqueue')
+        self.mainaudioqueue = make('queue', 'mainaudioqueue')
+
+        for i, (dimensions, path) in enumerate(self.renditions):
+            elements = {
+                'dimensions': dimensions,
+                'videoqueue': make('queue', 'videoqueue%d' % i),
+                'videoscale': make('ffvideoscale', 'videoscale%d' % i),
+                'capsfilter': make('capsfilter', 'capsfilter%d' % i),
+                'vp8enc': make('vp8enc', 'vp8enc%d' % i),
+                'audioqueue': make('queue', 'audioqueue%d' % i),
+                'webmmux': make('webmmux', 'webmmux%d' % i),
+                'filesink': make('filesink', 'filesink%d' % i)}
+
+            elements['vp8enc'].set_property('quality', self.vp8_quality)
+            elements['vp8enc'].set_property('threads', self.vp8_threads)
+            elements['vp8enc'].set_property('max-latency', 25)
+            elements['filesink'].set_property('location', path)
+
+            self.rendition_elements.append(elements)
+
     def _link_elements(self):
         '''
         Link all the elements
@@ -601,33 +792,79 @@ class VideoTranscoder(object):
         # or audio sink
         self.filesrc.link(self.decoder)
 
-        # Link all the video elements in a row to webmmux
+        if self.renditions:
+            self._link_rendition_elements()
+        else:
+            # Link all the video elements in a row to webmmux
+            gst.element_link_many(
+                self.videoqueue,
+                self.videorate,
+                self.ffmpegcolorspace,
+                self.videoscale,
+                self.capsfilter,
+                self.vp8enc,
+                self.webmmux)
+
+            if self.data.is_audio:
+                # Link all the audio elements in a row to webmux
+                gst.element_link_many(
+                    self.audioqueue,
+                    self.audiorate,
+                    self.audioconvert,
+                    self.audiocapsfilter,
+                    self.vorbisenc,
+                    self.webmmux)
+
+        gst.element_link_many(
+            self.webmmux,
+            self.progressreport,
+            self.filesink)
+
+        # Setup the message bus and connect _on_message to the pipeline
+        self._setup_bus()
+
+    def _link_rendition_elements(self):
+        '''
+        Link the decoded video and encoded audio through the tees to the
+        main and rendition muxers
+        '''
         gst.element_link_many(
             self.videoqueue,
             self.videorate,
             self.ffmpegcolorspace,
+            self.videotee,
+            self.mainvideoqueue,
             self.videoscale,
             self.capsfilter,
             self.vp8enc,
             self.webmmux)
 
         if self.data.is_audio:
-            # Link all the audio elements in a row to webmux
             gst.element_link_many(
                 self.audioqueue,
                 self.audiorate,
                 self.audioconvert,
                 self.audiocapsfilter,
                 self.vorbisenc,
+                self.audiotee,
+                self.mainaudioqueue,
                 self.webmmux)
 
-        gst.element_link_many(
-            self.webmmux,
-            self.progressreport,
-            self.filesink)
-
-        # Setup the message bus and connect _on_message to the pipeline
-        self._setup_bus()
+        for elements in self.rendition_elements:
+            gst.element_link_many(
+                self.videotee,
+                elements['videoqueue'],
+                elements['videoscale'],
+                elements['capsfilter'],
+                elements['vp8enc'],
+                elements['webmmux'],
+                elements['filesink'])
+
+            if self.data.is_audio:
+                gst.element_link_many(
+                    self.audiotee,
+                    elements['audioqueue'],
+                    elements['webmmux'])
 
     def _on_dynamic_pad(self, dbin, pad, islast):
         '''
@@ -652,21 +889,24 @@ class VideoTranscoder(object):
         '''
         Sets up the output format (width, height) for the video
         '''
+        self.capsfilter.set_property(
+            'caps', self._videoscale_caps(self.destination_dimensions))
+
+        for elements in self.rendition_elements:
+            elements['capsfilter'].set_property(
+                'caps', self._videoscale_caps(elements['dimensions']))
+
+    def _videoscale_caps(self, dimensions):
         caps = ['video/x-raw-yuv', 'pixel-aspect-ratio=1/1', 'framerate=30/1']
 
         if self.data.videoheight > self.data.videowidth:
             # Whoa! We have ourselves a portrait video!
-            caps.append('height={0}'.format(
-                    self.destination_dimensions[1]))
+            caps.append('height={0}'.format(dimensions[1]))
         else:
             # It's a landscape, phew, how normal.
-            caps.append('width={0}'.format(
-                    self.destination_dimensions[0]))
+            caps.append('width={0}'.format(dimensions[0]))
 
-        self.capsfilter.set_property(
-            'caps',
-            gst.caps_from_string(
-                ','.join(caps)))
+        return gst.caps_from_string(','.join(caps))
 
     def _on_message(self, bus, message):
         _log.debug((bus, message, message.type))
@@ -677,6 +917,10 @@ class VideoTranscoder(object):
             self._discover_dst_and_stop()
             _log.info('Done')
 
+        elif t == gst.MESSAGE_ASYNC_DONE:
+            if self.segment and not self._segment_seeked:
+                self._seek_segment()
+
         elif message.type == gst.MESSAGE_ELEMENT:
             if message.structure.get_name() == 'progress':
                 data = dict(message.structure)
@@ -694,6 +938,19 @@ class VideoTranscoder(object):
             _log.error((bus, message))
             self.__stop()
 
+    def _seek_segment(self):
+        start, stop = self.segment
+        _log.info('Transcoding segment {0}..{1}...'.format(start, stop))
+
+        self._segment_seeked = True
+        self.pipeline.seek(
+            1.0, gst.FORMAT_TIME,
+            gst.SEEK_FLAG_FLUSH | gst.SEEK_FLAG_ACCURATE,
+            gst.SEEK_TYPE_SET, start,
+            gst.SEEK_TYPE_NONE if stop is None else gst.SEEK_TYPE_SET,
+            -1 if stop is None else stop)
+        self.pipeline.set_state(gst.STATE_PLAYING)
+
     def _discover_dst_and_stop(self):
         self.dst_discoverer = discoverer.Discoverer(self.destination_path)
 
@@ -713,6 +970,11 @@ class VideoTranscoder(object):
             # Stop executing the pipeline
             self.pipeline.set_state(gst.STATE_NULL)
 
+        if getattr(self, 'bus', None) is not None:
+            # The main loop outlives the pipeline, don't leave it watching
+            self.bus.remove_signal_watch()
+            self.bus = None
+
         # This kills the loop, mercifully
         gobject.idle_add(self.__stop_mainloop)
 
@@ -15,11 +15,15 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
+import re
 
 from mediagoblin import mg_globals as mgg
 
 _log = logging.getLogger(__name__)
 
+# media_files keys of the renditions, eg. webm_360p
+RENDITION_KEY_RE = re.compile(r'^webm_(\d+)p$')
+
 
 def skip_transcode(metadata, size):
     '''
@@ -60,3 +64,56 @@ def skip_transcode(metadata, size):
             return False
 
     return True
+
+
+def rendition_sizes(renditions):
+    '''
+    Parses the renditions configuration, eg. ['640x360', '1280x720'],
+    into a list of (width, height), smallest first.
+
+    Renditions are stored by their height, so only the first of several
+    renditions with the same height is used.
+    '''
+    sizes = {}
+    for rendition in renditions:
+        try:
+            width, height = [int(i) for i in rendition.lower().split('x')]
+        except ValueError:
+            _log.warning('Invalid video rendition {0!r}, should be '
+                         'WIDTHxHEIGHT'.format(rendition))
+            continue
+        if height in sizes:
+            _log.warning('Ignoring video rendition {0!r}, there already is '
+                         'one {1} high'.format(rendition, height))
+            continue
+        sizes[height] = (width, height)
+
+    return sorted(sizes.values())
+
+
+def rendition_key(size):
+    '''
+    The media_files key of the rendition of size (width, height)
+    '''
+    return u'webm_{0}p'.format(size[1])
+
+
+def rendition_fits(metadata, size):
+    '''
+    Whether a rendition of size would be smaller than the video, there's
+    no point in making it otherwise
+    '''
+    return rendition_dimensions(metadata, size)[0] < metadata['videowidth']
+
+
+def rendition_dimensions(metadata, size):
+    '''
+    The dimensions a video will have when transcoded to fit size, which
+    just like the VideoTranscoder scales either the width or (for portrait
+    videos) the height, keeping the aspect ratio.
+    '''
+    width, height = metadata['videowidth'], metadata['videoheight']
+
+    if height > width:
+        return int(round(width * size[1] / float(height))), size[1]
+    return size[0], int(round(height * size[0] / float(width)))
@@ -37,6 +37,12 @@ queue_store = None
 # A WorkBenchManager
 workbench_manager = None
 
+# derivative cache of the processing steps (None if disabled)
+derivative_cache = None
+
+# process-wide cache of hot database lookups (None if disabled)
+lookup_cache = None
+
 # A thread-local scope
 thread_scope = threading.local()
 
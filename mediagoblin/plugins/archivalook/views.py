@@ -19,7 +19,7 @@ from mediagoblin.db.models import MediaEntry
 from mediagoblin.decorators import uses_pagination, user_not_banned,\
                                   user_has_privilege, get_user_media_entry
 from mediagoblin.tools.response import render_to_response, redirect
-from mediagoblin.tools.pagination import Pagination
+from mediagoblin.tools.pagination import KeysetPagination
 
 from mediagoblin.plugins.archivalook.tools import (
                                         split_featured_media_list,
@@ -102,7 +102,8 @@ def recent_media_gallery_view(request, page):
     cursor = MediaEntry.query.filter_by(state=u'processed').\
         order_by(MediaEntry.created.desc())
 
-    pagination = Pagination(page, cursor)
+    pagination = KeysetPagination(page, cursor,
+                                  marker=request.pagination_marker)
     media_entries = pagination()
     return render_to_response(
         request, 'archivalook/recent_media.html',
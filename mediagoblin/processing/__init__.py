@@ -129,6 +129,12 @@ class MediaProcessor(object):
         # Should be initialized at time of processing, at least
         self.workbench = None
 
+        # Set by process() to a function taking the feed url, if
+        # processing goes on in other tasks.  It's called once the
+        # workbench is gone, and the entry is only marked as processed
+        # by the tasks it started.
+        self.deferred = None
+
     def __enter__(self):
         self.workbench = mgg.workbench_manager.create()
         return self
@@ -379,6 +385,18 @@ def store_public(entry, keyname, local_file, target_name=None,
         if delete_if_exists:
             mgg.public_store.delete_file(entry.media_files[keyname])
 
+    copy_to_public_store(local_file, target_filepath, keyname)
+
+    entry.media_files[keyname] = target_filepath
+
+
+def copy_to_public_store(local_file, target_filepath, keyname):
+    """
+    Copy local_file to target_filepath in the public store.
+
+    Unlike store_public() this doesn't touch the media entry, so it can
+    run outside of the thread holding the database session.
+    """
     try:
         mgg.public_store.copy_local_to_storage(local_file, target_filepath)
     except:
@@ -388,13 +406,66 @@ def store_public(entry, keyname, local_file, target_name=None,
     if not mgg.public_store.file_exists(target_filepath):
         raise PublicStoreFail(keyname=keyname)
 
-    entry.media_files[keyname] = target_filepath
-
 
 def copy_original(entry, orig_filename, target_name, keyname=u"original"):
     store_public(entry, keyname, orig_filename, target_name)
 
 
+def reuse_duplicate_derivatives(entry):
+    """
+    Give entry the files of an already processed entry with an identical
+    original, if the public store can tell us about one.
+
+    Only storage systems which deduplicate their contents (and thus
+    provide filepaths_with_content() and link_file()) support this, and
+    only for a queued file in local storage.  Returns True if the
+    derivatives were reused, so processing can be skipped.
+    """
+    public_store = mgg.public_store
+    if not (entry.queued_media_file
+            and hasattr(public_store, 'filepaths_with_content')
+            and mgg.queue_store.local_storage):
+        return False
+
+    queued_filename = mgg.queue_store.get_local_path(entry.queued_media_file)
+    ext = os.path.splitext(entry.queued_media_file[-1])[1]
+
+    for filepath in public_store.filepaths_with_content(queued_filename, ext):
+        if len(filepath) != 3 or filepath[0] != u'media_entries' \
+                or not filepath[1].isdigit():
+            continue
+        original = MediaEntry.query.filter_by(
+            id=int(filepath[1]), media_type=entry.media_type,
+            state=u'processed').first()
+        if original is None or \
+                list(original.media_files.get(u'original', ())) != filepath:
+            continue
+
+        _log.info('Reusing the derivatives of {0} for {1}'.format(
+            original, entry))
+        for keyname, source_filepath in six.iteritems(original.media_files):
+            target_filepath = create_pub_filepath(entry, source_filepath[-1])
+            public_store.link_file(source_filepath, target_filepath)
+            entry.media_files[keyname] = target_filepath
+        entry.save()
+
+        for keyname in original.media_files:
+            file_metadata = original.get_file_metadata(keyname)
+            if file_metadata:
+                entry.set_file_metadata(keyname, **file_metadata)
+
+        if original.media_data is not None:
+            media_data = original.media_data
+            entry.media_data_init(**dict(
+                (column.name, getattr(media_data, column.name))
+                for column in media_data.__table__.columns
+                if column.name != 'media_entry'))
+
+        return True
+
+    return False
+
+
 class BaseProcessingFail(Exception):
     """
     Base exception that all other processing failure messages should
@@ -0,0 +1,176 @@
+# GNU MediaGoblin -- federated, autonomous media hosting
+# Copyright (C) 2011, 2012 MediaGoblin contributors.  See AUTHORS.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Cache of processed derivatives (thumbnails, mediums, transcodes...)
+
+Derivatives are keyed by the hash of the file they were made from, the
+name of the processing step and its parameters, so reprocessing media
+with unchanged settings copies the earlier result instead of running
+PIL or GStreamer again.
+"""
+
+import hashlib
+import io
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+from mediagoblin import mg_globals as mgg
+from mediagoblin.tools.files import SizeBoundedDirectory, file_hash
+
+_log = logging.getLogger(__name__)
+
+# Bump this to invalidate all cached derivatives, eg. when a processing
+# step starts producing different output for the same parameters
+CACHE_VERSION = 1
+
+SOURCE_HASH_CACHE_SIZE = 100
+
+
+class DerivativeCache(object):
+    """
+    Size-bounded on-disk cache of derivative files.
+
+    Every entry is a copy of the derivative plus a small .json file with
+    whatever info the processing step wants back on a hit.  When the
+    cache grows over max_size bytes, the least recently used entries are
+    evicted.
+    """
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self._source_hashes = {}
+        self._size_bound = SizeBoundedDirectory(
+            cache_dir, max_size, skip=lambda name: name.endswith('.json'))
+
+    def _source_hash(self, filename):
+        stat = os.stat(filename)
+        hash_key = (filename, stat.st_size, stat.st_mtime)
+        if hash_key not in self._source_hashes:
+            if len(self._source_hashes) >= SOURCE_HASH_CACHE_SIZE:
+                self._source_hashes.clear()
+            self._source_hashes[hash_key] = file_hash(filename)
+        return self._source_hashes[hash_key]
+
+    def make_key(self, source_filename, step, **params):
+        """
+        Key of the derivative made from source_filename by step with params
+        """
+        key_data = json.dumps(
+            [CACHE_VERSION, self._source_hash(source_filename), step, params],
+            sort_keys=True)
+        return hashlib.sha256(key_data.encode('utf-8')).hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def get(self, key, dest_filename):
+        """
+        Copy the derivative cached under key to dest_filename.
+
+        Returns the info dict stored with it, or None on a miss.
+        """
+        entry_path = self._entry_path(key)
+        try:
+            with io.open(entry_path + '.json', encoding='utf-8') as info_file:
+                info = json.load(info_file)
+            shutil.copyfile(entry_path, dest_filename)
+        except (IOError, OSError, ValueError):
+            return None
+
+        # Mark as recently used
+        try:
+            os.utime(entry_path, None)
+        except OSError:
+            pass
+        return info
+
+    def put(self, key, filename, info=None):
+        """
+        Cache a copy of the derivative filename under key
+        """
+        entry_path = self._entry_path(key)
+        entry_dir = os.path.dirname(entry_path)
+        try:
+            if not os.path.exists(entry_dir):
+                os.makedirs(entry_dir)
+
+            # Write both files under temporary names first, so nobody ever
+            # sees half of an entry
+            with tempfile.NamedTemporaryFile(
+                    dir=entry_dir, delete=False) as tmp_file:
+                with open(filename, 'rb') as derivative:
+                    shutil.copyfileobj(derivative, tmp_file)
+            with tempfile.NamedTemporaryFile(
+                    dir=entry_dir, delete=False) as tmp_info:
+                tmp_info.write(json.dumps(info or {}).encode('utf-8'))
+            os.rename(tmp_file.name, entry_path)
+            os.rename(tmp_info.name, entry_path + '.json')
+        except (IOError, OSError) as exc:
+            _log.warn('Could not cache derivative {0}: {1}'.format(
+                filename, exc))
+            return
+
+        self._remove_info(self._size_bound.added(os.path.getsize(filename)))
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits
+        max_size again
+        """
+        self._remove_info(self._size_bound.evict())
+
+    def _remove_info(self, evicted_paths):
+        for path in evicted_paths:
+            try:
+                os.remove(path + '.json')
+            except OSError:
+                pass
+
+
+def derivative_cache_key(source_filename, step, **params):
+    """
+    Key for caching what step makes of source_filename with params, or
+    None if the derivative cache is disabled or there's no source file.
+    """
+    if mgg.derivative_cache is None or not source_filename:
+        return None
+    return mgg.derivative_cache.make_key(source_filename, step, **params)
+
+
+def get_cached_derivative(key, dest_filename):
+    """
+    Copy a cached derivative to dest_filename, and return the info stored
+    along with it, or None if there was nothing cached under key.
+    """
+    if key is None:
+        return None
+
+    info = mgg.derivative_cache.get(key, dest_filename)
+    if info is not None:
+        _log.debug('Reusing cached derivative for {0}'.format(dest_filename))
+    return info
+
+
+def cache_derivative(key, filename, info=None):
+    """
+    Cache the derivative filename under key, with an optional info dict
+    """
+    if key is not None:
+        mgg.derivative_cache.put(key, filename, info)
@@ -14,6 +14,7 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import datetime
 import logging
 
 from six.moves.urllib import request, parse
@@ -22,7 +23,8 @@ import celery
 from celery.registry import tasks
 
 from mediagoblin import mg_globals as mgg
-from . import mark_entry_failed, BaseProcessingFail
+from . import (
+    mark_entry_failed, BaseProcessingFail, reuse_duplicate_derivatives)
 from mediagoblin.tools.processing import json_processing_callback
 from mediagoblin.processing import get_entry_and_processing_manager
 
@@ -62,6 +64,25 @@ def handle_push_urls(feed_url):
                 return False
 
 
+def finish_processing(entry, feed_url):
+    """
+    Mark entry as processed, and tell everyone who wants to know
+    """
+    # We set the state to processed and save the entry here so there's
+    # no need to save at the end of the processing stage, probably ;)
+    entry.state = u'processed'
+    # Reprocessing may only have replaced media files, which are
+    # not columns of the entry, so bump updated explicitly
+    entry.updated = datetime.datetime.now()
+    entry.save()
+
+    # Notify the PuSH servers as async task
+    if mgg.app_config["push_urls"] and feed_url:
+        handle_push_urls.subtask().delay(feed_url)
+
+    json_processing_callback(entry)
+
+
 ################################
 # Media processing initial steps
 ################################
@@ -95,7 +116,11 @@ class ProcessMedia(celery.Task):
                 _log.debug('Processing {0}'.format(entry))
 
                 try:
-                    processor.process(**reprocess_info)
+                    if reprocess_action == u'initial' and \
+                            reuse_duplicate_derivatives(entry):
+                        processor.delete_queue_file()
+                    else:
+                        processor.process(**reprocess_info)
                 except Exception as exc:
                     if processor.entry_orig_state == 'processed':
                         _log.error(
@@ -107,16 +132,12 @@ class ProcessMedia(celery.Task):
                     else:
                         raise
 
-            # We set the state to processed and save the entry here so there's
-            # no need to save at the end of the processing stage, probably ;)
-            entry.state = u'processed'
-            entry.save()
+            if processor.deferred is not None:
+                # Processing goes on in other tasks, which finish it
+                processor.deferred(feed_url)
+                return
 
-            # Notify the PuSH servers as async task
-            if mgg.app_config["push_urls"] and feed_url:
-                handle_push_urls.subtask().delay(feed_url)
-
-            json_processing_callback(entry)
+            finish_processing(entry, feed_url)
         except BaseProcessingFail as exc:
             mark_entry_failed(entry.id, exc)
             json_processing_callback(entry)
@@ -16,6 +16,7 @@
 
 from __future__ import absolute_import
 
+import errno
 import shutil
 import uuid
 
@@ -110,6 +111,25 @@ class StorageInterface(object):
         # Subclasses should override this method.
         self.__raise_not_implemented()
 
+    def delete_files(self, filepaths):
+        """
+        Delete the files at filepaths, with as few requests as this
+        storage allows.  Files which don't exist count as deleted.
+
+        :returns: The filepaths which could not be deleted.
+        """
+        # Subclasses may override this with something more efficient.
+        failed = []
+        for filepath in filepaths:
+            try:
+                self.delete_file(filepath)
+            except (IOError, OSError) as exc:
+                if exc.errno != errno.ENOENT:
+                    failed.append(filepath)
+            except Error:
+                failed.append(filepath)
+        return failed
+
     def delete_dir(self, dirpath, recursive=False):
         """Delete the directory at dirpath
 
@@ -202,6 +222,13 @@ class StorageInterface(object):
         # Subclasses should override this method.
         self.__raise_not_implemented()
 
+    def get_file_etag(self, filepath):
+        """
+        Return a string which changes whenever the content of the file
+        changes (like an HTTP ETag), or None if this storage can't tell.
+        """
+        return None
+
 
 ###########
 # Utilities
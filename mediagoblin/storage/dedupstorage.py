@@ -0,0 +1,306 @@
+# GNU MediaGoblin -- federated, autonomous media hosting
+# Copyright (C) 2011, 2012 MediaGoblin contributors.  See AUTHORS.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import fcntl
+import io
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+from mediagoblin.storage import NotImplementedError, clean_listy_filepath
+from mediagoblin.storage.filestorage import BasicFileStorage
+from mediagoblin.tools.files import file_hash, HASH_CHUNK_SIZE
+
+
+# Reference files start with this, followed by the name of their blob
+REF_PREFIX = b'mediagoblin-blob:'
+
+
+class DedupFileStorage(BasicFileStorage):
+    """
+    Local filesystem storage that keeps only one copy of identical files
+
+    File contents are stored once, as "blobs" named after their sha256
+    hash (plus the file extension) in blob_dir below base_dir.  Every
+    filepath stored is a small reference file naming its blob, and every
+    blob has a .refs file listing the filepaths that reference it.
+
+    Storing a file whose content is already known only adds a reference,
+    and deleting a file only deletes the blob along with its last
+    reference.  file_url() and get_local_path() point at the blob, so the
+    blob directory has to be served along with the rest of base_dir.
+
+    Plain files left over in base_dir (for example before running
+    `gmg dedupstorage`) keep working like in BasicFileStorage.
+    """
+    def __init__(self, base_dir, base_url=None, blob_dir=u'blobs',
+                 **kwargs):
+        """
+        Keyword arguments:
+        - base_dir: Base directory things will be served out of.  MUST
+          be an absolute path.
+        - base_url: URL files will be served from
+        - blob_dir: Directory below base_dir the blobs are kept in
+        """
+        super(DedupFileStorage, self).__init__(base_dir, base_url, **kwargs)
+        self.blob_dir = blob_dir
+
+    #######
+    # Blobs
+    #######
+
+    def _blob_filepath(self, blob_name):
+        return [self.blob_dir, blob_name[:2], blob_name]
+
+    def _blob_path(self, blob_name):
+        return self._resolve_filepath(self._blob_filepath(blob_name))
+
+    def _blob_name(self, filename, filepath):
+        return file_hash(filename) + os.path.splitext(filepath[-1])[1].lower()
+
+    def _read_ref(self, filepath):
+        """
+        Return the name of the blob filepath references, or None if
+        filepath is a plain file
+        """
+        path = self._resolve_filepath(filepath)
+        if not os.path.isfile(path):
+            return None
+        with open(path, 'rb') as ref_file:
+            head = ref_file.read(len(REF_PREFIX) + 128)
+        if not head.startswith(REF_PREFIX):
+            return None
+        return head[len(REF_PREFIX):].decode('ascii')
+
+    def _write_ref(self, filepath, blob_name):
+        plain_get_file = super(DedupFileStorage, self).get_file
+        with plain_get_file(filepath, 'wb') as ref_file:
+            ref_file.write(REF_PREFIX + blob_name.encode('ascii'))
+
+    @contextmanager
+    def _blob_refs(self, blob_name):
+        """
+        Lock the .refs file of blob_name and yield the set of filepaths
+        (joined with '/') referencing it, to be updated in place.
+
+        The blob is deleted once no filepath references it anymore.
+        """
+        blob_path = self._blob_path(blob_name)
+        refs_path = blob_path + u'.refs'
+        if not os.path.exists(os.path.dirname(refs_path)):
+            try:
+                os.makedirs(os.path.dirname(refs_path))
+            except OSError:
+                # Somebody else just created it
+                pass
+
+        while True:
+            refs_file = io.open(refs_path, 'a+', encoding='utf-8')
+            fcntl.flock(refs_file.fileno(), fcntl.LOCK_EX)
+            # Whoever held the lock before might have removed the file
+            if os.fstat(refs_file.fileno()).st_nlink:
+                break
+            refs_file.close()
+
+        with refs_file:
+            refs_file.seek(0)
+            refs = set(line for line in refs_file.read().splitlines() if line)
+
+            yield refs
+
+            if refs:
+                refs_file.seek(0)
+                refs_file.truncate()
+                refs_file.write(u''.join(
+                    ref + u'\n' for ref in sorted(refs)))
+            else:
+                if os.path.exists(blob_path):
+                    os.remove(blob_path)
+                os.remove(refs_path)
+
+    def _store(self, filename, filepath, move=False):
+        """
+        Store the local file filename under filepath, sharing the blob of
+        any identical file already stored.
+
+        With move=True filename is moved into the blob store (or removed,
+        if the blob exists already) instead of being copied.
+        """
+        filepath = clean_listy_filepath(filepath)
+        blob_name = self._blob_name(filename, filepath)
+        blob_path = self._blob_path(blob_name)
+
+        # Drop whatever is stored there now, unless that's what we store
+        if (self._resolve_filepath(filepath) != filename
+                and self.file_exists(filepath)):
+            self.delete_file(filepath)
+
+        with self._blob_refs(blob_name) as refs:
+            if os.path.exists(blob_path):
+                if move:
+                    os.remove(filename)
+            elif move:
+                os.rename(filename, blob_path)
+            else:
+                # Copy next to the blob first, so the blob is never seen
+                # half-written
+                with tempfile.NamedTemporaryFile(
+                        dir=os.path.dirname(blob_path), delete=False) as tmp:
+                    with open(filename, 'rb') as source_file:
+                        shutil.copyfileobj(source_file, tmp, HASH_CHUNK_SIZE)
+                os.rename(tmp.name, blob_path)
+
+            self._write_ref(filepath, blob_name)
+            refs.add(u'/'.join(filepath))
+
+        return blob_name
+
+    ##################
+    # Storage interface
+    ##################
+
+    def get_local_path(self, filepath):
+        blob_name = self._read_ref(filepath)
+        if blob_name is None:
+            return self._resolve_filepath(filepath)
+        return self._blob_path(blob_name)
+
+    def file_url(self, filepath):
+        blob_name = self._read_ref(filepath)
+        if blob_name is None:
+            return super(DedupFileStorage, self).file_url(filepath)
+        return super(DedupFileStorage, self).file_url(
+            self._blob_filepath(blob_name))
+
+    def get_file(self, filepath, mode='r'):
+        if 'r' in mode and '+' not in mode:
+            return open(self.get_local_path(filepath), mode)
+        if 'w' in mode and '+' not in mode:
+            return _BlobWriter(self, filepath, mode)
+        raise NotImplementedError(
+            "DedupFileStorage can't open files in mode %r" % mode)
+
+    def delete_file(self, filepath):
+        filepath = clean_listy_filepath(filepath)
+        blob_name = self._read_ref(filepath)
+        super(DedupFileStorage, self).delete_file(filepath)
+
+        if blob_name is not None:
+            with self._blob_refs(blob_name) as refs:
+                refs.discard(u'/'.join(filepath))
+
+    def delete_dir(self, dirpath, recursive=False):
+        if recursive:
+            # Drop the references of all files in there first
+            for dirname, dirs, files in os.walk(
+                    self._resolve_filepath(dirpath)):
+                relative = os.path.relpath(dirname, self.base_dir)
+                for name in files:
+                    self.delete_file(relative.split(os.sep) + [name])
+        return super(DedupFileStorage, self).delete_dir(dirpath, recursive)
+
+    def copy_local_to_storage(self, filename, filepath):
+        self._store(filename, filepath)
+
+    def get_file_size(self, filepath):
+        return os.stat(self.get_local_path(filepath)).st_size
+
+    ##############
+    # Dedup extras
+    ##############
+
+    def link_file(self, source_filepath, dest_filepath):
+        """
+        Make dest_filepath another reference to the content of
+        source_filepath, without copying any data.
+        """
+        blob_name = self._read_ref(source_filepath)
+        if blob_name is None:
+            # A plain file; store it properly while we're at it
+            blob_name = self._store(
+                self._resolve_filepath(source_filepath), source_filepath,
+                move=True)
+
+        dest_filepath = clean_listy_filepath(dest_filepath)
+        if self.file_exists(dest_filepath):
+            self.delete_file(dest_filepath)
+
+        with self._blob_refs(blob_name) as refs:
+            self._write_ref(dest_filepath, blob_name)
+            refs.add(u'/'.join(dest_filepath))
+
+    def filepaths_with_content(self, filename, ext=u''):
+        """
+        Return the filepaths of all stored files with the same content (and
+        extension) as the local file filename.
+        """
+        blob_name = file_hash(filename) + ext.lower()
+        if not os.path.exists(self._blob_path(blob_name)):
+            return []
+
+        with self._blob_refs(blob_name) as refs:
+            return [ref.split(u'/') for ref in sorted(refs)]
+
+    def dedup_file(self, filepath):
+        """
+        Move the plain file at filepath into the blob store.
+
+        Returns the blob name and whether that blob was already known, or
+        None if filepath already was a reference.
+        """
+        if self._read_ref(filepath) is not None:
+            return None
+
+        filename = self._resolve_filepath(filepath)
+        blob_name = self._blob_name(filename, filepath)
+        known = os.path.exists(self._blob_path(blob_name))
+        self._store(filename, filepath, move=True)
+        return blob_name, known
+
+
+class _BlobWriter(object):
+    """
+    Writable file for DedupFileStorage.get_file(), which goes into the
+    blob store once it is closed.
+    """
+    def __init__(self, storage, filepath, mode):
+        self.storage = storage
+        self.filepath = filepath
+        tmp_dir = storage._resolve_filepath([storage.blob_dir])
+        if not os.path.exists(tmp_dir):
+            os.makedirs(tmp_dir)
+        self._file = tempfile.NamedTemporaryFile(
+            mode=mode, dir=tmp_dir, delete=False)
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def close(self):
+        if self._file.closed:
+            return
+        self._file.close()
+        try:
+            self.storage._store(self._file.name, self.filepath, move=True)
+        finally:
+            if os.path.exists(self._file.name):
+                os.remove(self._file.name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
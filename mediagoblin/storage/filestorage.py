@@ -14,6 +14,7 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import errno
 import os
 import shutil
 
@@ -52,12 +53,22 @@ class BasicFileStorage(StorageInterface):
     def file_exists(self, filepath):
         return os.path.exists(self._resolve_filepath(filepath))
 
-    def get_file(self, filepath, mode='r'):
-        # Make directories if necessary
+    def _ensure_directory(self, filepath):
+        """
+        Make the directories filepath lives in, if necessary
+        """
         if len(filepath) > 1:
             directory = self._resolve_filepath(filepath[:-1])
-            if not os.path.exists(directory):
+            try:
                 os.makedirs(directory)
+            except OSError as e:
+                # Somebody else might have created it just now
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def get_file(self, filepath, mode='r'):
+        # Make directories if necessary
+        self._ensure_directory(filepath)
 
         # Grab and return the file in the mode specified
         return open(self._resolve_filepath(filepath), mode)
@@ -106,12 +117,13 @@ class BasicFileStorage(StorageInterface):
         Copy this file from locally to the storage system.
         """
         # Make directories if necessary
-        if len(filepath) > 1:
-            directory = self._resolve_filepath(filepath[:-1])
-            if not os.path.exists(directory):
-                os.makedirs(directory)
+        self._ensure_directory(filepath)
         # This uses chunked copying of 16kb buffers (Py2.7):
         shutil.copy(filename, self.get_local_path(filepath))
 
     def get_file_size(self, filepath):
         return os.stat(self._resolve_filepath(filepath)).st_size
+
+    def get_file_etag(self, filepath):
+        stat = os.stat(self._resolve_filepath(filepath))
+        return u'{0!r}-{1}'.format(stat.st_mtime, stat.st_size)
@@ -14,15 +14,72 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import six
+import bisect
+import io
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
 
-from mediagoblin.storage import StorageInterface, clean_listy_filepath
+from mediagoblin.storage import StorageInterface, Error, \
+    NotImplementedError, clean_listy_filepath
+from mediagoblin.tools.files import SizeBoundedDirectory
+from mediagoblin.tools.fragment_cache import FragmentCache
+
+_log = logging.getLogger(__name__)
+
+# Upper bounds (in seconds) of the buckets of the latency histograms, the
+# last bucket takes everything slower
+LATENCY_BUCKETS = (0.001, 0.01, 0.1, 1.0, 10.0)
+
+# How many directories to remember the mount of
+RESOLVE_CACHE_SIZE = 10000
+
+# How long (in seconds) TieredStorage.file_url() trusts a check of a hot
+# copy against the cold tier, and how many checks it remembers
+HOT_URL_CHECK_TIME = 60
+HOT_URL_CACHE_SIZE = 10000
 
 
 class MountError(Exception):
     pass
 
 
+class MountStats(object):
+    """
+    Operation counts, bytes transferred and latency histograms of a mount
+
+    Bytes are only counted for copy_locally() and copy_local_to_storage(),
+    the file objects of get_file() are handed out as they are.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.operations = defaultdict(int)
+        self.latency = defaultdict(lambda: [0] * (len(LATENCY_BUCKETS) + 1))
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def record(self, operation, seconds, bytes_read=0, bytes_written=0):
+        with self._lock:
+            self.operations[operation] += 1
+            self.latency[operation][
+                bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            self.bytes_read += bytes_read
+            self.bytes_written += bytes_written
+
+    def as_dict(self):
+        with self._lock:
+            return {'operations': dict(self.operations),
+                    'latency': dict((operation, list(histogram))
+                                    for operation, histogram
+                                    in self.latency.items()),
+                    'bytes_read': self.bytes_read,
+                    'bytes_written': self.bytes_written}
+
+
 class MountStorage(StorageInterface):
     """
     Experimental "Mount" virtual Storage Interface
@@ -49,114 +106,409 @@ class MountStorage(StorageInterface):
 
     To set this up, you currently need to call the mount() method with
     the target path and a backend, that shall be available under that
-    target path.  You have to mount things in a sensible order,
-    especially you can't mount ["a", "b"] before ["a"].
+    target path.  A path goes to the backend mounted at its longest
+    mounted prefix, so ["a", "b"] may be mounted before or after ["a"].
+    To put a local hot tier in front of a remote backend, mount a
+    TieredStorage.
+
+    What every mount did is counted, see get_stats().
     """
     def __init__(self, **kwargs):
-        self.mounttab = {}
+        # Mounted backends by their (cleaned) path as a tuple
+        self.mounts = {}
+        self.stats = {}
+        self._prefix_lengths = []
+        self._resolved = {}
 
     def mount(self, dirpath, backend):
         """
         Mount a new backend under dirpath
         """
-        new_ent = clean_listy_filepath(dirpath)
+        new_ent = tuple(clean_listy_filepath(dirpath))
 
-        print "Mounting:", repr(new_ent)
-        already, rem_1, table, rem_2 = self._resolve_to_backend(new_ent, True)
-        print "===", repr(already), repr(rem_1), repr(rem_2), len(table)
+        _log.debug('Mounting {0!r} at {1!r}'.format(backend, new_ent))
+        if new_ent in self.mounts:
+            raise MountError("That path is already mounted")
 
-        assert (len(rem_2) > 0) or (None not in table), \
-            "That path is already mounted"
-        assert (len(rem_2) > 0) or (len(table) == 0), \
-            "A longer path is already mounted here"
+        self.mounts[new_ent] = backend
+        self.stats[new_ent] = MountStats()
+        self._prefix_lengths = sorted(
+            set(len(mounted) for mounted in self.mounts), reverse=True)
+        self._resolved.clear()
 
-        for part in rem_2:
-            table[part] = {}
-            table = table[part]
-        table[None] = backend
-
-    def _resolve_to_backend(self, filepath, extra_info=False):
+    def _resolve_prefix(self, dirpath):
+        """
+        The longest mounted prefix of the tuple dirpath, or None
         """
-        extra_info = True is for internal use!
+        prefix = self._resolved.get(dirpath, False)
+        if prefix is not False:
+            return prefix
+
+        prefix = None
+        for length in self._prefix_lengths:
+            if length <= len(dirpath) and dirpath[:length] in self.mounts:
+                prefix = dirpath[:length]
+                break
 
-        Normally, returns the backend and the filepath inside that backend.
+        if len(self._resolved) >= RESOLVE_CACHE_SIZE:
+            self._resolved.clear()
+        self._resolved[dirpath] = prefix
+        return prefix
 
-        With extra_info = True it returns the last directory node and the
-        remaining filepath from there in addition.
+    def _resolve_to_backend(self, filepath):
         """
-        table = self.mounttab
-        filepath = filepath[:]
-        res_fp = None
-        while True:
-            new_be = table.get(None)
-            if (new_be is not None) or res_fp is None:
-                res_be = new_be
-                res_fp = filepath[:]
-                res_extra = (table, filepath[:])
-                # print "... New res: %r, %r, %r" % (res_be, res_fp, res_extra)
-            if len(filepath) == 0:
-                break
-            query = filepath.pop(0)
-            entry = table.get(query)
-            if entry is not None:
-                table = entry
-                res_extra = (table, filepath[:])
-            else:
-                break
-        if extra_info:
-            return (res_be, res_fp) + res_extra
+        Returns the mounted prefix of filepath, its backend and the
+        filepath inside that backend.
+
+        What directories resolve to is remembered, so most lookups are a
+        single dict lookup.
+        """
+        filepath = tuple(filepath)
+        if filepath in self.mounts:
+            prefix = filepath
         else:
-            return (res_be, res_fp)
+            prefix = self._resolve_prefix(filepath[:-1])
+        if prefix is None:
+            return None, None, filepath
+        return prefix, self.mounts[prefix], list(filepath[len(prefix):])
 
     def resolve_to_backend(self, filepath):
-        backend, filepath = self._resolve_to_backend(filepath)
+        prefix, backend, filepath = self._resolve_to_backend(filepath)
         if backend is None:
             raise MountError("Path not mounted")
         return backend, filepath
 
-    def __repr__(self, table=None, indent=[]):
-        res = []
-        if table is None:
-            res.append("MountStorage<")
-            table = self.mounttab
-        v = table.get(None)
-        if v:
-            res.append("  " * len(indent) + repr(indent) + ": " + repr(v))
-        for k, v in six.iteritems(table):
-            if k == None:
-                continue
-            res.append("  " * len(indent) + repr(k) + ":")
-            res += self.__repr__(v, indent + [k])
-        if table is self.mounttab:
-            res.append(">")
-            return "\n".join(res)
-        else:
-            return res
+    def __repr__(self):
+        res = ["MountStorage<"]
+        for prefix in sorted(self.mounts):
+            res.append("  " + repr(list(prefix)) + ": " +
+                       repr(self.mounts[prefix]))
+        res.append(">")
+        return "\n".join(res)
+
+    @contextmanager
+    def _backend(self, operation, filepath):
+        """
+        Yields the backend of filepath and the filepath inside it, and
+        counts the operation in the stats of the mount
+        """
+        prefix, backend, backend_filepath = self._resolve_to_backend(filepath)
+        if backend is None:
+            raise MountError("Path not mounted")
+
+        counted = {}
+        started = time.time()
+        try:
+            yield backend, backend_filepath, counted
+        finally:
+            self.stats[prefix].record(
+                operation, time.time() - started, **counted)
+
+    def get_stats(self):
+        """
+        The stats of every mount, see MountStats, by mounted path
+        """
+        return dict(('/'.join(prefix), stats.as_dict())
+                    for prefix, stats in self.stats.items())
 
     def file_exists(self, filepath):
-        backend, filepath = self.resolve_to_backend(filepath)
-        return backend.file_exists(filepath)
+        with self._backend('file_exists', filepath) as (backend, filepath, _):
+            return backend.file_exists(filepath)
 
     def get_file(self, filepath, mode='r'):
-        backend, filepath = self.resolve_to_backend(filepath)
-        return backend.get_file(filepath, mode)
+        with self._backend('get_file', filepath) as (backend, filepath, _):
+            return backend.get_file(filepath, mode)
 
     def delete_file(self, filepath):
-        backend, filepath = self.resolve_to_backend(filepath)
-        return backend.delete_file(filepath)
+        with self._backend('delete_file', filepath) as (backend, filepath, _):
+            return backend.delete_file(filepath)
+
+    def delete_files(self, filepaths):
+        """
+        Hand each backend all of its files at once
+        """
+        by_prefix = defaultdict(list)
+        for filepath in filepaths:
+            prefix, backend, backend_filepath = self._resolve_to_backend(
+                filepath)
+            if backend is None:
+                raise MountError("Path not mounted")
+            by_prefix[prefix].append(filepath)
+
+        failed = []
+        for prefix, prefix_filepaths in by_prefix.items():
+            started = time.time()
+            backend_failed = self.mounts[prefix].delete_files(
+                [list(filepath[len(prefix):]) for filepath in prefix_filepaths])
+            self.stats[prefix].record('delete_files', time.time() - started)
+            failed.extend(list(prefix) + list(filepath)
+                          for filepath in backend_failed)
+        return failed
+
+    def delete_dir(self, dirpath, recursive=False):
+        with self._backend('delete_dir', dirpath) as (backend, dirpath, _):
+            return backend.delete_dir(dirpath, recursive)
 
     def file_url(self, filepath):
-        backend, filepath = self.resolve_to_backend(filepath)
-        return backend.file_url(filepath)
+        with self._backend('file_url', filepath) as (backend, filepath, _):
+            return backend.file_url(filepath)
 
     def get_local_path(self, filepath):
-        backend, filepath = self.resolve_to_backend(filepath)
-        return backend.get_local_path(filepath)
+        with self._backend('get_local_path', filepath) as (
+                backend, filepath, _):
+            return backend.get_local_path(filepath)
+
+    def get_file_size(self, filepath):
+        with self._backend('get_file_size', filepath) as (
+                backend, filepath, _):
+            return backend.get_file_size(filepath)
+
+    def get_file_etag(self, filepath):
+        with self._backend('get_file_etag', filepath) as (
+                backend, filepath, _):
+            return backend.get_file_etag(filepath)
 
     def copy_locally(self, filepath, dest_path):
         """
         Need to override copy_locally, because the local_storage
         attribute is not correct.
         """
-        backend, filepath = self.resolve_to_backend(filepath)
-        backend.copy_locally(filepath, dest_path)
+        with self._backend('copy_locally', filepath) as (
+                backend, filepath, counted):
+            backend.copy_locally(filepath, dest_path)
+            counted['bytes_read'] = os.path.getsize(dest_path)
+
+    def copy_local_to_storage(self, filename, filepath):
+        with self._backend('copy_local_to_storage', filepath) as (
+                backend, filepath, counted):
+            backend.copy_local_to_storage(filename, filepath)
+            counted['bytes_written'] = os.path.getsize(filename)
+
+
+class TieredStorage(StorageInterface):
+    """
+    A local hot tier in front of a (remote) cold tier
+
+    The cold tier has every file.  Files are copied to the hot tier
+    ("promoted") when they are read, and served from there afterwards.
+    Writes go to the cold tier, and drop the copy in the hot tier.
+
+    Files can be rewritten through another TieredStorage (on another
+    machine), so next to every hot copy the size and ETag of the cold
+    file it was copied from is kept, in a file with HOT_VERSION_SUFFIX.
+    A hot copy is only used while the cold file still matches.  If the
+    cold tier has no ETags, hot copies can't be checked, and files are
+    read from the cold tier instead.
+
+    If hot_max_size (in bytes) is given, the least recently promoted or
+    read files are removed from the hot tier when it grows bigger.
+    """
+
+    # What's read comes from the hot tier, so this is as local as it
+    local_storage = True
+
+    HOT_VERSION_SUFFIX = '.mg-version'
+
+    def __init__(self, hot, cold, hot_max_size=None, **kwargs):
+        if not hot.local_storage:
+            raise MountError("The hot tier has to be local storage")
+        self.hot = hot
+        self.cold = cold
+        self.hot_max_size = hot_max_size
+        self._size_bound = None
+        if hot_max_size is not None:
+            self._size_bound = SizeBoundedDirectory(
+                hot.get_local_path([]), hot_max_size,
+                skip=lambda name: name.endswith(self.HOT_VERSION_SUFFIX))
+        # The URLs file_url() gave out, with when it checked the hot copy
+        self._urls = FragmentCache(HOT_URL_CACHE_SIZE)
+
+    def __repr__(self):
+        return '<TieredStorage hot={0!r} cold={1!r}>'.format(
+            self.hot, self.cold)
+
+    def _cold_version(self, filepath):
+        """
+        What identifies the current content of filepath in the cold tier,
+        or None if the cold tier can't tell
+        """
+        try:
+            etag = self.cold.get_file_etag(filepath)
+            if etag is None:
+                # The size alone doesn't change when a file is rewritten
+                return None
+            return u'{0} {1}'.format(self.cold.get_file_size(filepath), etag)
+        except NotImplementedError:
+            return None
+
+    def _hot_version(self, path):
+        try:
+            with io.open(path + self.HOT_VERSION_SUFFIX,
+                         encoding='utf-8') as version_file:
+                return version_file.read()
+        except (IOError, OSError):
+            return None
+
+    def _hot_is_current(self, filepath, version):
+        if version is None:
+            return False
+        path = self.hot.get_local_path(filepath)
+        if not os.path.exists(path):
+            return False
+        return self._hot_version(path) == version
+
+    def _promote(self, filepath):
+        """
+        Make sure the hot tier has a current copy of filepath
+
+        Returns False, and copies nothing, if the cold tier can't tell
+        whether a copy is current.
+        """
+        path = self.hot.get_local_path(filepath)
+        version = self._cold_version(filepath)
+        if version is None:
+            return False
+        if self._hot_is_current(filepath, version):
+            # Mark as recently used
+            try:
+                os.utime(path, None)
+            except OSError:
+                pass
+            return True
+
+        _log.debug('Promoting {0} to the hot tier'.format(filepath))
+        self._copy_to_hot(filepath, version)
+        return True
+
+    def _copy_to_hot(self, filepath, version):
+        """
+        Copy filepath from the cold to the hot tier, and keep version
+        next to it.  Without a version the copy is never current.
+        """
+        path = self.hot.get_local_path(filepath)
+        self._urls.delete(tuple(filepath))
+        hot_dir = os.path.dirname(path)
+        if not os.path.exists(hot_dir):
+            try:
+                os.makedirs(hot_dir)
+            except OSError:
+                # Made by another process in the meantime?
+                if not os.path.isdir(hot_dir):
+                    raise
+
+        # Copy under temporary names first, so readers never see half a
+        # file (or a new file with an old version)
+        tmp_filenames = []
+        try:
+            for contents in (None, version):
+                with tempfile.NamedTemporaryFile(
+                        dir=hot_dir, delete=False) as tmp_file:
+                    tmp_filenames.append(tmp_file.name)
+                    if contents is not None:
+                        tmp_file.write(contents.encode('utf-8'))
+            self.cold.copy_locally(filepath, tmp_filenames[0])
+            os.rename(tmp_filenames[0], path)
+            if version is None:
+                self._remove(tmp_filenames[1])
+                self._remove(path + self.HOT_VERSION_SUFFIX)
+            else:
+                os.rename(tmp_filenames[1], path + self.HOT_VERSION_SUFFIX)
+        except:
+            for tmp_filename in tmp_filenames:
+                self._remove(tmp_filename)
+            raise
+
+        if self._size_bound is not None:
+            for evicted in self._size_bound.added(os.path.getsize(path)):
+                self._remove(evicted + self.HOT_VERSION_SUFFIX)
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _demote(self, filepath):
+        path = self.hot.get_local_path(filepath)
+        self._urls.delete(tuple(filepath))
+        self._remove(path)
+        self._remove(path + self.HOT_VERSION_SUFFIX)
+
+    def evict(self):
+        """
+        Remove the least recently used files from the hot tier until it
+        fits hot_max_size again
+        """
+        if self._size_bound is not None:
+            for evicted in self._size_bound.evict():
+                self._remove(evicted + self.HOT_VERSION_SUFFIX)
+
+    def file_exists(self, filepath):
+        return self.hot.file_exists(filepath) or \
+            self.cold.file_exists(filepath)
+
+    def get_file(self, filepath, mode='r'):
+        if 'w' in mode or 'a' in mode:
+            self._demote(filepath)
+            return self.cold.get_file(filepath, mode)
+
+        if not self._promote(filepath):
+            return self.cold.get_file(filepath, mode)
+        return self.hot.get_file(filepath, mode)
+
+    def delete_file(self, filepath):
+        self._demote(filepath)
+        return self.cold.delete_file(filepath)
+
+    def delete_files(self, filepaths):
+        for filepath in filepaths:
+            self._demote(filepath)
+        return self.cold.delete_files(filepaths)
+
+    def delete_dir(self, dirpath, recursive=False):
+        self.hot.delete_dir(dirpath, recursive)
+        return self.cold.delete_dir(dirpath, recursive)
+
+    def file_url(self, filepath):
+        # URLs are made for every page, checking the hot copy against the
+        # cold tier every time would make them as slow as the cold tier
+        key = tuple(filepath)
+        cached = self._urls.get(key)
+        if cached is not None and \
+                time.time() - cached[1] < HOT_URL_CHECK_TIME:
+            return cached[0]
+
+        url = None
+        if self.hot.file_exists(filepath):
+            try:
+                if self._hot_is_current(
+                        filepath, self._cold_version(filepath)):
+                    url = self.hot.file_url(filepath)
+            except (Error, IOError, OSError):
+                pass
+        if url is None:
+            url = self.cold.file_url(filepath)
+        self._urls.set(key, (url, time.time()))
+        return url
+
+    def get_local_path(self, filepath):
+        if not self._promote(filepath):
+            # A local path is wanted, but the hot copy can't be trusted
+            # later on, so get a fresh one every time
+            self._copy_to_hot(filepath, None)
+        return self.hot.get_local_path(filepath)
+
+    def copy_locally(self, filepath, dest_path):
+        if not self._promote(filepath):
+            return self.cold.copy_locally(filepath, dest_path)
+        self.hot.copy_locally(filepath, dest_path)
+
+    def copy_local_to_storage(self, filename, filepath):
+        self._demote(filepath)
+        self.cold.copy_local_to_storage(filename, filepath)
+
+    def get_file_size(self, filepath):
+        return self.cold.get_file_size(filepath)
+
+    def get_file_etag(self, filepath):
+        return self.cold.get_file_etag(filepath)
@@ -0,0 +1,592 @@
+# GNU MediaGoblin -- federated, autonomous media hosting
+# Copyright (C) 2011, 2012 MediaGoblin contributors.  See AUTHORS.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Storage in S3 compatible object stores (Amazon S3, MinIO, Ceph...)
+
+Talks the S3 REST API over plain HTTP(S), so no extra library is needed.
+Objects are addressed path-style, as <endpoint>/<bucket>/<key>, which is
+what most self-hosted object stores expect.  Example configuration:
+
+  [storage:publicstore]
+  storage_class = mediagoblin.storage.s3:S3Storage
+  s3_endpoint = https://objects.example.org
+  s3_bucket = mediagoblin
+  s3_access_key = ...
+  s3_secret_key = ...
+  base_url = https://objects.example.org/mediagoblin/
+
+Files bigger than s3_part_size are uploaded in parts and downloaded in
+ranges, s3_threads at a time.
+"""
+
+from __future__ import absolute_import
+
+import base64
+import datetime
+import hashlib
+import hmac
+import logging
+import mimetypes
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+from xml.etree import ElementTree
+
+import six
+from six.moves import http_client
+from six.moves.queue import LifoQueue, Empty, Full
+import six.moves.urllib.parse as urlparse
+
+from mediagoblin.storage import StorageInterface, Error, clean_listy_filepath
+
+_log = logging.getLogger(__name__)
+
+# Copy in chunks of this size when streaming a response to a file
+CHUNK_SIZE = 64 * 1024
+
+# S3 takes at most this many keys per multi-object delete
+DELETE_BATCH_SIZE = 1000
+
+# How many HEAD responses to keep at most
+METADATA_CACHE_SIZE = 10000
+
+
+class S3Error(Error):
+    """
+    The object store answered with an unexpected status
+    """
+    def __init__(self, method, path, status, body=b''):
+        super(S3Error, self).__init__(
+            '{0} {1} failed with status {2}: {3!r}'.format(
+                method, path, status, body[:200]))
+        self.status = status
+
+
+def _tag(element):
+    """
+    The tag of element, without the namespace
+    """
+    return element.tag.rsplit('}', 1)[-1]
+
+
+def _find_all(root, tag):
+    return [element for element in root.iter() if _tag(element) == tag]
+
+
+def _find_text(root, tag):
+    for element in _find_all(root, tag):
+        return element.text
+    return None
+
+
+def _quote(value):
+    return urlparse.quote(value.encode('utf-8') if isinstance(
+        value, six.text_type) else value, safe='-_.~')
+
+
+class _FileRange(object):
+    """
+    Reads at most length bytes of filename from offset, so httplib can
+    send a part of a file without reading it into memory
+    """
+    def __init__(self, filename, offset, length):
+        self.file = open(filename, 'rb')
+        self.offset = offset
+        self.length = length
+        self.rewind()
+
+    def rewind(self):
+        self.file.seek(self.offset)
+        self.remaining = self.length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+class S3Storage(StorageInterface):
+    """
+    S3 compatible object store
+
+    Keeps a pool of persistent connections per worker process, and what
+    HEAD requests found out about objects for metadata_ttl seconds, so
+    file_exists() and get_file_size() don't go over the wire every time.
+    """
+
+    local_storage = False
+
+    def __init__(self, s3_endpoint, s3_bucket, s3_access_key=None,
+                 s3_secret_key=None, s3_region=u'us-east-1', base_url=None,
+                 s3_part_size=8 * 1024 * 1024, s3_threads=4,
+                 s3_metadata_ttl=300, **kwargs):
+        """
+        Keyword arguments:
+        - s3_endpoint: URL of the object store, like https://s3.example.org
+        - s3_bucket: Bucket to store files in, which has to exist
+        - s3_access_key, s3_secret_key: Credentials, requests are not
+          signed without them
+        - s3_region: Region the bucket is in, used for signing
+        - base_url: URL files will be served from, defaults to the
+          bucket on the endpoint
+        - s3_part_size: Bytes per part of multipart uploads and ranged
+          downloads (at least 5MB, S3 refuses smaller parts)
+        - s3_threads: Parts transferred in parallel
+        - s3_metadata_ttl: Seconds to trust what we know about an object
+        """
+        endpoint = urlparse.urlsplit(s3_endpoint)
+        self.secure = endpoint.scheme == 'https'
+        self.host = endpoint.netloc
+        self.bucket = s3_bucket
+        self.access_key = s3_access_key
+        self.secret_key = s3_secret_key
+        self.region = s3_region
+        self.base_url = base_url or u'{0}/{1}/'.format(
+            s3_endpoint.rstrip('/'), s3_bucket)
+        self.part_size = int(s3_part_size)
+        self.threads = int(s3_threads)
+        self.metadata_ttl = float(s3_metadata_ttl)
+
+        self._pool_pid = None
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._metadata = {}
+
+    ############
+    # Connection
+    ############
+
+    def _new_connection(self):
+        if self.secure:
+            return http_client.HTTPSConnection(self.host)
+        return http_client.HTTPConnection(self.host)
+
+    @contextmanager
+    def _connection(self):
+        """
+        A connection from the pool of this process, and whether it was
+        used before
+
+        Celery forks its workers, and connections can't be shared with
+        the parent, so every process makes a pool of its own.  Connections
+        are only put back after a complete request.
+        """
+        with self._pool_lock:
+            if self._pool_pid != os.getpid():
+                self._pool_pid = os.getpid()
+                self._pool = LifoQueue(maxsize=self.threads)
+            pool = self._pool
+
+        try:
+            connection, reused = pool.get_nowait(), True
+        except Empty:
+            connection, reused = self._new_connection(), False
+
+        try:
+            yield connection, reused
+        except:
+            connection.close()
+            raise
+
+        try:
+            pool.put_nowait(connection)
+        except Full:
+            connection.close()
+
+    def _path(self, key=None):
+        if key is None:
+            return u'/{0}'.format(_quote(self.bucket))
+        return u'/{0}/{1}'.format(
+            _quote(self.bucket),
+            u'/'.join(_quote(part) for part in key.split(u'/')))
+
+    def _sign(self, method, path, query, headers):
+        """
+        Add AWS signature version 4 headers for a request
+
+        The payload isn't hashed, so bodies can be streamed.
+        """
+        now = datetime.datetime.utcnow()
+        headers['host'] = self.host
+        headers['x-amz-date'] = now.strftime('%Y%m%dT%H%M%SZ')
+        headers['x-amz-content-sha256'] = 'UNSIGNED-PAYLOAD'
+        if not self.access_key:
+            return
+
+        signed_headers = sorted(headers)
+        canonical_request = u'\n'.join([
+            method,
+            path,
+            u'&'.join(u'{0}={1}'.format(_quote(name), _quote(value))
+                      for name, value in sorted(query.items())),
+            u''.join(u'{0}:{1}\n'.format(name, six.text_type(
+                headers[name]).strip()) for name in signed_headers),
+            u';'.join(signed_headers),
+            u'UNSIGNED-PAYLOAD'])
+
+        scope = u'{0}/{1}/s3/aws4_request'.format(
+            now.strftime('%Y%m%d'), self.region)
+        string_to_sign = u'\n'.join([
+            u'AWS4-HMAC-SHA256', headers['x-amz-date'], scope,
+            hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()])
+
+        key = (u'AWS4' + self.secret_key).encode('utf-8')
+        for part in scope.split(u'/'):
+            key = hmac.new(key, part.encode('utf-8'), hashlib.sha256).digest()
+        signature = hmac.new(key, string_to_sign.encode('utf-8'),
+                             hashlib.sha256).hexdigest()
+
+        headers['authorization'] = (
+            u'AWS4-HMAC-SHA256 Credential={0}/{1}, SignedHeaders={2}, '
+            u'Signature={3}'.format(self.access_key, scope,
+                                    u';'.join(signed_headers), signature))
+
+    def _request(self, method, key=None, query=None, headers=None, body=None,
+                 expect=(200, 204), dest=None):
+        """
+        Do a request on the bucket (if key is None) or the object at key.
+
+        Returns the response status, headers (with lowercase names) and
+        body, unless dest is given: then the body is written to the file
+        object dest.  Raises S3Error if the status isn't in expect.
+        """
+        query = query or {}
+        headers = dict((name.lower(), value)
+                       for name, value in (headers or {}).items())
+        path = self._path(key)
+        self._sign(method, path, query, headers)
+
+        url = path
+        if query:
+            url += u'?' + u'&'.join(
+                u'{0}={1}'.format(_quote(name), _quote(value))
+                if value else _quote(name)
+                for name, value in sorted(query.items()))
+
+        with self._connection() as (connection, reused):
+            try:
+                connection.request(method, url, body, headers)
+                response = connection.getresponse()
+            except (http_client.HTTPException, socket.error):
+                # The store may have closed an idle connection in the pool,
+                # try once more on a new one
+                if not reused:
+                    raise
+                connection.close()
+                if isinstance(body, _FileRange):
+                    body.rewind()
+                connection.request(method, url, body, headers)
+                response = connection.getresponse()
+            response_headers = dict(
+                (name.lower(), value) for name, value in response.getheaders())
+            if dest is not None and response.status in expect:
+                shutil.copyfileobj(response, dest, CHUNK_SIZE)
+                response_body = b''
+            else:
+                response_body = response.read()
+
+        if response.status not in expect:
+            raise S3Error(method, url, response.status, response_body)
+        return response.status, response_headers, response_body
+
+    ##########
+    # Metadata
+    ##########
+
+    def _key(self, filepath):
+        return u'/'.join(clean_listy_filepath(filepath))
+
+    def _remember(self, key, size, etag):
+        if len(self._metadata) >= METADATA_CACHE_SIZE:
+            self._metadata.clear()
+        self._metadata[key] = (time.time() + self.metadata_ttl, size, etag)
+
+    def _forget(self, key):
+        self._metadata.pop(key, None)
+
+    def _head(self, key):
+        """
+        The (size, etag) of the object at key, or None if there is none
+
+        Only objects that exist are remembered, another worker might be
+        about to store one that doesn't yet.
+        """
+        cached = self._metadata.get(key)
+        if cached is not None and cached[0] > time.time():
+            return cached[1:]
+
+        status, headers, body = self._request('HEAD', key, expect=(200, 404))
+        if status == 404:
+            self._forget(key)
+            return None
+
+        metadata = int(headers['content-length']), headers.get('etag')
+        self._remember(key, *metadata)
+        return metadata
+
+    def file_exists(self, filepath):
+        return self._head(self._key(filepath)) is not None
+
+    def get_file_size(self, filepath):
+        metadata = self._head(self._key(filepath))
+        if metadata is None:
+            raise S3Error('HEAD', self._key(filepath), 404)
+        return metadata[0]
+
+    def get_file_etag(self, filepath):
+        metadata = self._head(self._key(filepath))
+        return metadata and metadata[1]
+
+    ###########
+    # Transfers
+    ###########
+
+    def _in_parallel(self, function, items):
+        items = list(items)
+        pool = ThreadPool(min(self.threads, len(items)))
+        try:
+            return pool.map(function, items)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _content_type(self, key):
+        return mimetypes.guess_type(key)[0] or 'application/octet-stream'
+
+    def get_file(self, filepath, mode='r'):
+        """
+        Objects can't be changed in place: reading fetches the object into
+        a temporary file, writing stores it when the file is closed.
+        """
+        if 'w' in mode or 'a' in mode:
+            return _S3Writer(self, filepath)
+
+        source = tempfile.SpooledTemporaryFile(max_size=4 * 1024 * 1024)
+        self._request('GET', self._key(filepath), dest=source)
+        source.seek(0)
+        return source
+
+    def delete_file(self, filepath):
+        key = self._key(filepath)
+        self._forget(key)
+        self._request('DELETE', key)
+
+    def file_url(self, filepath):
+        return urlparse.urljoin(
+            self.base_url, u'/'.join(
+                _quote(part) for part in clean_listy_filepath(filepath)))
+
+    def copy_local_to_storage(self, filename, filepath):
+        """
+        Store filename, in parts uploaded in parallel if it is bigger than
+        a part
+        """
+        key = self._key(filepath)
+        size = os.path.getsize(filename)
+        self._forget(key)
+
+        if size <= self.part_size:
+            body = _FileRange(filename, 0, size)
+            try:
+                status, headers, response = self._request(
+                    'PUT', key, body=body, headers={
+                        'content-length': str(size),
+                        'content-type': self._content_type(key)})
+            finally:
+                body.close()
+            self._remember(key, size, headers.get('etag'))
+            return
+
+        status, headers, response = self._request(
+            'POST', key, query={'uploads': ''},
+            headers={'content-type': self._content_type(key)})
+        upload_id = _find_text(ElementTree.fromstring(response), 'UploadId')
+
+        def upload_part(number):
+            offset = (number - 1) * self.part_size
+            length = min(self.part_size, size - offset)
+            body = _FileRange(filename, offset, length)
+            try:
+                status, headers, response = self._request(
+                    'PUT', key, body=body,
+                    query={'partNumber': str(number), 'uploadId': upload_id},
+                    headers={'content-length': str(length)})
+            finally:
+                body.close()
+            return number, headers['etag']
+
+        part_count = (size + self.part_size - 1) // self.part_size
+        _log.debug('Uploading {0} in {1} parts'.format(key, part_count))
+        try:
+            parts = self._in_parallel(upload_part, range(1, part_count + 1))
+        except:
+            self._request('DELETE', key, query={'uploadId': upload_id},
+                          expect=(200, 204, 404))
+            raise
+
+        complete = u''.join(
+            u'<Part><PartNumber>{0}</PartNumber><ETag>{1}</ETag></Part>'.format(
+                number, etag)
+            for number, etag in parts)
+        status, headers, response = self._request(
+            'POST', key, query={'uploadId': upload_id},
+            body=u'<CompleteMultipartUpload>{0}</CompleteMultipartUpload>'
+                .format(complete).encode('utf-8'))
+
+        # S3 may send an error with status 200 once it started answering
+        result = ElementTree.fromstring(response)
+        if _tag(result) == 'Error':
+            raise S3Error('POST', key, 200, response)
+        self._remember(key, size, _find_text(result, 'ETag'))
+
+    def copy_locally(self, filepath, dest_path):
+        """
+        Fetch the object to dest_path, in ranges downloaded in parallel if
+        it is bigger than a part
+        """
+        key = self._key(filepath)
+        metadata = self._head(key)
+        if metadata is None:
+            raise S3Error('HEAD', key, 404)
+        size = metadata[0]
+
+        if size <= self.part_size:
+            with open(dest_path, 'wb') as dest_file:
+                self._request('GET', key, dest=dest_file)
+            return
+
+        with open(dest_path, 'wb') as dest_file:
+            dest_file.truncate(size)
+
+        def download_range(offset):
+            last = min(offset + self.part_size, size) - 1
+            with open(dest_path, 'r+b') as dest_file:
+                dest_file.seek(offset)
+                self._request('GET', key, expect=(206,), dest=dest_file,
+                              headers={'range': 'bytes={0}-{1}'.format(
+                                  offset, last)})
+
+        self._in_parallel(download_range, range(0, size, self.part_size))
+
+    #############
+    # Directories
+    #############
+
+    def _list(self, prefix):
+        """
+        Iterate over the keys starting with prefix
+        """
+        query = {'list-type': '2', 'prefix': prefix}
+        while True:
+            status, headers, response = self._request('GET', query=query)
+            result = ElementTree.fromstring(response)
+            for key in _find_all(result, 'Key'):
+                yield key.text
+            token = _find_text(result, 'NextContinuationToken')
+            if _find_text(result, 'IsTruncated') != 'true' or not token:
+                break
+            query['continuation-token'] = token
+
+    def delete_files(self, filepaths):
+        keys = dict((self._key(filepath), filepath) for filepath in filepaths)
+        return [keys[key] for key in self._delete_keys(list(keys))]
+
+    def _delete_keys(self, keys):
+        """
+        Delete keys with multi-object deletes, returns the keys which
+        could not be deleted
+        """
+        failed = []
+        for start in range(0, len(keys), DELETE_BATCH_SIZE):
+            batch = keys[start:start + DELETE_BATCH_SIZE]
+            for key in batch:
+                self._forget(key)
+
+            root = ElementTree.Element('Delete')
+            ElementTree.SubElement(root, 'Quiet').text = 'true'
+            for key in batch:
+                ElementTree.SubElement(
+                    ElementTree.SubElement(root, 'Object'), 'Key').text = key
+            body = ElementTree.tostring(root)
+
+            try:
+                status, headers, response = self._request(
+                    'POST', query={'delete': ''}, body=body, headers={
+                        'content-md5': base64.b64encode(
+                            hashlib.md5(body).digest()).decode('ascii'),
+                        'content-type': 'application/xml'})
+            except (S3Error, http_client.HTTPException, socket.error) as exc:
+                _log.error('Could not delete {0} files: {1}'.format(
+                    len(batch), exc))
+                failed.extend(batch)
+                continue
+
+            for error in _find_all(ElementTree.fromstring(response), 'Error'):
+                _log.error('Could not delete {0}: {1}'.format(
+                    _find_text(error, 'Key'), _find_text(error, 'Message')))
+                failed.append(_find_text(error, 'Key'))
+        return failed
+
+    def delete_dir(self, dirpath, recursive=False):
+        """
+        There are no directories in object stores, only keys that look
+        like paths: the directory is gone once there's nothing in it.
+        """
+        keys = list(self._list(self._key(dirpath) + u'/'))
+        if not keys:
+            return True
+        if not recursive:
+            return False
+        return not self._delete_keys(keys)
+
+
+class _S3Writer(object):
+    """
+    A temporary file which is stored at filepath when closed
+    """
+    def __init__(self, storage, filepath):
+        self.storage = storage
+        self.filepath = filepath
+        self.file = tempfile.NamedTemporaryFile()
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+    def close(self):
+        if self.file.closed:
+            return
+        try:
+            self.file.flush()
+            self.storage.copy_local_to_storage(self.file.name, self.filepath)
+        finally:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
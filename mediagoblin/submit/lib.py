@@ -24,7 +24,7 @@ from werkzeug.utils import secure_filename
 from werkzeug.datastructures import FileStorage
 
 from mediagoblin import mg_globals
-from mediagoblin.tools.response import json_response
+from mediagoblin.tools.response import json_response, json_error
 from mediagoblin.tools.text import convert_to_tag_list_of_dicts
 from mediagoblin.tools.federation import create_activity, create_generator
 from mediagoblin.db.models import MediaEntry, ProcessingMetaData
@@ -99,6 +99,84 @@ class UserPastUploadLimit(UploadLimitError):
     pass
 
 
+# Uploads are copied into the queue this many bytes at a time, so that no
+# more than one chunk of a (possibly huge) upload is ever held in memory.
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+def copy_upload_to_queue(submitted_file, queue_file,
+                         max_file_size=None, upload_limit=None, uploaded=0,
+                         offset=0, chunk_size=UPLOAD_CHUNK_SIZE):
+    """
+    Copy submitted_file into queue_file in bounded chunks.
+
+    Raises FileUploadLimit or UserUploadLimit as soon as the copied data
+    goes over max_file_size or over what is left of the user's
+    upload_limit, without reading the rest of the upload.
+
+    Args:
+     - max_file_size: maximum size of the file, in megabytes
+     - upload_limit: the user's upload limit, in megabytes
+     - uploaded: megabytes the user has uploaded so far
+     - offset: bytes of this file already in the queue (for resumed
+       uploads), which count towards the limits as well
+
+    Returns the total size of the queued file in bytes.
+    """
+    max_bytes = None
+    if max_file_size:
+        max_bytes = max_file_size * 1024 * 1024
+
+    remaining_bytes = None
+    if upload_limit:
+        remaining_bytes = (upload_limit - uploaded) * 1024 * 1024
+
+    file_size = offset
+    while True:
+        chunk = submitted_file.read(chunk_size)
+        if not chunk:
+            break
+
+        file_size += len(chunk)
+        if max_bytes is not None and file_size >= max_bytes:
+            raise FileUploadLimit()
+        if remaining_bytes is not None and file_size >= remaining_bytes:
+            raise UserUploadLimit()
+
+        queue_file.write(chunk)
+
+    return file_size
+
+
+def open_queued_file(mg_app, entry):
+    """
+    Open the queued file of entry for reading.
+
+    For local queue stores this is the file on disk, so sniffers can read
+    it in place instead of making a copy of their own.
+    """
+    queue_store = mg_app.queue_store
+    if queue_store.local_storage:
+        return open(queue_store.get_local_path(entry.queued_media_file), 'rb')
+    return queue_store.get_file(entry.queued_media_file, 'rb')
+
+
+def discard_queued_file(mg_app, entry):
+    """
+    Remove the queued file of an aborted upload, and its task directory
+    """
+    queued_filepath = entry.queued_media_file
+    if not queued_filepath:
+        return
+
+    try:
+        mg_app.queue_store.delete_file(queued_filepath)
+        mg_app.queue_store.delete_dir(queued_filepath[:-1])
+    except Exception:
+        _log.exception('Could not remove queued file %r', queued_filepath)
+    entry.queued_media_file = []
+
+
 
 def submit_media(mg_app, user, submitted_file, filename,
                  title=None, description=None,
@@ -133,12 +211,38 @@ def submit_media(mg_app, user, submitted_file, filename,
     if not all(ord(c) < 128 for c in filename):
         filename = six.text_type(uuid.uuid4()) + splitext(filename)[-1]
 
-    # Sniff the submitted media to determine which
-    # media plugin should handle processing
-    media_type, media_manager = sniff_media(submitted_file, filename)
+    entry = new_upload_entry(user)
+    queue_file = prepare_queue_task(mg_app, entry, filename)
+
+    try:
+        # Stream the upload into the queue, bailing out as soon as it
+        # goes over any limit
+        with queue_file:
+            file_size = copy_upload_to_queue(
+                submitted_file, queue_file,
+                max_file_size=max_file_size, upload_limit=upload_limit,
+                uploaded=user.uploaded)
+
+        # Sniff the queued media to determine which
+        # media plugin should handle processing
+        with open_queued_file(mg_app, entry) as queued_file:
+            media_type, media_manager = sniff_media(queued_file, filename)
+
+        # Get file size and round to 2 decimal places
+        file_size = float('{0:.2f}'.format(file_size / (1024.0 * 1024)))
+
+        # Check if file size is over the limit
+        if max_file_size and file_size >= max_file_size:
+            raise FileUploadLimit()
+
+        # Check if user is over upload limit
+        if upload_limit and (user.uploaded + file_size) >= upload_limit:
+            raise UserUploadLimit()
+    except BaseException:
+        discard_queued_file(mg_app, entry)
+        raise
 
     # create entry and save in database
-    entry = new_upload_entry(user)
     entry.media_type = media_type
     entry.title = (title or six.text_type(splitext(filename)[0]))
 
@@ -154,24 +258,6 @@ def submit_media(mg_app, user, submitted_file, filename,
     # Generate a slug from the title
     entry.generate_slug()
 
-    queue_file = prepare_queue_task(mg_app, entry, filename)
-
-    with queue_file:
-        queue_file.write(submitted_file.read())
-
-    # Get file size and round to 2 decimal places
-    file_size = mg_app.queue_store.get_file_size(
-        entry.queued_media_file) / (1024.0 * 1024)
-    file_size = float('{0:.2f}'.format(file_size))
-
-    # Check if file size is over the limit
-    if max_file_size and file_size >= max_file_size:
-        raise FileUploadLimit()
-
-    # Check if user is over upload limit
-    if upload_limit and (user.uploaded + file_size) >= upload_limit:
-        raise UserUploadLimit()
-
     user.uploaded = user.uploaded + file_size
     user.save()
 
@@ -269,19 +355,67 @@ def run_process_media(entry, feed_url=None,
         raise
 
 
-def api_upload_request(request, file_data, entry):
-    """ This handles a image upload request """
-    # Use the same kind of method from mediagoblin/submit/views:submit_start
-    entry.title = file_data.filename
+def api_upload_request(request, file_data, entry, content_range=None):
+    """ This handles a image upload request
 
-    # This will be set later but currently we just don't have enough information
-    entry.slug = None
+    The upload is streamed into the queue from file_data.  If content_range
+    (a werkzeug ContentRange) is given, file_data is only one chunk of a
+    resumable upload: chunks are appended to the queued file, and until the
+    last one has arrived the response only reports the upload_id and how
+    many bytes have been received so far.
+    """
+    upload_limit, max_file_size = get_upload_file_limits(request.user)
+    if upload_limit and request.user.uploaded >= upload_limit:
+        raise UserPastUploadLimit()
+
+    if content_range is not None and max_file_size and \
+            content_range.length >= max_file_size * 1024 * 1024:
+        raise FileUploadLimit()
+
+    if entry.queued_media_file:
+        # Resuming an upload, carry on where the last chunk stopped
+        received = request.app.queue_store.get_file_size(
+            entry.queued_media_file)
+        if content_range is None or content_range.start != received:
+            return json_error(
+                "Upload should resume at byte {0}.".format(received),
+                status=409)
+        queue_file = request.app.queue_store.get_file(
+            entry.queued_media_file, 'ab')
+    else:
+        if content_range is not None and content_range.start != 0:
+            return json_error("Upload should start at byte 0.", status=409)
+
+        # Use the same kind of method from mediagoblin/submit/views:submit_start
+        entry.title = file_data.filename
 
-    queue_file = prepare_queue_task(request.app, entry, file_data.filename)
-    with queue_file:
-        queue_file.write(request.data)
+        # This will be set later but currently we just don't have enough
+        # information
+        entry.slug = None
+
+        received = 0
+        queue_file = prepare_queue_task(
+            request.app, entry, file_data.filename)
+
+    try:
+        with queue_file:
+            received = copy_upload_to_queue(
+                file_data.stream, queue_file,
+                max_file_size=max_file_size, upload_limit=upload_limit,
+                uploaded=request.user.uploaded, offset=received)
+    except UploadLimitError:
+        discard_queued_file(request.app, entry)
+        if entry.id is not None:
+            entry.delete()
+        raise
 
     entry.save()
+
+    if content_range is not None and received < content_range.length:
+        return json_response(
+            {"upload_id": entry.queued_task_id, "received": received},
+            status=202)
+
     return json_response(entry.serialize(request))
 
 def api_add_to_feed(request, entry):
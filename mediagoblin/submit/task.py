@@ -16,9 +16,26 @@
 
 import celery
 import datetime
+import logging
 import pytz
 
-from mediagoblin.db.models import MediaEntry
+from mediagoblin import mg_globals as mgg
+from mediagoblin.db.models import MediaEntry, PendingDeletion
+from mediagoblin.tools.files import delete_queued_files_later, \
+    queue_file_deletions
+
+_log = logging.getLogger(__name__)
+
+# How many media entries to delete per transaction when collecting garbage
+GARBAGE_BATCH_SIZE = 100
+
+# How many queued files to delete per storage request and transaction
+DELETION_BATCH_SIZE = 500
+
+# How many periodic runs of delete_queued_files try deleting a file before
+# giving up on it
+DELETION_MAX_ATTEMPTS = 5
+
 
 @celery.task()
 def collect_garbage():
@@ -34,5 +51,81 @@ def collect_garbage():
     garbage = MediaEntry.query.filter(MediaEntry.created < cuttoff)
     garbage = garbage.filter(MediaEntry.state == "unprocessed")
 
-    for entry in garbage.all():
-        entry.delete()
+    # Go through the garbage in batches, by id, and commit each batch, so
+    # neither the entries nor the transaction grow without bounds
+    last_id = 0
+    while True:
+        entries = garbage.filter(MediaEntry.id > last_id).order_by(
+            MediaEntry.id).limit(GARBAGE_BATCH_SIZE).all()
+        if not entries:
+            break
+
+        last_id = entries[-1].id
+        for entry in entries:
+            # The upload was never processed, so is still in the queue
+            if entry.queued_media_file:
+                queue_file_deletions(
+                    entry._session, [entry.queued_media_file], store=u'queue')
+            entry.delete(commit=False)
+        mgg.database.commit()
+
+    delete_queued_files_later()
+
+
+def _delete_batch(batch, count_attempts):
+    """
+    Delete the files of the PendingDeletions in batch, and return how many
+    could not be deleted.  If count_attempts, files which could not be
+    deleted DELETION_MAX_ATTEMPTS times are given up on.
+    """
+    stores = {u'public': mgg.public_store, u'queue': mgg.queue_store}
+    failed = 0
+    for store in set(pending.store for pending in batch):
+        pending_here = [pending for pending in batch if pending.store == store]
+        not_deleted = set(
+            tuple(filepath) for filepath in stores[store].delete_files(
+                [pending.filepath for pending in pending_here]))
+
+        for pending in pending_here:
+            if tuple(pending.filepath) not in not_deleted:
+                pending.delete(commit=False)
+                continue
+
+            if count_attempts:
+                pending.attempts += 1
+                if pending.attempts >= DELETION_MAX_ATTEMPTS:
+                    _log.error('Giving up on deleting {0}'.format(pending))
+                    pending.delete(commit=False)
+                    continue
+            failed += 1
+    return failed
+
+
+@celery.task()
+def delete_queued_files(count_attempts=False):
+    """
+    Delete the files queued for deletion (see
+    mediagoblin.tools.files.delete_media_files), in batches of
+    DELETION_BATCH_SIZE, each with one bulk delete per store.
+
+    Files which could not be deleted stay queued for the periodic run of
+    this task, which counts its attempts (see
+    mediagoblin.init.celery.get_celery_settings_dict).  Runs started
+    right after something was deleted don't, so a storage which is down
+    for a moment doesn't use up the attempts of every file.
+    """
+    failed = 0
+    last_id = 0
+    while True:
+        batch = PendingDeletion.query.filter(
+            PendingDeletion.id > last_id).order_by(
+            PendingDeletion.id).limit(DELETION_BATCH_SIZE).all()
+        if not batch:
+            break
+
+        last_id = batch[-1].id
+        failed += _delete_batch(batch, count_attempts)
+        mgg.database.commit()
+
+    if failed:
+        _log.warn('Could not delete {0} files, retrying later'.format(failed))
@@ -41,3 +41,12 @@ GOOD_JPG = resource_exif('good.jpg')
 EMPTY_JPG = resource_exif('empty.jpg')
 BAD_JPG = resource_exif('bad.jpg')
 GPS_JPG = resource_exif('has-gps.jpg')
+
+
+def resource_stl(f):
+    return resource_filename('mediagoblin.tests', 'test_stl/' + f)
+
+
+STL_BINARY = resource_stl('tetrahedron.stl')
+STL_ASCII = resource_stl('tetrahedron-ascii.stl')
+STL_OBJ = resource_stl('tetrahedron.obj')
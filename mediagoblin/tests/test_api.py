@@ -25,7 +25,9 @@ from webtest import AppError
 
 from .resources import GOOD_JPG
 from mediagoblin import mg_globals
-from mediagoblin.db.models import User, MediaEntry, MediaComment
+from mediagoblin.db import models
+from mediagoblin.db.models import User, MediaEntry, MediaComment, Activity, \
+    ActivityCount
 from mediagoblin.tools.routing import extract_url_arguments
 from mediagoblin.tests.tools import fixture_add_user
 from mediagoblin.moderation.tools import take_away_privileges
@@ -129,6 +131,48 @@ class TestAPI(object):
         response, _ = self._post_image_to_feed(test_app, image)
         assert response.status_code == 200
 
+    def test_resumable_upload(self, test_app):
+        """ Test that an image can be uploaded in several chunks """
+        data = open(GOOD_JPG, "rb").read()
+        middle = len(data) // 2
+        url = "/api/user/{0}/uploads".format(self.active_user.username)
+
+        def headers(start, end):
+            return {
+                "Content-Type": "image/jpeg",
+                "Content-Range": "bytes {0}-{1}/{2}".format(
+                    start, end - 1, len(data))
+            }
+
+        with self.mock_oauth():
+            response = test_app.post(
+                url, data[:middle], headers=headers(0, middle))
+            assert response.status_code == 202
+            upload = json.loads(response.body.decode())
+            assert upload["received"] == middle
+            resume_url = "{0}?upload_id={1}".format(url, upload["upload_id"])
+
+            # Sending a chunk from the wrong offset tells us where to resume
+            with pytest.raises(AppError) as excinfo:
+                test_app.post(
+                    resume_url,
+                    data[middle + 1:],
+                    headers=headers(middle + 1, len(data)))
+            assert "409" in excinfo.value.args[0]
+
+            response = test_app.post(
+                resume_url,
+                data[middle:],
+                headers=headers(middle, len(data)))
+            assert response.status_code == 200
+            image = json.loads(response.body.decode())
+
+        assert image["objectType"] == "image"
+        entry = MediaEntry.query.filter_by(
+            queued_task_id=upload["upload_id"]).first()
+        queue_store = mg_globals.queue_store
+        assert queue_store.get_file_size(entry.queued_media_file) == len(data)
+
     def test_unable_to_upload_as_someone_else(self, test_app):
         """ Test that can't upload as someoen else """
         data = open(GOOD_JPG, "rb").read()
@@ -598,3 +642,70 @@ class TestAPI(object):
 
         assert model.content == activity["object"]["content"]
 
+
+    def test_feed_paging(self, test_app):
+        """ Test paging through the feed with the before and since links """
+        for i in range(3):
+            response, data = self._upload_image(test_app, GOOD_JPG)
+            self._post_image_to_feed(test_app, data)
+
+        activities = [str(activity.id) for activity in
+                      Activity.query.filter_by(actor=self.user.id).order_by(
+                          Activity.published.desc(), Activity.id.desc())]
+
+        def get_feed(uri):
+            with self.mock_oauth():
+                response = test_app.get(uri)
+            return json.loads(response.body.decode())
+
+        uri = "/api/user/{0}/feed".format(self.user.username)
+        first = get_feed(uri + "?count=2")
+        assert first["totalItems"] == len(activities)
+        assert [item["id"].split("/")[-2] for item in first["items"]] == \
+            activities[:2]
+
+        second = get_feed(first["links"]["next"]["href"])
+        assert [item["id"].split("/")[-2] for item in second["items"]] == \
+            activities[2:4]
+
+        # Going back from the second page gives the first one again
+        assert get_feed(second["links"]["prev"]["href"])["items"] == \
+            first["items"]
+
+        # Only the posts are in the major feed
+        major = get_feed(uri + "/major/")
+        assert major["totalItems"] == 3
+        assert [item["verb"] for item in major["items"]] == ["post"] * 3
+
+        with self.mock_oauth():
+            with pytest.raises(AppError) as excinfo:
+                test_app.get(uri + "?before=nonsense")
+        assert "400 BAD REQUEST" in excinfo.value.args[0]
+
+    def test_activity_counts(self, test_app, monkeypatch):
+        """ Test totalItems is kept up to date as activities come and go """
+        # Someone else adds the count at the same time
+        add_activity_count = models._add_activity_count
+
+        def racing_add_activity_count(connection, actor, verb):
+            connection.execute(ActivityCount.__table__.insert().values(
+                actor=actor, verb=verb, count=0))
+            add_activity_count(connection, actor, verb)
+        monkeypatch.setattr(
+            models, "_add_activity_count", racing_add_activity_count)
+
+        response, data = self._upload_image(test_app, GOOD_JPG)
+        response, data = self._post_image_to_feed(test_app, data)
+        monkeypatch.undo()
+
+        def total_items(uri):
+            with self.mock_oauth():
+                response = test_app.get(uri)
+            return json.loads(response.body.decode())["totalItems"]
+
+        uri = "/api/user/{0}/feed/major/".format(self.user.username)
+        assert total_items(uri) == 1
+
+        Activity.query.filter_by(actor=self.user.id, verb=u"post").one()\
+            .delete()
+        assert total_items(uri) == 0
@@ -0,0 +1,252 @@
+# GNU MediaGoblin -- federated, autonomous media hosting
+# Copyright (C) 2011, 2012 MediaGoblin contributors.  See AUTHORS.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+
+import pytest
+
+numpy = pytest.importorskip('numpy')
+try:
+    from mediagoblin.media_types.audio import audioprocessing, processing
+except Exception:
+    # The audio media type needs GStreamer 0.10 (and says so with an
+    # Exception, not an ImportError)
+    pytest.skip('The audio media type is not available',
+                allow_module_level=True)
+
+from mediagoblin import mg_globals
+from mediagoblin.processing import FilenameBuilder
+from mediagoblin.tests.tools import fixture_media_entry
+
+HEIGHT = 21
+FFT_SIZE = 256
+SAMPLERATE = 44100
+
+
+def _signal(frames=50000):
+    """
+    Stereo frames of two tones and some noise, getting louder, with
+    silence at the end
+    """
+    t = numpy.arange(frames) / float(SAMPLERATE)
+    left = (0.6 * numpy.sin(2 * numpy.pi * 440 * t) +
+            0.2 * numpy.sin(2 * numpy.pi * 3000 * t) +
+            0.1 * numpy.random.RandomState(1).uniform(-1, 1, frames))
+    left *= numpy.linspace(0.1, 1, frames)
+    left[-frames // 10:] = 0
+    right = numpy.random.RandomState(2).uniform(-1, 1, frames)
+    return numpy.column_stack([left, right])
+
+
+class FakeSndfile(object):
+    """
+    Like audiolab.Sndfile, reading from an array of frames
+    """
+    samplerate = SAMPLERATE
+
+    def __init__(self, frames):
+        self.frames = frames
+        self.nframes = len(frames)
+        self.channels = frames.shape[1]
+        self.position = 0
+
+    def seek(self, position):
+        self.position = position
+
+    def read_frames(self, count):
+        frames = self.frames[self.position:self.position + count]
+        self.position += count
+        return frames.copy()
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def fake_audiolab(monkeypatch):
+    frames = _signal()
+
+    class FakeAudiolab(object):
+        @staticmethod
+        def Sndfile(filename, mode):
+            return FakeSndfile(frames)
+
+    monkeypatch.setattr(audioprocessing, 'audiolab', FakeAudiolab,
+                        raising=False)
+    return frames
+
+
+def _image_data(image):
+    return numpy.asarray(image.convert('RGB'))
+
+
+def _reference(processor, width):
+    """
+    The centroids, peaks and images of AudioProcessor, column by column
+    like create_wave_images used to
+    """
+    samples_per_pixel = processor.audio_file.nframes / float(width)
+    waveform = audioprocessing.WaveformImage(width, HEIGHT)
+    spectrogram = audioprocessing.SpectrogramImage(width, HEIGHT, FFT_SIZE)
+
+    centroids = []
+    peaks = []
+    for x in range(width):
+        seek_point = int(x * samples_per_pixel)
+        next_seek_point = int((x + 1) * samples_per_pixel)
+
+        (centroid, db_spectrum) = processor.spectral_centroid(seek_point)
+        centroids.append(centroid)
+        peaks.append(processor.peaks(seek_point, next_seek_point))
+
+        waveform.draw_peaks(x, peaks[-1], centroid)
+        spectrogram.draw_spectrum(x, db_spectrum)
+
+    spectrogram.image.putdata(spectrogram.pixels)
+    return (centroids, peaks, _image_data(waveform.image),
+            _image_data(spectrogram.image.transpose(
+                audioprocessing.Image.ROTATE_90)))
+
+
+def _batched(processor, width):
+    (centroids, db_spectra) = processor.spectral_centroids(width)
+    peaks = processor.peaks(width)
+
+    waveform = audioprocessing.WaveformImage(width, HEIGHT)
+    for x, column_peaks in enumerate(peaks):
+        waveform.draw_peaks(x, column_peaks, centroids[x])
+    spectrogram = audioprocessing.SpectrogramImage(width, HEIGHT, FFT_SIZE)
+    spectrogram.draw_spectra(db_spectra)
+
+    return (centroids, peaks, _image_data(waveform.image),
+            _image_data(spectrogram.spectra_image))
+
+
+def _processors(tmpdir, width):
+    return (
+        _reference(audioprocessing.AudioProcessor('sound.wav', FFT_SIZE),
+                   width),
+        _batched(audioprocessing.BatchAudioProcessor(
+            'sound.wav', FFT_SIZE, tmp_dir=str(tmpdir)), width))
+
+
+def test_batch_audio_processor(fake_audiolab, tmpdir):
+    reference, batched = _processors(tmpdir, 40)
+
+    # The silence at the end has no centroid
+    assert reference[0][-1] == 0
+    assert numpy.allclose(batched[0], reference[0])
+    assert numpy.allclose(batched[1], reference[1])
+    assert (batched[2] == reference[2]).all()
+    assert (batched[3] == reference[3]).all()
+
+
+def test_batch_audio_processor_long_columns(fake_audiolab, tmpdir):
+    # AudioProcessor.peaks() reads whole blocks of 4096 frames, so for
+    # longer columns it also looks at (some of) the next column
+    reference, batched = _processors(tmpdir, 8)
+
+    assert numpy.allclose(batched[0], reference[0])
+    assert (batched[3] == reference[3]).all()
+
+    left = fake_audiolab[:, 0]
+    for x, peaks in enumerate(batched[1]):
+        column = left[x * len(left) // 8:(x + 1) * len(left) // 8]
+        assert sorted(peaks) == [column.min(), column.max()]
+
+
+def _write_pcm(frames, filename):
+    with open(filename, 'wb') as pcm_file:
+        pcm_file.write(frames.astype(audioprocessing.PCM_DTYPE).tobytes())
+
+
+def test_batch_audio_processor_pcm(fake_audiolab, tmpdir):
+    pcm_filename = str(tmpdir.join('sound.pcm'))
+    _write_pcm(fake_audiolab, pcm_filename)
+
+    decoded = audioprocessing.BatchAudioProcessor(
+        'sound.wav', FFT_SIZE, tmp_dir=str(tmpdir))
+    mapped = audioprocessing.BatchAudioProcessor(
+        pcm_filename, FFT_SIZE, samplerate=SAMPLERATE)
+
+    # Only the left channel, straight from the file
+    assert isinstance(mapped.samples, numpy.memmap)
+    assert mapped.nframes == len(fake_audiolab)
+    assert numpy.allclose(mapped.samples, fake_audiolab[:, 0], atol=1e-6)
+
+    # ... which is as good as decoding it, up to the precision of floats
+    for (mapped_part, decoded_part) in zip(
+            mapped.spectral_centroids(40), decoded.spectral_centroids(40)):
+        assert numpy.allclose(mapped_part, decoded_part, atol=1e-4)
+    assert numpy.allclose(mapped.peaks(40), decoded.peaks(40), atol=1e-6)
+
+
+class FakeTranscoder(object):
+    """
+    Decodes anything into the PCM of frames
+    """
+    def __init__(self, frames):
+        self.frames = frames
+        self.decoded = []
+
+    def discover(self, src):
+        class Data(object):
+            audiorate = SAMPLERATE
+        return Data()
+
+    def decode(self, src, pcm_dst, data=None):
+        _write_pcm(self.frames, pcm_dst)
+        self.decoded.append(pcm_dst)
+
+
+def test_spectrogram_from_pcm(test_app, fake_audiolab, tmpdir, monkeypatch):
+    monkeypatch.setattr(mg_globals, 'derivative_cache', None)
+
+    class FakeWorkbench(object):
+        dir = str(tmpdir)
+
+    entry = fixture_media_entry(fake_upload=False, expunge=False)
+    processor = processing.CommonAudioProcessor(None, entry)
+    processor.workbench = FakeWorkbench()
+    processor.audio_config = {'spectrogram_fft_size': FFT_SIZE}
+    processor.process_filename = str(tmpdir.join('sound.ogg'))
+    processor.name_builder = FilenameBuilder(processor.process_filename)
+    processor.transcoder = FakeTranscoder(fake_audiolab)
+    processor.thumbnailer = processing.AudioThumbnailer()
+    processor.pcm_tmp = None
+    processor.pcm_samplerate = None
+
+    processor.create_spectrogram(max_width=100)
+
+    # Decoded for the spectrogram, and removed again
+    pcm_filename, = processor.transcoder.decoded
+    assert not os.path.exists(pcm_filename)
+    assert processor.pcm_tmp is None
+
+    spectrogram = audioprocessing.Image.open(
+        mg_globals.public_store.get_local_path(
+            entry.media_files['spectrogram']))
+    assert spectrogram.size == (100, 30)
+    assert numpy.asarray(spectrogram).any()
+
+    # Decoded PCM kept for a spectrogram that is already there is removed
+    # too
+    processor.pcm_tmp = pcm_filename
+    _write_pcm(fake_audiolab, pcm_filename)
+    processor.create_spectrogram(max_width=100)
+    assert not os.path.exists(pcm_filename)
+    assert processor.pcm_tmp is None
+    assert len(processor.transcoder.decoded) == 1
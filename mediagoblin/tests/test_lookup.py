@@ -0,0 +1,71 @@
+# GNU MediaGoblin -- federated, autonomous media hosting
+# Copyright (C) 2011, 2012 MediaGoblin contributors.  See AUTHORS.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from sqlalchemy import event
+
+from mediagoblin import mg_globals
+from mediagoblin.db.base import Session
+from mediagoblin.db.lookup import RequestLookups, SharedLookupCache
+from mediagoblin.db.models import User
+from mediagoblin.tests.tools import fixture_add_user
+
+
+class TestLookups(object):
+    def _setup(self, monkeypatch):
+        self.user_id = fixture_add_user(u'lookedup').id
+        Session.remove()
+
+        self.statements = []
+
+        def count(conn, cursor, statement, *args):
+            self.statements.append(statement)
+        event.listen(mg_globals.database.engine, 'before_cursor_execute',
+                     count)
+
+        self.shared = SharedLookupCache(60)
+        monkeypatch.setattr(mg_globals, 'lookup_cache', self.shared)
+
+    def test_request_lookups(self, test_app, monkeypatch):
+        self._setup(monkeypatch)
+        lookups = RequestLookups()
+        user = lookups.first(User, username=u'lookedup')
+        queries = len(self.statements)
+        assert lookups.first(User, username=u'lookedup') is user
+        assert lookups.first(User, id=self.user_id) is user
+        assert lookups.first(User, username=u'nobody') is None
+        assert lookups.first(User, username=u'nobody') is None
+        assert len(self.statements) == queries + 1
+
+    def test_shared_lookups(self, test_app, monkeypatch):
+        self._setup(monkeypatch)
+        RequestLookups(self.shared).first(User, username=u'lookedup')
+        Session.remove()
+
+        # A later request finds the user without asking the database
+        del self.statements[:]
+        user = RequestLookups(self.shared).first(
+            User, username=u'lookedup')
+        assert user.id == self.user_id
+        assert user.username == u'lookedup'
+        assert self.statements == []
+
+        # Saving the user drops it from the shared cache
+        user.bio = u'Changed'
+        user.save()
+        Session.remove()
+        user = RequestLookups(self.shared).first(
+            User, username=u'lookedup')
+        assert user.bio == u'Changed'
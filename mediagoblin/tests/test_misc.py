@@ -19,12 +19,17 @@ import datetime
 
 from werkzeug.datastructures import FileStorage
 
+import six
+
 from .resources import GOOD_JPG
+from mediagoblin import mg_globals
 from mediagoblin.db.base import Session
 from mediagoblin.media_types import sniff_media
 from mediagoblin.submit.lib import new_upload_entry
-from mediagoblin.submit.task import collect_garbage
-from mediagoblin.db.models import User, MediaEntry, MediaComment
+from mediagoblin.submit.task import (
+    collect_garbage, delete_queued_files, DELETION_MAX_ATTEMPTS)
+from mediagoblin.db.models import (
+    User, MediaEntry, MediaComment, PendingDeletion)
 from mediagoblin.tests.tools import fixture_add_user, fixture_media_entry
 
 
@@ -101,6 +106,57 @@ def test_media_deletes_broken_attachment(test_app):
     MediaEntry.query.get(media.id).delete()
     User.query.get(user_a.id).delete()
 
+def test_media_delete_queues_files(test_app):
+    user = fixture_add_user(u"deleter")
+    media = fixture_media_entry(uploader=user.id, fake_upload=False,
+                                expunge=False)
+    filepaths = [[u'media_entries', six.text_type(media.id), name]
+                 for name in (u'original.jpg', u'thumb.jpg')]
+    for key, filepath in zip((u'original', u'thumb'), filepaths):
+        with mg_globals.public_store.get_file(filepath, 'wb') as our_file:
+            our_file.write(b'media')
+        media.media_files[key] = filepath
+    media.save()
+
+    # Until the deletion is committed, the files are only queued
+    MediaEntry.query.get(media.id).delete(commit=False)
+    assert sorted(list(pending.filepath)
+                  for pending in PendingDeletion.query) == filepaths
+    assert all(mg_globals.public_store.file_exists(filepath)
+               for filepath in filepaths)
+
+    Session.commit()
+    delete_queued_files.apply_async()
+    assert PendingDeletion.query.count() == 0
+    assert not any(mg_globals.public_store.file_exists(filepath)
+                   for filepath in filepaths)
+
+
+def test_delete_queued_files_retries(test_app, monkeypatch):
+    Session.add(PendingDeletion(filepath=[u'undeletable']))
+    Session.commit()
+
+    attempts = []
+    def delete_files(filepaths):
+        attempts.append(filepaths)
+        return filepaths
+    monkeypatch.setattr(mg_globals.public_store, 'delete_files', delete_files)
+
+    # Runs started by deletions don't use up the attempts
+    for i in range(DELETION_MAX_ATTEMPTS):
+        delete_queued_files.apply_async()
+    assert len(attempts) == DELETION_MAX_ATTEMPTS
+    assert PendingDeletion.query.one().attempts == 0
+
+    # ... the periodic runs do, and give up after enough of them
+    for i in range(DELETION_MAX_ATTEMPTS - 1):
+        delete_queued_files.apply_async(kwargs={'count_attempts': True})
+        assert PendingDeletion.query.one().attempts == i + 1
+    delete_queued_files.apply_async(kwargs={'count_attempts': True})
+    assert attempts == [[(u'undeletable',)]] * (2 * DELETION_MAX_ATTEMPTS)
+    assert PendingDeletion.query.count() == 0
+
+
 def test_garbage_collection_task(test_app):
     """ Test old media entry are removed by GC task """
     user = fixture_add_user()
@@ -122,6 +178,10 @@ def test_garbage_collection_task(test_app):
     entry.slug = "slugy-slug-slug"
     entry.media_type = 'image'
     entry.created = now - datetime.timedelta(days=2)
+    entry.queued_media_file = [u'media_entries', u'garbage', u'mah_test.jpg']
+    with mg_globals.queue_store.get_file(
+            entry.queued_media_file, 'wb') as queue_file:
+        queue_file.write(b'garbage')
     entry.save()
 
     # Validate the model exists
@@ -130,5 +190,47 @@ def test_garbage_collection_task(test_app):
     # Call the garbage collection task
     collect_garbage()
 
-    # Now validate the image has been deleted
+    # Now validate the image and its queued file have been deleted
     assert MediaEntry.query.filter_by(id=entry_id).first() is None
+    assert not mg_globals.queue_store.file_exists(
+        [u'media_entries', u'garbage', u'mah_test.jpg'])
+
+
+def test_cached_atom_feed(test_app):
+    user = fixture_add_user(u'feedy', privileges=[u'active'])
+    entry = fixture_media_entry(
+        title=u'First title', uploader=user.id, state=u'processed',
+        expunge=False)
+
+    res = test_app.get('/u/feedy/atom/')
+    assert 'First title' in res.body
+    etag = res.headers['ETag']
+
+    # Nothing new for feed readers that know the feed
+    res = test_app.get('/u/feedy/atom/', headers={'If-None-Match': etag})
+    assert res.status_int == 304
+    assert res.headers['ETag'] == etag
+    assert 'First title' in test_app.get('/u/feedy/').body
+
+    # Editing an entry changes the feed and the thumbnail grid
+    entry.title = u'Second title'
+    entry.save()
+    res = test_app.get('/u/feedy/atom/', headers={'If-None-Match': etag})
+    assert res.status_int == 200
+    assert 'Second title' in res.body
+    assert res.headers['ETag'] != etag
+
+    res = test_app.get('/u/feedy/')
+    assert 'Second title' in res.body
+
+    # Query strings don't make other feeds
+    etag = test_app.get('/u/feedy/atom/').headers['ETag']
+    res = test_app.get('/u/feedy/atom/?nonsense=1')
+    assert res.headers['ETag'] == etag
+    assert '?nonsense' not in res.body
+
+    # Only the ETag can tell the feed hasn't changed
+    assert 'Last-Modified' not in res.headers
+    res = test_app.get('/u/feedy/atom/', headers={
+        'If-Modified-Since': 'Fri, 01 Jan 2100 00:00:00 GMT'})
+    assert res.status_int == 200
@@ -20,6 +20,7 @@
 from __future__ import print_function
 
 from mediagoblin.db.base import Session
+from mediagoblin.gmg_commands import rendermarkdown
 from mediagoblin.db.models import MediaEntry, User, Privilege, Activity, \
                                   Generator
 
@@ -213,6 +214,27 @@ def test_media_data_init(test_app):
     assert obj_in_session == 0
 
 
+def test_rendered_description(test_app):
+    media = fixture_media_entry(expunge=False)
+    media.description = u'Some **bold** text'
+    assert u'<strong>bold</strong>' in media.rendered_description
+    assert media.description_html == media.rendered_description
+
+    media.description = u'Some *other* text'
+    media.save()
+    assert u'<em>other</em>' in media.description_html
+
+    # Rows saved before rendered markdown was stored get rendered by
+    # "gmg rendermarkdown"
+    MediaEntry.query.filter_by(id=media.id).update(
+        {'rendered_description': None}, synchronize_session=False)
+    Session.commit()
+    assert rendermarkdown.render_rows(
+        Session, MediaEntry, 'description', 'rendered_description') == 1
+    assert u'<em>other</em>' in MediaEntry.query.get(
+        media.id).rendered_description
+
+
 class TestUserUrlForSelf(MGClientTestCase):
 
     usernames = [(u'lindsay', dict(privileges=[u'active']))]
@@ -0,0 +1,114 @@
+# GNU MediaGoblin -- federated, autonomous media hosting
+# Copyright (C) 2011, 2012 MediaGoblin contributors.  See AUTHORS.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+
+import pytest
+
+from mediagoblin.db.models import MediaEntry
+from mediagoblin.tests.tools import fixture_add_user, fixture_media_entry
+from mediagoblin.tools.pagination import (
+    KeysetPagination, encode_marker, decode_marker, get_pagination_marker)
+
+
+def test_marker_roundtrip():
+    created = datetime.datetime(2014, 3, 15, 12, 30, 45, 123456)
+    token = encode_marker(created, 42)
+    assert decode_marker(token) == (created, 42)
+
+    assert get_pagination_marker({u'after': token}) == (u'after', created, 42)
+    assert get_pagination_marker({}) is None
+
+    with pytest.raises(ValueError):
+        decode_marker(u'not-a-marker')
+    with pytest.raises(ValueError):
+        get_pagination_marker({u'before': token, u'after': token})
+
+
+class TestKeysetPagination(object):
+    def _setup(self):
+        user = fixture_add_user(u'pagey')
+        self.entry_ids = []
+        for i in range(7):
+            entry = fixture_media_entry(
+                title=u'Entry %d' % i, uploader=user.id,
+                state=u'processed')
+            self.entry_ids.append(entry.id)
+        # Newest first, as in the galleries
+        self.entry_ids.reverse()
+        self.cursor = MediaEntry.query.filter_by(state=u'processed')
+
+    def _marker(self, direction, entry):
+        return (direction, entry.created, entry.id)
+
+    def test_walk_with_markers(self, test_app):
+        self._setup()
+
+        first = KeysetPagination(1, self.cursor, per_page=3)
+        entries = first()
+        assert [e.id for e in entries] == self.entry_ids[:3]
+        assert not first.has_prev
+        assert first.has_next
+        assert first.pages == 3
+
+        second = KeysetPagination(
+            1, self.cursor, per_page=3,
+            marker=self._marker(u'after', entries[-1]))
+        entries = second()
+        assert [e.id for e in entries] == self.entry_ids[3:6]
+        assert second.has_prev and second.has_next
+        assert second.page == 2
+
+        third = KeysetPagination(
+            1, self.cursor, per_page=3,
+            marker=self._marker(u'after', entries[-1]))
+        assert [e.id for e in third()] == self.entry_ids[6:]
+        assert not third.has_next
+
+        back = KeysetPagination(
+            1, self.cursor, per_page=3,
+            marker=self._marker(u'before', third()[0]))
+        assert [e.id for e in back()] == self.entry_ids[3:6]
+
+    def test_short_before_page_falls_back_to_first(self, test_app):
+        self._setup()
+
+        entry = KeysetPagination(1, self.cursor, per_page=3)()[2]
+        back = KeysetPagination(
+            1, self.cursor, per_page=3,
+            marker=self._marker(u'before', entry))
+        assert [e.id for e in back()] == self.entry_ids[:3]
+        assert back.page == 1
+        assert not back.has_prev
+
+    def test_jump_to_id(self, test_app):
+        self._setup()
+
+        pagination = KeysetPagination(
+            1, self.cursor, per_page=3, jump_to_id=self.entry_ids[4])
+        assert pagination.page == 2
+        assert pagination.active_id == self.entry_ids[4]
+        assert self.entry_ids[4] in [e.id for e in pagination()]
+
+        ascending = KeysetPagination(
+            1, self.cursor, per_page=3, jump_to_id=self.entry_ids[4],
+            ascending=True)
+        assert ascending.page == 1
+
+
+def test_bad_marker_404s(test_app):
+    response = test_app.get('/?after=garbage', status=404)
+    assert response.status_int == 404
@@ -18,10 +18,16 @@ import collections
 import tempfile
 import shutil
 import os
+import socket
 import pytest
 
+from mediagoblin.media_types.pdf import pages, processing
+from mediagoblin.media_types.pdf.pages import evict_pages, page_key
+from mediagoblin.processing import BadMediaFail
 from mediagoblin.media_types.pdf.processing import (
-    pdf_info, check_prerequisites, create_pdf_thumb)
+    pdf_info, check_prerequisites, create_pdf_thumb, where,
+    unoconv_listener)
+from mediagoblin.tests.tools import fixture_add_user, fixture_media_entry
 from .resources import GOOD_PDF
 
 
@@ -44,3 +50,129 @@ def test_pdf():
     temp_dir = tempfile.mkdtemp()
     create_pdf_thumb(GOOD_PDF, os.path.join(temp_dir, 'good_256_256.png'), 256, 256)
     shutil.rmtree(temp_dir)
+
+
+def test_where_is_cached(tmpdir, monkeypatch):
+    tool = tmpdir.join('pdftool')
+    tool.write('')
+    monkeypatch.setenv('PATH', str(tmpdir))
+
+    assert where('pdftool') == str(tool)
+    tool.remove()
+    # Still found, until PATH changes
+    assert where('pdftool') == str(tool)
+
+    monkeypatch.setenv('PATH', os.pathsep.join([str(tmpdir), str(tmpdir)]))
+    assert where('pdftool') is None
+
+
+def test_unoconv_listener_waits(test_app, tmpdir, monkeypatch):
+    # A listener which keeps running, found before PATH is only tmpdir
+    unoconv = tmpdir.join('unoconv')
+    unoconv.write('#!/bin/sh\nexec {0} 30\n'.format(where('sleep')))
+    unoconv.chmod(0o755)
+    monkeypatch.setenv('PATH', str(tmpdir))
+
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    monkeypatch.setattr(processing, 'UNOCONV_LISTENER_ADDRESS',
+                        server.getsockname())
+    monkeypatch.setattr(processing, 'UNOCONV_LISTENER_STARTUP', 1)
+    monkeypatch.setattr(processing, '_listener',
+                        {'pid': None, 'process': None})
+    try:
+        # Running, but not accepting connections (yet), so it's stopped
+        assert not unoconv_listener()
+        assert processing._listener == {'pid': None, 'process': None}
+
+        server.listen(1)
+        assert unoconv_listener()
+        process = processing._listener['process']
+        assert unoconv_listener()
+        assert processing._listener['process'] is process
+
+        # Running, but it stopped accepting connections
+        server.close()
+        assert not unoconv_listener()
+        assert process.poll() is not None
+        assert processing._listener == {'pid': None, 'process': None}
+    finally:
+        processing._stop_unoconv_listener()
+        server.close()
+
+
+def _pdf_entry(pages):
+    user = fixture_add_user(u'pdfreader')
+    entry = fixture_media_entry(
+        uploader=user.id, state=u'processed', expunge=False)
+    entry.media_type = u'mediagoblin.media_types.pdf'
+    entry.media_data_init(pdf_pages=pages)
+    entry.save()
+    return entry
+
+
+def test_pdf_page_view(test_app):
+    entry = _pdf_entry(3)
+    entry.media_files[page_key(2)] = [u'media_entries', u'2', u'page-2.png']
+    entry.save()
+    url = '/u/pdfreader/m/' + entry.slug + '/page/{0}/'
+
+    response = test_app.get(url.format(1))
+    assert response.status_int == 302
+    assert response.location.endswith('/mgoblin_media/d/e/f.png')
+
+    response = test_app.get(url.format(2))
+    assert response.status_int == 302
+    assert response.location.endswith(
+        '/mgoblin_media/media_entries/2/page-2.png')
+
+    test_app.get(url.format(4), status=404)
+
+
+def test_pdf_page_rendered_once(test_app, monkeypatch):
+    entry = _pdf_entry(3)
+    entry_id = entry.id
+    url = '/u/pdfreader/m/' + entry.slug + '/page/{0}/'
+    dispatched = []
+    monkeypatch.setattr(pages.render_page, 'apply_async',
+                        lambda args: dispatched.append(args))
+
+    # Later requests wait for the page being rendered
+    for i in range(2):
+        assert test_app.get(url.format(2)).status_int == 202
+    assert dispatched == [[entry_id, 2]]
+
+    # ... unless that takes too long
+    monkeypatch.setattr(pages, 'RENDERING_TIMEOUT', -1)
+    assert test_app.get(url.format(2)).status_int == 202
+    assert len(dispatched) == 2
+
+
+def test_pdf_page_failed(test_app, monkeypatch):
+    entry = _pdf_entry(3)
+    url = '/u/pdfreader/m/' + entry.slug + '/page/{0}/'
+    rendered = []
+
+    def render_pages(*args, **kwargs):
+        rendered.append(kwargs['page'])
+        raise BadMediaFail()
+    monkeypatch.setattr(pages, 'render_pages', render_pages)
+
+    for i in range(2):
+        test_app.get(url.format(2), status=500)
+    assert rendered == [2]
+
+
+def test_evict_pages(test_app):
+    entry = _pdf_entry(10)
+    for page, last_viewed in [(2, 30), (3, 10), (4, 20)]:
+        entry.media_files[page_key(page)] = [u'nowhere', u'page.png']
+        entry.save()
+        entry.set_file_metadata(page_key(page), last_viewed=last_viewed)
+
+    evict_pages(entry, 2)
+    assert sorted(entry.media_files) == [
+        u'medium', u'original', page_key(2), page_key(4), u'thumb']
+
+    evict_pages(entry, 0)
+    assert sorted(entry.media_files) == [u'medium', u'original', u'thumb']
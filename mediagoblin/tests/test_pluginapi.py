@@ -304,6 +304,38 @@ def test_hook_transform():
         "expand_tuple", (-1, 0)) == (-1, 0, 1, 2, 3)
 
 
+@with_cleanup()
+def test_hook_dispatch_table():
+    """
+    Test memoizing pure hooks and the hook stats
+    """
+    call_log = []
+
+    def upper_ext(ext):
+        call_log.append(ext)
+        return ext.upper()
+
+    pman = pluginapi.PluginManager()
+    pman.register_hooks({'pure_test': upper_ext})
+    pluginapi.register_pure_hooks(['pure_test'])
+    pman.freeze_hooks()
+    pluginapi.enable_hook_stats()
+    try:
+        assert pluginapi.hook_handle('pure_test', 'jpg') == 'JPG'
+        assert pluginapi.hook_handle('pure_test', 'jpg') == 'JPG'
+        assert pluginapi.hook_handle('pure_test', 'png') == 'PNG'
+        assert call_log == ['jpg', 'png']
+        assert pluginapi.get_hook_stats()['pure_test'][0] == 3
+
+        # Registering more hooks forgets what was memoized
+        pman.register_hooks({'pure_test': lambda ext: None})
+        assert pluginapi.hook_handle('pure_test', 'jpg') == 'JPG'
+        assert call_log == ['jpg', 'png', 'jpg']
+    finally:
+        pluginapi.enable_hook_stats(False)
+        pluginapi.PURE_HOOKS.discard('pure_test')
+
+
 def test_plugin_config():
     """
     Make sure plugins can set up their own config
@@ -1,6 +1,16 @@
 #!/usr/bin/env python
 
+import os
+
+import pytest
+try:
+    from PIL import Image
+except ImportError:
+    import Image
+
 from mediagoblin import processing
+from mediagoblin.processing import cache
+from mediagoblin.tools import files
 
 class TestProcessing(object):
     def run_fill(self, input, format, output=None):
@@ -16,3 +26,137 @@ class TestProcessing(object):
     def test_long_filename_fill(self):
         self.run_fill('{0}.png'.format('A' * 300), 'image-{basename}{ext}',
                       'image-{0}.png'.format('A' * 245))
+
+
+def test_derivative_cache(tmpdir):
+    derivative_cache = cache.DerivativeCache(str(tmpdir.join('cache')), 10)
+
+    source = tmpdir.join('source.txt')
+    source.write('source')
+    derivative = tmpdir.join('derivative.txt')
+    derivative.write('12345')
+
+    key = derivative_cache.make_key(str(source), 'step', size=[1, 2])
+    assert key == derivative_cache.make_key(str(source), 'step', size=(1, 2))
+    assert key != derivative_cache.make_key(str(source), 'step', size=(2, 1))
+    assert key != derivative_cache.make_key(str(source), 'other', size=(1, 2))
+
+    dest = str(tmpdir.join('dest.txt'))
+    assert derivative_cache.get(key, dest) is None
+    derivative_cache.put(key, str(derivative), {'width': 3})
+    assert derivative_cache.get(key, dest) == {'width': 3}
+    assert open(dest).read() == '12345'
+
+    # Another 5 bytes still fit, but a third entry evicts the oldest one
+    os.utime(derivative_cache._entry_path(key), (0, 0))
+    other_keys = [derivative_cache.make_key(str(source), 'step', size=size)
+                  for size in (3, 4)]
+    for other_key in other_keys:
+        derivative_cache.put(other_key, str(derivative))
+
+    assert derivative_cache.get(key, dest) is None
+    assert all(derivative_cache.get(other_key, dest) == {}
+               for other_key in other_keys)
+
+
+def test_size_bounded_directory(tmpdir, monkeypatch):
+    size_bound = files.SizeBoundedDirectory(str(tmpdir), 10)
+
+    def add(name, mtime):
+        tmpdir.join(name).write('12345')
+        os.utime(str(tmpdir.join(name)), (mtime, mtime))
+        return size_bound.added(5)
+
+    assert add('first', 1) == []
+
+    # Until it's time to rescan, the size is kept as a running total
+    walks = []
+    real_walk = os.walk
+    monkeypatch.setattr(os, 'walk', lambda *args: walks.append(args) or
+                        real_walk(*args))
+    assert add('second', 2) == []
+    assert add('third', 3) == [str(tmpdir.join('first'))]
+    assert walks == []
+
+    # Something used since the last look isn't evicted
+    os.utime(str(tmpdir.join('second')), (4, 4))
+    assert add('fourth', 5) == [str(tmpdir.join('third'))]
+    assert sorted(os.listdir(str(tmpdir))) == ['fourth', 'second']
+
+
+def test_video_rendition_sizes():
+    util = pytest.importorskip('mediagoblin.media_types.video.util')
+
+    # Renditions are stored by height, so only one per height is made
+    assert util.rendition_sizes(
+        ['1280x720', '640x360', '480x360', 'big']) == [(640, 360), (1280, 720)]
+    assert util.rendition_key((640, 360)) == u'webm_360p'
+
+    metadata = {'videowidth': 1024, 'videoheight': 576}
+    assert util.rendition_fits(metadata, (640, 360))
+    assert not util.rendition_fits(metadata, (1280, 720))
+
+
+# Nanoseconds, like discover() gives the length of videos
+SECOND = 1000000000
+
+
+@pytest.mark.parametrize('videolength, boundaries', [
+    # An exact multiple of the segment length
+    (30 * SECOND, [(0, 10), (10, 20), (20, None)]),
+    # A short tail goes with the last segment
+    (35 * SECOND, [(0, 10), (10, 20), (20, None)]),
+    (39 * SECOND, [(0, 10), (10, 20), (20, None)]),
+    # ... a long one is a segment of its own
+    (41 * SECOND, [(0, 10), (10, 20), (20, 30), (30, None)]),
+    # Less than one or two segments long
+    (5 * SECOND, [(0, None)]),
+    (15 * SECOND, [(0, None)]),
+    (0, [(0, None)]),
+])
+def test_video_segment_boundaries(videolength, boundaries):
+    segments = pytest.importorskip('mediagoblin.media_types.video.segments')
+
+    assert segments.segment_boundaries(videolength, 10) == [
+        (start * SECOND, stop and stop * SECOND)
+        for start, stop in boundaries]
+
+
+def test_video_thumbnail_score():
+    transcoders = pytest.importorskip(
+        'mediagoblin.media_types.video.transcoders')
+
+    black = Image.new('RGB', (32, 32))
+    flat = Image.new('RGB', (32, 32), (0x80, 0x40, 0x20))
+    varied = Image.new('RGB', (32, 32))
+    varied.putdata([(x * 8, y * 8, (x + y) * 4)
+                    for y in range(32) for x in range(32)])
+
+    assert transcoders.histogram_score(black) == 0
+    assert transcoders.histogram_score(flat) == 0
+    assert transcoders.histogram_score(varied) > 4
+
+
+def test_gstengine_stats(monkeypatch, caplog):
+    gstengine = pytest.importorskip('mediagoblin.media_types.gstengine')
+    engine = gstengine.MediaEngine()
+    monkeypatch.setattr(gstengine, '_engine', engine)
+
+    for i in range(3):
+        with engine.pipeline('fakesrc num-buffers=1 ! fakesink',
+                             name='fake'):
+            pass
+    engine.record('recorded', 0.5, 2.0)
+
+    stats = engine.get_stats()
+    assert stats['fake']['count'] == 3
+    # All but the first come from the pool
+    assert stats['fake']['reused'] == 2
+    assert stats['recorded'] == {
+        'count': 1, 'reused': 0, 'setup': 0.5, 'run': 2.0}
+
+    with caplog.at_level('INFO', logger=gstengine.__name__):
+        gstengine.log_stats()
+    assert 'fake: 3 pipelines, 2 reused' in caplog.text
+    assert 'recorded: 1 pipelines, 0 reused, 0.50s setting up, ' \
+        '2.00s running' in caplog.text
@@ -0,0 +1,77 @@
+# GNU MediaGoblin -- federated, autonomous media hosting
+# Copyright (C) 2011, 2012 MediaGoblin contributors.  See AUTHORS.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import os
+
+from mediagoblin.db.models import MediaEntry
+from mediagoblin.gmg_commands import reprocess
+from mediagoblin.tests.tools import fixture_add_user, fixture_media_entry
+
+
+PROCESSED = []
+
+
+def fake_process_one(args, media_id):
+    if media_id in args.broken:
+        raise Exception('Broken media')
+    PROCESSED.append(media_id)
+
+
+class TestBulkReprocess(object):
+    def _setup(self, tmpdir):
+        user = fixture_add_user(u'bulky')
+        self.entry_ids = [
+            fixture_media_entry(uploader=user.id, state=u'processed').id
+            for i in range(5)]
+        self.checkpoint = str(tmpdir.join('checkpoint'))
+        self.args = argparse.Namespace(
+            workers=1, batch_size=2, checkpoint=self.checkpoint,
+            max_queued=None, celery=False, broken=[])
+        self.query = MediaEntry.query.filter_by(state=u'processed')
+        del PROCESSED[:]
+
+    def test_bulk_reprocess(self, test_app, tmpdir):
+        self._setup(tmpdir)
+        self.args.broken = [self.entry_ids[1]]
+
+        reprocess.bulk_reprocess(self.args, self.query, fake_process_one)
+
+        assert PROCESSED == self.entry_ids[:1] + self.entry_ids[2:]
+        # Finished runs start over next time
+        assert not os.path.exists(self.checkpoint)
+
+    def test_resume_from_checkpoint(self, test_app, tmpdir):
+        self._setup(tmpdir)
+        reprocess.write_checkpoint(self.checkpoint, self.entry_ids[2])
+        assert reprocess.read_checkpoint(self.checkpoint) == \
+            self.entry_ids[2]
+
+        reprocess.bulk_reprocess(self.args, self.query, fake_process_one)
+
+        assert PROCESSED == self.entry_ids[3:]
+
+
+def test_bulk_progress():
+    progress = reprocess.BulkProgress({u'image': 4, u'video': 1})
+    progress.add(u'image', True)
+    progress.add(u'image', False)
+    progress.add(u'video', True)
+
+    image_line, video_line = progress.report()
+    assert image_line.startswith(u'image: 2/4 (1 failed), ')
+    assert u'ETA' in image_line
+    assert video_line.endswith(u'done')
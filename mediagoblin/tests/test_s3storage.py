@@ -0,0 +1,248 @@
+# GNU MediaGoblin -- federated, autonomous media hosting
+# Copyright (C) 2011, 2012 MediaGoblin contributors.  See AUTHORS.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import re
+import threading
+from collections import Counter
+from xml.etree import ElementTree
+
+import pytest
+from six.moves import BaseHTTPServer, socketserver
+import six.moves.urllib.parse as urlparse
+
+from mediagoblin import storage
+from mediagoblin.storage.s3 import S3Storage, S3Error
+
+
+class FakeS3Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Just enough of the S3 API for S3Storage, keeping one bucket in memory
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _parse(self):
+        url = urlparse.urlsplit(self.path)
+        bucket, _, key = urlparse.unquote(url.path).lstrip('/').partition('/')
+        query = dict(urlparse.parse_qsl(url.query, keep_blank_values=True))
+        self.server.requests[self.command] += 1
+        self.server.connections.add(self.client_address)
+        assert bucket == 'bucket'
+        assert self.headers['authorization'].startswith('AWS4-HMAC-SHA256')
+        length = int(self.headers.get('content-length') or 0)
+        return key, query, self.rfile.read(length)
+
+    def _answer(self, status, body=b'', headers=None, length=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(
+            len(body) if length is None else length))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def do_HEAD(self):
+        key, query, body = self._parse()
+        if key not in self.server.objects:
+            return self._answer(404)
+        data = self.server.objects[key]
+        self._answer(200, headers={'ETag': '"etag"'}, length=len(data))
+
+    def do_GET(self):
+        key, query, body = self._parse()
+        if not key:
+            keys = sorted(k for k in self.server.objects
+                          if k.startswith(query['prefix']))
+            start = int(query.get('continuation-token', 0))
+            page = keys[start:start + 2]
+            listing = u''.join(u'<Contents><Key>{0}</Key></Contents>'.format(k)
+                               for k in page)
+            if start + 2 < len(keys):
+                listing += (u'<IsTruncated>true</IsTruncated>'
+                            u'<NextContinuationToken>{0}'
+                            u'</NextContinuationToken>'.format(start + 2))
+            return self._answer(200, (
+                u'<ListBucketResult xmlns="http://s3.amazonaws.com/doc/'
+                u'2006-03-01/">{0}</ListBucketResult>'.format(listing)
+                ).encode('utf-8'))
+
+        if key not in self.server.objects:
+            return self._answer(404)
+        data = self.server.objects[key]
+        match = re.match(r'bytes=(\d+)-(\d+)', self.headers.get('range', ''))
+        if match:
+            self.server.ranges.append(match.group(0))
+            start, stop = int(match.group(1)), int(match.group(2)) + 1
+            return self._answer(206, data[start:stop])
+        self._answer(200, data)
+
+    def do_PUT(self):
+        key, query, body = self._parse()
+        if 'uploadId' in query:
+            self.server.uploads[query['uploadId']][
+                int(query['partNumber'])] = body
+            return self._answer(200, headers={
+                'ETag': '"part{0}"'.format(query['partNumber'])})
+        self.server.objects[key] = body
+        self._answer(200, headers={'ETag': '"etag"'})
+
+    def do_POST(self):
+        key, query, body = self._parse()
+        if 'delete' in query:
+            for element in ElementTree.fromstring(body).iter('Key'):
+                self.server.objects.pop(element.text, None)
+            return self._answer(200, b'<DeleteResult/>')
+        if 'uploads' in query:
+            upload_id = str(len(self.server.uploads))
+            self.server.uploads[upload_id] = {}
+            return self._answer(200, (
+                '<InitiateMultipartUploadResult><UploadId>{0}</UploadId>'
+                '</InitiateMultipartUploadResult>'.format(upload_id)
+                ).encode('utf-8'))
+
+        parts = self.server.uploads.pop(query['uploadId'])
+        numbers = [int(element.text) for element in
+                   ElementTree.fromstring(body).iter('PartNumber')]
+        assert numbers == sorted(parts)
+        self.server.objects[key] = b''.join(parts[n] for n in numbers)
+        self._answer(200, b'<CompleteMultipartUploadResult><ETag>"etag"'
+                          b'</ETag></CompleteMultipartUploadResult>')
+
+    def do_DELETE(self):
+        key, query, body = self._parse()
+        self.server.objects.pop(key, None)
+        self._answer(204)
+
+
+class FakeS3Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(
+            self, ('127.0.0.1', 0), FakeS3Handler)
+        self.objects = {}
+        self.uploads = {}
+        self.ranges = []
+        self.requests = Counter()
+        self.connections = set()
+
+
+@pytest.fixture()
+def s3_server(request):
+    server = FakeS3Server()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    def stop():
+        server.shutdown()
+        server.server_close()
+    request.addfinalizer(stop)
+    return server
+
+
+def get_s3_storage(server, **kwargs):
+    return S3Storage(
+        s3_endpoint='http://127.0.0.1:{0}'.format(server.server_address[1]),
+        s3_bucket='bucket', s3_access_key='key', s3_secret_key='secret',
+        **kwargs)
+
+
+def test_s3_storage_files(s3_server):
+    this_storage = get_s3_storage(s3_server)
+
+    with this_storage.get_file(['dir1', 'file.txt'], 'wb') as our_file:
+        our_file.write(b'testing')
+    assert s3_server.objects == {'dir1/file.txt': b'testing'}
+
+    assert this_storage.file_exists(['dir1', 'file.txt'])
+    assert not this_storage.file_exists(['dir1', 'other.txt'])
+    assert this_storage.get_file(['dir1', 'file.txt']).read() == b'testing'
+    assert this_storage.file_url(['dir1', 'file.txt']) == \
+        'http://127.0.0.1:{0}/bucket/dir1/file.txt'.format(
+            s3_server.server_address[1])
+
+    # What was stored and looked up is remembered
+    assert this_storage.get_file_size(['dir1', 'file.txt']) == 7
+    assert this_storage.file_exists(['dir1', 'file.txt'])
+    assert s3_server.requests['HEAD'] == 1
+
+    this_storage.delete_file(['dir1', 'file.txt'])
+    assert s3_server.objects == {}
+    assert not this_storage.file_exists(['dir1', 'file.txt'])
+    with pytest.raises(S3Error):
+        this_storage.get_file(['dir1', 'file.txt'])
+
+    # All of it went over a single connection
+    assert len(s3_server.connections) == 1
+
+
+def test_s3_storage_multipart(s3_server, tmpdir):
+    this_storage = get_s3_storage(s3_server, s3_part_size=1000)
+    data = os.urandom(3500)
+    filename = tmpdir.join('upload').strpath
+    with open(filename, 'wb') as local_file:
+        local_file.write(data)
+
+    this_storage.copy_local_to_storage(filename, ['dir1', 'big.bin'])
+    assert s3_server.objects == {'dir1/big.bin': data}
+    assert s3_server.requests['PUT'] == 4
+
+    this_storage._metadata.clear()
+    dest = tmpdir.join('download').strpath
+    this_storage.copy_locally(['dir1', 'big.bin'], dest)
+    with open(dest, 'rb') as local_file:
+        assert local_file.read() == data
+    assert sorted(s3_server.ranges) == [
+        'bytes=0-999', 'bytes=1000-1999', 'bytes=2000-2999',
+        'bytes=3000-3499']
+
+
+def test_s3_storage_delete_dir(s3_server):
+    this_storage = get_s3_storage(s3_server)
+    for name in ['a', 'b', 'c', 'd', 'e']:
+        s3_server.objects['dir1/' + name] = b'x'
+    s3_server.objects['dir2/f'] = b'x'
+
+    assert not this_storage.delete_dir(['dir1'])
+    assert len(s3_server.objects) == 6
+
+    assert this_storage.delete_dir(['dir1'], recursive=True)
+    assert list(s3_server.objects) == ['dir2/f']
+    assert this_storage.delete_dir(['dir1'])
+
+    # Listed in pages of two, deleted in one request
+    assert s3_server.requests['POST'] == 1
+
+    assert this_storage.delete_files([['dir2', 'f'], ['dir2', 'g']]) == []
+    assert s3_server.objects == {}
+
+
+def test_s3_storage_from_config():
+    this_storage = storage.storage_system_from_config(
+        {'storage_class': 'mediagoblin.storage.s3:S3Storage',
+         's3_endpoint': 'https://s3.example.org',
+         's3_bucket': 'bucket',
+         's3_part_size': '10485760',
+         'base_url': 'https://media.example.org/'})
+    assert this_storage.secure
+    assert this_storage.part_size == 10485760
+    assert this_storage.file_url(['dir1', 'file.jpg']) == \
+        'https://media.example.org/dir1/file.jpg'
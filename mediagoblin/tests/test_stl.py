@@ -0,0 +1,228 @@
+# GNU MediaGoblin -- federated, autonomous media hosting
+# Copyright (C) 2011, 2012 MediaGoblin contributors.  See AUTHORS.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import io
+import struct
+
+import pytest
+
+numpy = pytest.importorskip('numpy')
+try:
+    from PIL import Image
+except ImportError:
+    import Image
+
+from mediagoblin.media_types.stl import model_loader, renderer
+from .resources import STL_BINARY, STL_ASCII, STL_OBJ
+
+# The tetrahedron in the test_stl files
+TETRAHEDRON = [[0, 0, 0], [1, 0, 0], [0, 2, 0], [0, 0, 3]]
+TETRAHEDRON_FACES = [[0, 2, 1], [0, 1, 3], [0, 3, 2], [1, 2, 3]]
+
+
+def load(filename, hint, **kwargs):
+    with open(filename, 'rb') as model_file:
+        return model_loader.auto_detect(model_file, hint, **kwargs)
+
+
+def assert_tetrahedron(model):
+    assert model.min == [0, 0, 0]
+    assert model.max == [1, 2, 3]
+    assert (model.width, model.depth, model.height) == (1, 2, 3)
+    # Every corner is in three triangles, so the average is the same
+    assert numpy.allclose(model.average, [0.25, 0.5, 0.75])
+    assert not model.sampled
+
+    triangles = model.triangles()
+    assert triangles.shape == (4, 3, 3)
+    assert triangles.tolist() == [
+        [TETRAHEDRON[i] for i in face] for face in TETRAHEDRON_FACES]
+
+
+@pytest.mark.parametrize('filename, model_class', [
+    (STL_BINARY, model_loader.BinaryStlModel),
+    (STL_ASCII, model_loader.AsciiStlModel)])
+def test_load_stl(filename, model_class):
+    model = load(filename, 'stl')
+    assert isinstance(model, model_class)
+    assert model.vertex_count == 12
+    assert_tetrahedron(model)
+
+
+def test_load_obj():
+    model = load(STL_OBJ, 'obj')
+    assert isinstance(model, model_loader.ObjModel)
+    # vt and vn lines are not vertices
+    assert model.vertex_count == 4
+    assert model.verts.tolist() == TETRAHEDRON
+    # All the ways of giving indices, negative ones included
+    assert model.faces.tolist() == TETRAHEDRON_FACES
+    assert_tetrahedron(model)
+
+
+def test_truncated_binary_stl():
+    with open(STL_BINARY, 'rb') as model_file:
+        data = model_file.read()
+
+    assert model_loader.is_binary_stl(io.BytesIO(data))
+    assert not model_loader.is_binary_stl(io.BytesIO(data[:-10]))
+    with pytest.raises(model_loader.ThreeDeeParseError):
+        model_loader.BinaryStlModel(io.BytesIO(data[:-10]))
+    with pytest.raises(model_loader.ThreeDeeParseError):
+        model_loader.BinaryStlModel(io.BytesIO(data[:82]))
+
+
+def _random_triangles(count):
+    return numpy.random.RandomState(1).uniform(
+        -100, 100, (count, 3, 3)).astype(numpy.float32)
+
+
+def _binary_stl(triangles):
+    data = io.BytesIO()
+    data.write(b' ' * 80)
+    data.write(struct.pack('<I', len(triangles)))
+    for triangle in triangles:
+        data.write(struct.pack('<3f', 0, 0, 0))
+        data.write(triangle.astype('<f4').tobytes())
+        data.write(struct.pack('<H', 0))
+    return data
+
+
+def _ascii_stl(triangles):
+    lines = [b'solid random']
+    for triangle in triangles:
+        lines.append(b'facet normal 0 0 0')
+        lines.append(b'outer loop')
+        for vertex in triangle:
+            lines.append(
+                ('vertex %r %r %r' % tuple(map(float, vertex))).encode())
+        lines.append(b'endloop')
+        lines.append(b'endfacet')
+    lines.append(b'endsolid random')
+    return io.BytesIO(b'\n'.join(lines) + b'\n')
+
+
+def _obj(triangles):
+    lines = [('v %r %r %r' % tuple(map(float, vertex))).encode()
+             for vertex in triangles.reshape(-1, 3)]
+    lines.extend(('f %d %d %d' % (i * 3 + 1, i * 3 + 2, i * 3 + 3)).encode()
+                 for i in range(len(triangles)))
+    return io.BytesIO(b'\n'.join(lines) + b'\n')
+
+
+@pytest.mark.parametrize('model_class, make_file', [
+    (model_loader.BinaryStlModel, _binary_stl),
+    (model_loader.AsciiStlModel, _ascii_stl),
+    (model_loader.ObjModel, _obj)])
+def test_sampled_model(model_class, make_file, monkeypatch):
+    triangles = _random_triangles(1000)
+    # Several batches, so what is kept is halved more than once
+    monkeypatch.setattr(model_loader.AsciiStlModel, 'batch_size', 300)
+    monkeypatch.setattr(model_loader.ObjModel, 'batch_size', 300)
+
+    model = model_class(make_file(triangles))
+    sampled = model_class(make_file(triangles), max_vertices=500)
+
+    assert not model.sampled
+    assert sampled.sampled
+    assert len(model.verts) == 3000
+    assert 0 < len(sampled.verts) <= 500
+    if model_class.group == 3:
+        # Whole triangles are kept
+        kept = model.triangles().tolist()
+        assert all(triangle in kept
+                   for triangle in sampled.triangles().tolist())
+    else:
+        # The faces don't fit the sampled vertices anymore
+        assert sampled.triangles() is None
+
+    # ... but the bounds and average are of the whole model
+    assert sampled.vertex_count == model.vertex_count
+    assert sampled.min == model.min
+    assert sampled.max == model.max
+    assert numpy.allclose(sampled.average, model.average)
+
+
+def test_rasterize():
+    # A square from (2, 2) to (6, 6), of two triangles
+    frame = renderer.Frame(10, 10)
+    screen = numpy.array([[[2, 2], [6, 2], [6, 6]],
+                          [[2, 2], [6, 6], [2, 6]]], float)
+    renderer.rasterize(frame, screen, numpy.ones((2, 3)),
+                       numpy.array([0.5, 1.0]))
+
+    drawn = numpy.isfinite(frame.depth).reshape(10, 10)
+    assert drawn[2:6, 2:6].all()
+    assert drawn.sum() == 16
+
+    # Nearer triangles cover farther ones
+    renderer.rasterize(frame, screen[:1], numpy.zeros((1, 3)),
+                       numpy.array([0.25]))
+    assert numpy.isfinite(frame.depth).sum() == 16
+    assert frame.shade.reshape(10, 10)[2, 5] == 0.25
+    assert frame.shade.reshape(10, 10)[5, 2] == 1.0
+
+
+def _shots(model, out_dir):
+    """
+    The shots of processing.CommonStlProcessor for model
+    """
+    greatest = max(model.width, model.height, model.depth)
+    average = model.average
+    views = [
+        ('thumb', [0, -1.5 * greatest, greatest], 'PERSP', (90, 60)),
+        ('top', [average[0], average[1], 2 * greatest], 'ORTHO', (64, 48)),
+        ('front', [average[0], -2 * greatest, average[2]], 'ORTHO', (64, 48)),
+        ('side', [-2 * greatest, average[1], average[2]], 'ORTHO', (48, 64)),
+    ]
+    return [{
+        'camera_coord': camera,
+        'camera_focus': average,
+        'greatest': greatest,
+        'projection': projection,
+        'width': size[0],
+        'height': size[1],
+        'out_file': str(out_dir.join(name + '.jpg')),
+    } for name, camera, projection, size in views]
+
+
+def _coverage(filename):
+    """
+    The share of the pixels of the image in filename which are not
+    the background
+    """
+    image = numpy.asarray(Image.open(filename).convert('RGB'), float)
+    model = abs(image - renderer.BACKGROUND).max(axis=-1) > 16
+    return model.mean()
+
+
+@pytest.mark.parametrize('points', [False, True])
+def test_render_views(tmpdir, points):
+    model = load(STL_BINARY, 'stl')
+    shots = _shots(model, tmpdir)
+    if points:
+        renderer.render_views(None, shots, points=model.verts)
+    else:
+        renderer.render_views(model.triangles(), shots)
+
+    for shot in shots:
+        image = Image.open(shot['out_file'])
+        assert image.size == (shot['width'], shot['height'])
+        if points:
+            # Only the corners, some of them on top of each other
+            assert 0 < _coverage(shot['out_file']) < 0.01
+        else:
+            assert 0.01 < _coverage(shot['out_file']) < 0.5
@@ -24,6 +24,7 @@ import six
 from werkzeug.utils import secure_filename
 
 from mediagoblin import storage
+from mediagoblin.storage import dedupstorage, mountstorage
 
 
 ################
@@ -321,3 +322,220 @@ def test_basic_storage_copy_local_to_storage():
 def test_general_storage_copy_local_to_storage():
     tmpdir, this_storage = get_tmp_filestorage(fake_remote=True)
     _test_copy_local_to_storage_works(tmpdir, this_storage)
+
+
+##########################
+# Dedup file storage tests
+##########################
+
+def test_dedup_storage_shares_blobs():
+    tmpdir = tempfile.mkdtemp(prefix="test_gmg_storage")
+    this_storage = dedupstorage.DedupFileStorage(
+        tmpdir, 'http://media.example.org/')
+
+    local_filename = tempfile.mktemp()
+    with open(local_filename, 'w') as tmpfile:
+        tmpfile.write('haha')
+
+    first = ['dir1', 'first.txt']
+    second = ['dir2', 'second.txt']
+    this_storage.copy_local_to_storage(local_filename, first)
+    with this_storage.get_file(second, 'w') as second_file:
+        second_file.write('haha')
+
+    # Both point to the very same blob
+    blob_path = this_storage.get_local_path(first)
+    assert blob_path == this_storage.get_local_path(second)
+    assert blob_path.startswith(os.path.join(tmpdir, 'blobs'))
+    assert this_storage.get_file(second).read() == 'haha'
+    assert this_storage.get_file_size(first) == 4
+    assert this_storage.file_url(first) == \
+        'http://media.example.org/blobs/' + blob_path.split('/blobs/')[1]
+    assert sorted(this_storage.filepaths_with_content(
+        local_filename, '.txt')) == [first, second]
+
+    # The blob goes away with its last reference only
+    this_storage.delete_file(first)
+    assert os.path.exists(blob_path)
+    assert this_storage.filepaths_with_content(
+        local_filename, '.txt') == [second]
+
+    third = ['dir3', 'third.txt']
+    this_storage.link_file(second, third)
+    this_storage.delete_dir(['dir2'], recursive=True)
+    assert this_storage.get_file(third).read() == 'haha'
+
+    this_storage.delete_file(third)
+    assert not os.path.exists(blob_path)
+    assert this_storage.filepaths_with_content(local_filename, '.txt') == []
+
+    os.remove(local_filename)
+
+
+def test_dedup_storage_plain_files():
+    tmpdir, plain_storage = get_tmp_filestorage()
+    for name in ('one.txt', 'two.txt'):
+        with plain_storage.get_file(['dir1', name], 'w') as plain_file:
+            plain_file.write('duplicate')
+
+    this_storage = dedupstorage.DedupFileStorage(tmpdir)
+    # Files which aren't deduplicated yet still work
+    assert this_storage.get_local_path(['dir1', 'one.txt']) == \
+        os.path.join(tmpdir, 'dir1', 'one.txt')
+
+    assert this_storage.dedup_file(['dir1', 'one.txt'])[1] is False
+    assert this_storage.dedup_file(['dir1', 'two.txt'])[1] is True
+    assert this_storage.dedup_file(['dir1', 'two.txt']) is None
+
+    assert this_storage.get_local_path(['dir1', 'one.txt']) == \
+        this_storage.get_local_path(['dir1', 'two.txt'])
+    assert this_storage.get_file(['dir1', 'two.txt']).read() == 'duplicate'
+
+
+########################
+# Mount storage tests
+########################
+
+def test_mount_storage_resolves_longest_prefix():
+    this_storage = mountstorage.MountStorage()
+    tmpdir, user_storage = get_tmp_filestorage('http://users.example.org/')
+    tmpdir2, media_storage = get_tmp_filestorage('http://media.example.org/')
+    this_storage.mount(['user_data'], user_storage)
+    this_storage.mount(['media_entries'], media_storage)
+    # Longer paths may be mounted after shorter ones
+    this_storage.mount(['user_data', 'elrond'], media_storage)
+
+    assert this_storage.resolve_to_backend(
+        ['user_data', 'cwebber', 'avatar.jpg']) == \
+        (user_storage, ['cwebber', 'avatar.jpg'])
+    assert this_storage.resolve_to_backend(
+        ['user_data', 'elrond', 'avatar.jpg']) == \
+        (media_storage, ['avatar.jpg'])
+    assert this_storage.resolve_to_backend(
+        ['media_entries', '1', 'thumb.jpg']) == \
+        (media_storage, ['1', 'thumb.jpg'])
+    with pytest.raises(mountstorage.MountError):
+        this_storage.resolve_to_backend(['elsewhere', 'file.jpg'])
+    with pytest.raises(mountstorage.MountError):
+        this_storage.mount(['user_data'], media_storage)
+
+    with this_storage.get_file(['media_entries', '1', 'thumb.jpg'], 'w') \
+            as our_file:
+        our_file.write('thumb')
+    assert this_storage.file_url(['media_entries', '1', 'thumb.jpg']) == \
+        'http://media.example.org/1/thumb.jpg'
+    assert this_storage.delete_files(
+        [['media_entries', '1', 'thumb.jpg'],
+         ['user_data', 'elrond', 'gone.jpg']]) == []
+    assert not os.path.exists(os.path.join(tmpdir2, '1', 'thumb.jpg'))
+
+    stats = this_storage.get_stats()
+    assert stats['media_entries']['operations'] == {
+        'get_file': 1, 'file_url': 1, 'delete_files': 1}
+    assert sum(stats['media_entries']['latency']['get_file']) == 1
+    assert stats['user_data/elrond']['operations'] == {'delete_files': 1}
+    assert stats['user_data']['operations'] == {}
+
+    cleanup_storage(user_storage, tmpdir)
+    cleanup_storage(media_storage, tmpdir2, ['1'])
+
+
+def test_tiered_storage_promotes_on_read(monkeypatch):
+    tmpdir, hot_storage = get_tmp_filestorage('http://hot.example.org/')
+    tmpdir2, cold_storage = get_tmp_filestorage(
+        'http://cold.example.org/', fake_remote=True)
+    this_storage = mountstorage.MountStorage()
+    this_storage.mount(['media_entries'], mountstorage.TieredStorage(
+        hot_storage, cold_storage, hot_max_size=8))
+
+    first = ['media_entries', 'first.txt']
+    local_filename = tempfile.mktemp()
+    with open(local_filename, 'w') as tmpfile:
+        tmpfile.write('haha')
+    this_storage.copy_local_to_storage(local_filename, first)
+
+    # Written to the cold tier only
+    assert this_storage.file_exists(first)
+    assert not hot_storage.file_exists(['first.txt'])
+    assert this_storage.file_url(first) == 'http://cold.example.org/first.txt'
+
+    # ... and promoted to the hot tier when read
+    assert this_storage.get_file(first).read() == 'haha'
+    assert hot_storage.file_exists(['first.txt'])
+    assert this_storage.file_url(first) == 'http://hot.example.org/first.txt'
+
+    # Writing again drops the stale copy
+    with this_storage.get_file(first, 'w') as our_file:
+        our_file.write('hahaha')
+    assert not hot_storage.file_exists(['first.txt'])
+
+    # ... and so does writing elsewhere, like on another machine
+    assert this_storage.get_file(first).read() == 'hahaha'
+    assert this_storage.file_url(first) == 'http://hot.example.org/first.txt'
+    with cold_storage.get_file(['first.txt'], 'w') as our_file:
+        our_file.write('hohoho')
+    os.utime(cold_storage.get_local_path(['first.txt']), (0, 0))
+    # URLs are only checked against the cold tier every HOT_URL_CHECK_TIME
+    assert this_storage.file_url(first) == 'http://hot.example.org/first.txt'
+    monkeypatch.setattr(mountstorage, 'HOT_URL_CHECK_TIME', 0)
+    assert this_storage.file_url(first) == 'http://cold.example.org/first.txt'
+    assert this_storage.get_file(first).read() == 'hohoho'
+    assert this_storage.file_url(first) == 'http://hot.example.org/first.txt'
+
+    # The hot tier is kept below its maximum size
+    second = ['media_entries', 'second.txt']
+    this_storage.copy_local_to_storage(local_filename, second)
+    this_storage.copy_locally(first, local_filename + '.copy')
+    os.utime(hot_storage.get_local_path(['first.txt']), (0, 0))
+    this_storage.copy_locally(second, local_filename + '.copy')
+    assert not hot_storage.file_exists(['first.txt'])
+    assert hot_storage.file_exists(['second.txt'])
+    assert this_storage.get_stats()['media_entries'][
+        'bytes_read'] == 6 + 4
+    assert not os.path.exists(hot_storage.get_local_path(
+        ['first.txt' + mountstorage.TieredStorage.HOT_VERSION_SUFFIX]))
+
+    this_storage.delete_file(first)
+    this_storage.delete_file(second)
+    assert not cold_storage.file_exists(['second.txt'])
+    assert not hot_storage.file_exists(['second.txt'])
+
+    os.remove(local_filename)
+    os.remove(local_filename + '.copy')
+    os.rmdir(tmpdir)
+    os.rmdir(tmpdir2)
+
+
+def test_tiered_storage_without_etags(monkeypatch):
+    tmpdir, hot_storage = get_tmp_filestorage('http://hot.example.org/')
+    tmpdir2, cold_storage = get_tmp_filestorage(
+        'http://cold.example.org/', fake_remote=True)
+    monkeypatch.setattr(cold_storage, 'get_file_etag', lambda filepath: None)
+    this_storage = mountstorage.TieredStorage(hot_storage, cold_storage)
+
+    with cold_storage.get_file(['first.txt'], 'w') as our_file:
+        our_file.write('haha')
+
+    # Hot copies can't be checked, so files are read from the cold tier
+    assert this_storage.get_file(['first.txt']).read() == 'haha'
+    assert not hot_storage.file_exists(['first.txt'])
+    assert this_storage.file_url(['first.txt']) == \
+        'http://cold.example.org/first.txt'
+
+    # ... and a local path is copied again every time
+    local_path = this_storage.get_local_path(['first.txt'])
+    with cold_storage.get_file(['first.txt'], 'w') as our_file:
+        our_file.write('hoho')
+    assert this_storage.get_local_path(['first.txt']) == local_path
+    with open(local_path) as local_file:
+        assert local_file.read() == 'hoho'
+    monkeypatch.setattr(mountstorage, 'HOT_URL_CHECK_TIME', 0)
+    assert this_storage.file_url(['first.txt']) == \
+        'http://cold.example.org/first.txt'
+    assert not os.path.exists(
+        local_path + mountstorage.TieredStorage.HOT_VERSION_SUFFIX)
+
+    this_storage.delete_file(['first.txt'])
+    assert os.listdir(tmpdir) == []
+    os.rmdir(tmpdir)
+    os.rmdir(tmpdir2)
@@ -21,8 +21,13 @@ if six.PY2:  # this hack only work in Python 2
     reload(sys)
     sys.setdefaultencoding('utf-8')
 
+import io
 import os
 import pytest
+try:
+    from PIL import Image, ImageFile
+except ImportError:
+    import Image, ImageFile
 
 import six.moves.urllib.parse as urlparse
 
@@ -32,6 +37,10 @@ from mediagoblin.db.models import MediaEntry, User
 from mediagoblin.db.base import Session
 from mediagoblin.tools import template
 from mediagoblin.media_types.image import ImageMediaManager
+from mediagoblin.media_types.image import processing as image_processing
+from mediagoblin.storage.dedupstorage import DedupFileStorage
+from mediagoblin.submit.lib import (copy_upload_to_queue, FileUploadLimit,
+                                    UserUploadLimit)
 from mediagoblin.media_types.pdf.processing import check_prerequisites as pdf_check_prerequisites
 
 from .resources import GOOD_JPG, GOOD_PNG, EVIL_FILE, EVIL_JPG, EVIL_PNG, \
@@ -133,6 +142,33 @@ class TestSubmission:
         our_user.save()
         Session.expunge(our_user)
 
+    def test_duplicate_reuses_derivatives(self, monkeypatch, tmpdir):
+        public_store = DedupFileStorage(str(tmpdir))
+        monkeypatch.setattr(mg_globals, 'public_store', public_store)
+
+        self.do_post({'title': u'Original'}, **self.upload_data(GOOD_JPG))
+
+        # The duplicate must not get processed again
+        def no_processing(processor, **kwargs):
+            raise AssertionError('Duplicate got processed')
+        monkeypatch.setattr(image_processing.InitialProcessor, 'process',
+                            no_processing)
+        self.do_post({'title': u'Duplicate'}, **self.upload_data(GOOD_JPG))
+
+        original, duplicate = [
+            MediaEntry.query.filter_by(title=title).first()
+            for title in (u'Original', u'Duplicate')]
+        assert duplicate.state == u'processed'
+        assert not duplicate.queued_media_file
+        assert sorted(duplicate.media_files) == sorted(original.media_files)
+        for keyname, filepath in six.iteritems(duplicate.media_files):
+            assert filepath[1] == six.text_type(duplicate.id)
+            assert public_store.get_local_path(filepath) == \
+                public_store.get_local_path(original.media_files[keyname])
+        assert duplicate.get_file_metadata(u'original') == \
+            original.get_file_metadata(u'original')
+        assert duplicate.media_data.width == original.media_data.width
+
     def test_normal_jpg(self):
         # User uploaded should be 0
         assert self.our_user().uploaded == 0
@@ -146,6 +182,48 @@ class TestSubmission:
         # Reload user
         assert self.our_user().uploaded == file_size
 
+    def test_resize_uses_derivative_cache(self, monkeypatch):
+        self.check_normal_upload(u'Cached resize', GOOD_JPG)
+        entry = MediaEntry.query.filter_by(title=u'Cached resize').first()
+        thumb = mg_globals.public_store.get_file(
+            entry.media_files['thumb']).read()
+
+        # Reprocessing with the same settings must not touch PIL again
+        def no_resizing(*args, **kwargs):
+            raise AssertionError('Thumbnail got resized again')
+        monkeypatch.setattr(image_processing, 'exif_fix_image_orientation',
+                            no_resizing)
+
+        manager = image_processing.ImageProcessingManager()
+        with manager.get_processor(u'resize', entry)(
+                manager, entry) as processor:
+            entry.set_file_metadata('thumb', quality=None)
+            processor.process(file=u'thumb')
+
+        assert mg_globals.public_store.get_file(
+            entry.media_files['thumb']).read() == thumb
+
+    def test_image_decoded_once(self, monkeypatch):
+        decoded = []
+        image_load = ImageFile.ImageFile.load
+        def counting_load(image):
+            # Only images which still have tiles to decode do any work
+            if image.tile:
+                decoded.append(image.filename)
+            return image_load(image)
+        monkeypatch.setattr(ImageFile.ImageFile, 'load', counting_load)
+
+        self.check_normal_upload(u'Decoded once', BIG_BLUE)
+        assert len(decoded) == 1
+
+        entry = MediaEntry.query.filter_by(title=u'Decoded once').first()
+        for keyname in (u'medium', u'thumb'):
+            config = mg_globals.global_config['media:' + keyname]
+            resized = Image.open(mg_globals.public_store.get_local_path(
+                entry.media_files[keyname]))
+            assert max(resized.size) == max(
+                config['max_width'], config['max_height'])
+
     def test_normal_png(self):
         self.check_normal_upload(u'Normal upload 2', GOOD_PNG)
 
@@ -386,3 +464,26 @@ class TestSubmission:
             size = os.stat(filename).st_size
             assert last_size > size
             last_size = size
+
+
+def test_copy_upload_to_queue_stops_at_limits():
+    data = b'x' * (3 * 1024 * 1024)
+
+    source = io.BytesIO(data)
+    queue_file = io.BytesIO()
+    with pytest.raises(FileUploadLimit):
+        copy_upload_to_queue(source, queue_file, max_file_size=1,
+                             chunk_size=256 * 1024)
+    # Gave up without reading the whole upload
+    assert source.tell() < len(data)
+    assert len(queue_file.getvalue()) < 1024 * 1024
+
+    with pytest.raises(UserUploadLimit):
+        copy_upload_to_queue(io.BytesIO(data), io.BytesIO(),
+                             upload_limit=10, uploaded=8)
+
+    queue_file = io.BytesIO()
+    assert copy_upload_to_queue(
+        io.BytesIO(data), queue_file, max_file_size=5, offset=10) == \
+        len(data) + 10
+    assert queue_file.getvalue() == data
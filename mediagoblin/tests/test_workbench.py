@@ -15,6 +15,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import shutil
 import tempfile
 
 
@@ -120,3 +121,45 @@ class TestWorkbench(object):
         benchdir = create_it()
         # workbench dir has been cleaned up automatically?
         assert not os.path.isdir(benchdir)
+
+    def test_localized_file_cache(self):
+        tmpdir, this_storage = get_tmp_filestorage(fake_remote=True)
+        cache_dir = tempfile.mkdtemp(prefix='gmg_workbench_cache_testing')
+        cache = workbench.RemoteFileCache(cache_dir, 20)
+        workbench_manager = workbench.WorkbenchManager(
+            self.workbench_base, cache)
+
+        filepath = ['dir1', 'ourfile.txt']
+        with this_storage.get_file(filepath, 'w') as our_file:
+            our_file.write('Our file')
+
+        for i in range(2):
+            with workbench_manager.create() as this_workbench:
+                filename = this_workbench.localized_file(
+                    this_storage, filepath)
+                with open(filename) as local_file:
+                    assert local_file.read() == 'Our file'
+        assert cache.get_stats() == {'hits': 1, 'misses': 1, 'evictions': 0}
+
+        # A changed file is not taken from the cache
+        with this_storage.get_file(filepath, 'w') as our_file:
+            our_file.write('Our changed file')
+        with workbench_manager.create() as this_workbench:
+            filename = this_workbench.localized_file(this_storage, filepath)
+            with open(filename) as local_file:
+                assert local_file.read() == 'Our changed file'
+
+        # ... and pushes the old version out of the cache
+        assert cache.get_stats() == {'hits': 1, 'misses': 2, 'evictions': 1}
+        assert sum(len(files) for _, _, files in os.walk(cache_dir)) == 1
+
+        # Without an ETag, files aren't cached at all
+        this_storage.get_file_etag = lambda filepath: None
+        for i in range(2):
+            with workbench_manager.create() as this_workbench:
+                this_workbench.localized_file(this_storage, filepath)
+        assert cache.get_stats() == {'hits': 1, 'misses': 2, 'evictions': 1}
+
+        this_storage.delete_file(filepath)
+        cleanup_storage(this_storage, tmpdir, ['dir1'])
+        shutil.rmtree(cache_dir)
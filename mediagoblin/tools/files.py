@@ -14,30 +14,154 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from mediagoblin import mg_globals
+import hashlib
+import os
+import threading
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# How many files a SizeBoundedDirectory is told about before it looks at
+# what is on disk again, to notice what other processes added
+DIRECTORY_RESCAN_INTERVAL = 100
 
 
 def delete_media_files(media):
     """
-    Delete all files associated with a MediaEntry
+    Have all files associated with a MediaEntry deleted
+
+    The files are only queued for deletion, in the session (and so the
+    transaction) media is deleted in.  They are deleted later by the
+    delete_queued_files task, see delete_queued_files_later().
 
     Arguments:
      - media: A MediaEntry document
     """
-    no_such_files = []
-    for listpath in media.media_files.itervalues():
-        try:
-            mg_globals.public_store.delete_file(
-                listpath)
-        except OSError:
-            no_such_files.append("/".join(listpath))
-
-    for attachment in media.attachment_files:
-        try:
-            mg_globals.public_store.delete_file(
-                attachment['filepath'])
-        except OSError:
-            no_such_files.append("/".join(attachment['filepath']))
-
-    if no_such_files:
-        raise OSError(", ".join(no_such_files))
+    filepaths = list(media.media_files.values())
+    filepaths.extend(
+        attachment['filepath'] for attachment in media.attachment_files)
+    queue_file_deletions(media._session, filepaths)
+
+
+def queue_file_deletions(session, filepaths, store=u'public'):
+    """
+    Record filepaths of the public (or queue) store as to be deleted,
+    once session is committed
+    """
+    # TODO: Import here due to cyclic imports
+    from mediagoblin.db.models import PendingDeletion
+
+    for filepath in filepaths:
+        session.add(PendingDeletion(store=store, filepath=filepath))
+
+
+def delete_queued_files_later():
+    """
+    Start deleting the queued files, after they have been committed
+    """
+    # TODO: Import here due to cyclic imports
+    from mediagoblin.submit.task import delete_queued_files
+    delete_queued_files.apply_async()
+
+
+def file_hash(filename):
+    """
+    Return the hex sha256 digest of the file at filename
+    """
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as hash_file:
+        for chunk in iter(lambda: hash_file.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class SizeBoundedDirectory(object):
+    """
+    Keeps the files in directory under max_size bytes, by removing the
+    least recently used (by mtime) ones.
+
+    Only every DIRECTORY_RESCAN_INTERVAL added files (or when what was
+    found last time isn't enough to evict from) is the whole directory
+    looked at.  In between, the size is kept as a running total, so adding
+    a file doesn't cost a walk over all of the directory.
+
+    Files for which skip(filename) is true aren't counted or evicted.
+    """
+    def __init__(self, directory, max_size, skip=None):
+        self.directory = directory
+        self.max_size = max_size
+        self.skip = skip
+        self._lock = threading.Lock()
+        # Newest first, so the least recently used one is popped off
+        self._entries = None
+        self._total_size = 0
+        self._added = 0
+
+    def _scan(self):
+        entries = []
+        total_size = 0
+        for dirname, dirs, files in os.walk(self.directory):
+            for name in files:
+                if self.skip is not None and self.skip(name):
+                    continue
+                path = os.path.join(dirname, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total_size += stat.st_size
+
+        entries.sort(reverse=True)
+        self._entries = entries
+        self._total_size = total_size
+        self._added = 0
+
+    def _evict(self):
+        evicted = []
+        for attempt in range(2):
+            while self._entries and self._total_size > self.max_size:
+                mtime, size, path = self._entries.pop()
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    # Gone already
+                    self._total_size -= size
+                    continue
+                if stat.st_mtime > mtime:
+                    # Used since the last scan, so not the least recent
+                    continue
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                self._total_size -= stat.st_size
+                evicted.append(path)
+
+            if self._total_size <= self.max_size or attempt:
+                break
+            # What was found last time has been used since, look again
+            self._scan()
+        return evicted
+
+    def added(self, size):
+        """
+        Account for a file of size bytes added to the directory, and evict
+        what doesn't fit anymore.  Returns the paths of evicted files.
+        """
+        with self._lock:
+            self._added += 1
+            if self._entries is None or \
+                    self._added >= DIRECTORY_RESCAN_INTERVAL:
+                self._scan()
+            else:
+                self._total_size += size
+            return self._evict()
+
+    def evict(self):
+        """
+        Look at all of the directory and evict what doesn't fit.  Returns
+        the paths of evicted files.
+        """
+        with self._lock:
+            self._scan()
+            return self._evict()
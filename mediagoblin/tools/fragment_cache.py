@@ -0,0 +1,67 @@
+# GNU MediaGoblin -- federated, autonomous media hosting
+# Copyright (C) 2011, 2012 MediaGoblin contributors.  See AUTHORS.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+In-process cache of rendered fragments, like Atom feeds and thumbnails
+
+Keys have to include a version of everything the fragment was rendered
+from (eg. the updated timestamp of a media entry), so nothing ever needs
+to be invalidated: stale fragments just aren't asked for anymore and
+fall out of the cache.
+"""
+
+import threading
+from collections import OrderedDict
+
+# How many fragments to keep around
+FRAGMENT_CACHE_SIZE = 2000
+
+
+class FragmentCache(object):
+    """
+    Thread safe least recently used cache of at most max_entries fragments
+    """
+    def __init__(self, max_entries=FRAGMENT_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._fragments = OrderedDict()
+
+    def get(self, key):
+        """Return the fragment cached under key, or None"""
+        with self._lock:
+            fragment = self._fragments.pop(key, None)
+            if fragment is not None:
+                # Move to the end, as the most recently used
+                self._fragments[key] = fragment
+            return fragment
+
+    def set(self, key, fragment):
+        with self._lock:
+            self._fragments.pop(key, None)
+            self._fragments[key] = fragment
+            while len(self._fragments) > self.max_entries:
+                self._fragments.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._fragments.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._fragments.clear()
+
+
+fragment_cache = FragmentCache()
@@ -16,14 +16,98 @@
 
 import urllib
 import copy
+import base64
+import binascii
+import datetime
+import time
 from math import ceil, floor
 from itertools import count
 from werkzeug.datastructures import MultiDict
 
+import six
 from six.moves import zip
+from sqlalchemy import and_, or_
 
 PAGINATION_DEFAULT_PER_PAGE = 30
 
+# How long (in seconds) a total count is reused before counting again
+PAGINATION_COUNT_CACHE_TIME = 60
+PAGINATION_COUNT_CACHE_SIZE = 1000
+
+MARKER_DIRECTIONS = (u'before', u'after')
+_MARKER_DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+_count_cache = {}
+
+
+def cached_count(cursor, cache_time=PAGINATION_COUNT_CACHE_TIME):
+    """
+    Count the rows of a cursor, reusing a recent count of the same query.
+
+    A total which is a few seconds stale is good enough to render page
+    numbers, and saves a full count on every page view.
+    """
+    statement = cursor.statement.compile()
+    key = (six.text_type(statement),
+           repr(sorted(statement.params.items())))
+    now = time.time()
+
+    cached = _count_cache.get(key)
+    if cached is not None and now - cached[0] < cache_time:
+        return cached[1]
+
+    if len(_count_cache) >= PAGINATION_COUNT_CACHE_SIZE:
+        _count_cache.clear()
+
+    total_count = cursor.order_by(None).count()
+    _count_cache[key] = (now, total_count)
+    return total_count
+
+
+def encode_marker(created, obj_id):
+    """
+    Encode a (created, id) key into an opaque, url-safe marker token
+    """
+    raw = u'%s|%d' % (created.strftime(_MARKER_DATETIME_FORMAT), obj_id)
+    return base64.urlsafe_b64encode(
+        raw.encode('ascii')).decode('ascii').rstrip(u'=')
+
+
+def decode_marker(token):
+    """
+    Decode a token made by encode_marker() back into (created, id).
+
+    Raises ValueError if the token is malformed.
+    """
+    try:
+        raw = token.encode('ascii')
+        raw += b'=' * (-len(raw) % 4)
+        created, obj_id = base64.urlsafe_b64decode(
+            raw).decode('ascii').split(u'|')
+        return (datetime.datetime.strptime(created, _MARKER_DATETIME_FORMAT),
+                int(obj_id))
+    except (TypeError, ValueError, UnicodeError, binascii.Error):
+        raise ValueError('Invalid pagination marker: %r' % (token,))
+
+
+def get_pagination_marker(get_params):
+    """
+    Get the keyset marker out of the 'before' or 'after' GET parameter.
+
+    Returns a (direction, created, id) tuple, or None if neither parameter
+    is set.  Raises ValueError if the marker is malformed or both are set.
+    """
+    markers = [(direction, get_params[direction])
+               for direction in MARKER_DIRECTIONS
+               if get_params.get(direction)]
+    if not markers:
+        return None
+    if len(markers) > 1:
+        raise ValueError('Only one of before/after may be given')
+
+    direction, token = markers[0]
+    return (direction,) + decode_marker(token)
+
 
 class Pagination(object):
     """
@@ -100,11 +184,7 @@ class Pagination(object):
         """
         Get a page url by adding a page= parameter to the base url
         """
-        if isinstance(get_params, MultiDict):
-            new_get_params = get_params.to_dict()
-        else:
-            new_get_params = dict(get_params) or {}
-
+        new_get_params = self._clean_get_params(get_params)
         new_get_params['page'] = page_no
         return "%s?%s" % (
             base_url, urllib.urlencode(new_get_params))
@@ -117,3 +197,197 @@ class Pagination(object):
         """
         return self.get_page_url_explicit(
             request.full_path, request.GET, page_no)
+
+    def get_prev_url_explicit(self, base_url, get_params):
+        """
+        Get the url of the previous ("newer") page
+        """
+        return self.get_page_url_explicit(
+            base_url, get_params, self.page - 1)
+
+    def get_next_url_explicit(self, base_url, get_params):
+        """
+        Get the url of the next ("older") page
+        """
+        return self.get_page_url_explicit(
+            base_url, get_params, self.page + 1)
+
+    def _clean_get_params(self, get_params):
+        """
+        Copy get_params into a dict without any page or marker parameters
+        """
+        if isinstance(get_params, MultiDict):
+            new_get_params = get_params.to_dict()
+        else:
+            new_get_params = dict(get_params) or {}
+
+        for key in ('page',) + MARKER_DIRECTIONS:
+            new_get_params.pop(key, None)
+        return new_get_params
+
+
+class KeysetPagination(Pagination):
+    """
+    Pagination which seeks on the (created, id) key of the paginated model.
+
+    Stepping to the previous or next page uses opaque before/after markers
+    instead of an OFFSET, so deep pages cost as much as the first one.
+    Explicit page numbers still work, and the total count is only needed
+    (and then cached) when the page list is rendered.
+
+    The cursor's own ordering is replaced by (created, id), newest first
+    unless ascending is set.
+    """
+
+    def __init__(self, page, cursor, per_page=PAGINATION_DEFAULT_PER_PAGE,
+                 jump_to_id=False, marker=None, ascending=False):
+        """
+        Initializes KeysetPagination
+
+        Args:
+         - page: requested page, ignored if a marker is given
+         - per_page: number of objects per page
+         - cursor: db cursor of a model with created and id columns
+         - jump_to_id: object id, sets the page to the page containing the
+           object with id == jump_to_id.
+         - marker: (direction, created, id) tuple, as returned by
+           get_pagination_marker()
+         - ascending: order oldest first instead of newest first
+        """
+        self.per_page = per_page
+        self.ascending = ascending
+        self.active_id = None
+
+        model = cursor.column_descriptions[0]['type']
+        self.key = (model.created, model.id)
+        self.base_cursor = cursor.order_by(None)
+        self.cursor = self._ordered(ascending)
+
+        self.marker = marker
+        self._page = None if marker else max(page, 1)
+        self._results = None
+        self._has_prev = self._has_next = False
+
+        if jump_to_id:
+            self._jump_to(int(jump_to_id))
+
+    def _ordered(self, ascending):
+        if ascending:
+            return self.base_cursor.order_by(
+                *[column.asc() for column in self.key])
+        return self.base_cursor.order_by(
+            *[column.desc() for column in self.key])
+
+    def _beyond(self, created, obj_id, ascending):
+        """
+        Filter for rows which come after (created, id) in the given order
+        """
+        created_column, id_column = self.key
+        if ascending:
+            return or_(created_column > created,
+                       and_(created_column == created, id_column > obj_id))
+        return or_(created_column < created,
+                   and_(created_column == created, id_column < obj_id))
+
+    def _position(self, created, obj_id):
+        """
+        Number of rows which come before (created, id) in display order
+        """
+        return self.base_cursor.filter(
+            self._beyond(created, obj_id, not self.ascending)).count()
+
+    def _jump_to(self, jump_to_id):
+        created_column, id_column = self.key
+        row = self.base_cursor.filter(id_column == jump_to_id).with_entities(
+            created_column, id_column).first()
+        if row is None:
+            return
+
+        self.marker = None
+        self._page = 1 + self._position(*row) // self.per_page
+        self.active_id = jump_to_id
+
+    def _fetch(self):
+        limit = self.per_page + 1
+
+        if self.marker is None:
+            results = self.cursor.slice(
+                (self._page - 1) * self.per_page,
+                self._page * self.per_page + 1).all()
+            self._has_prev = self._page > 1
+            self._has_next = len(results) > self.per_page
+            return results[:self.per_page]
+
+        direction, created, obj_id = self.marker
+        if direction == u'after':
+            results = self.cursor.filter(
+                self._beyond(created, obj_id, self.ascending)).limit(
+                    limit).all()
+            self._has_prev = bool(results)
+            self._has_next = len(results) > self.per_page
+            return results[:self.per_page]
+
+        # Walk backwards from the marker and flip the rows around
+        results = self._ordered(not self.ascending).filter(
+            self._beyond(created, obj_id, not self.ascending)).limit(
+                limit).all()
+        if len(results) < self.per_page:
+            # Not a full page before the marker; show the first page
+            self.marker = None
+            self._page = 1
+            return self._fetch()
+
+        self._has_prev = len(results) > self.per_page
+        self._has_next = True
+        return list(reversed(results[:self.per_page]))
+
+    def __call__(self):
+        """
+        Returns the list of objects for the requested page
+        """
+        if self._results is None:
+            self._results = self._fetch()
+        return self._results
+
+    @property
+    def page(self):
+        if self._page is None:
+            results = self()
+            if self._page is None:
+                self._page = 1
+                if results:
+                    first = results[0]
+                    self._page += self._position(
+                        first.created, first.id) // self.per_page
+        return self._page
+
+    @property
+    def total_count(self):
+        return cached_count(self.base_cursor)
+
+    @property
+    def has_prev(self):
+        self()
+        return self._has_prev
+
+    @property
+    def has_next(self):
+        self()
+        return self._has_next
+
+    def get_marker_url_explicit(self, base_url, get_params, direction, obj):
+        """
+        Get a url which seeks to the rows before or after obj
+        """
+        new_get_params = self._clean_get_params(get_params)
+        new_get_params[direction] = encode_marker(obj.created, obj.id)
+        return "%s?%s" % (
+            base_url, urllib.urlencode(new_get_params))
+
+    def get_prev_url_explicit(self, base_url, get_params):
+        return self.get_marker_url_explicit(
+            base_url, get_params, u'before', self()[0])
+
+    def get_next_url_explicit(self, base_url, get_params):
+        return self.get_marker_url_explicit(
+            base_url, get_params, u'after', self()[-1])
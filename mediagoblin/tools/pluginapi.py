@@ -54,9 +54,14 @@ Lifecycle
 2. After all plugin modules are imported, the ``setup`` hook is called
    allowing plugins to do any set up they need to do.
 
+3. The hooks are frozen into a dispatch table, so calling a hook doesn't
+   need to look anything up anymore.  Hooks registered later on still
+   work, they just thaw the table until the next freeze.
+
 """
 
 import logging
+import time
 
 from functools import wraps
 
@@ -65,6 +70,26 @@ from mediagoblin import mg_globals
 
 _log = logging.getLogger(__name__)
 
+# hook name -> tuple of callables, built by PluginManager.freeze_hooks()
+# (None while hooks are still being registered)
+_hook_table = None
+
+# Hooks whose handlers always give the same result for the same
+# arguments, so hook_handle() can remember it.  For hook names which are
+# tuples, like ('media_manager', media_type), the first item counts.
+PURE_HOOKS = set([
+    'get_media_type_and_manager',
+    'media_manager',
+    'reprocess_manager'])
+
+# (hook name, args, kwargs) -> result of the pure hooks called so far
+_hook_memo = {}
+HOOK_MEMO_SIZE = 1000
+
+# hook name -> [calls, seconds spent], while profiling with
+# enable_hook_stats()
+_hook_stats = None
+
 
 class PluginManager(object):
     """Manager for plugin things
@@ -97,6 +122,7 @@ class PluginManager(object):
         del self.routes[:]
         self.hooks.clear()
         self.template_paths.clear()
+        self.thaw_hooks()
 
     def __init__(self):
         self.__dict__ = self.__state
@@ -107,6 +133,7 @@ class PluginManager(object):
 
     def register_hooks(self, hook_mapping):
         """Takes a hook_mapping and registers all the hooks"""
+        self.thaw_hooks()
         for hook, callables in hook_mapping.items():
             if isinstance(callables, (list, tuple)):
                 self.hooks.setdefault(hook, []).extend(list(callables))
@@ -116,8 +143,24 @@ class PluginManager(object):
                 self.hooks.setdefault(hook, []).append(callables)
 
     def get_hook_callables(self, hook_name):
+        if _hook_table is not None:
+            return _hook_table.get(hook_name, ())
         return self.hooks.get(hook_name, [])
 
+    def freeze_hooks(self):
+        """Build the dispatch table of all hooks registered so far"""
+        global _hook_table
+        _hook_table = dict(
+            (hook, tuple(callables))
+            for hook, callables in self.hooks.items())
+        _hook_memo.clear()
+
+    def thaw_hooks(self):
+        """Drop the dispatch table and memoized results of pure hooks"""
+        global _hook_table
+        _hook_table = None
+        _hook_memo.clear()
+
     def register_template_path(self, path):
         """Registers a template path"""
         self.template_paths.add(path)
@@ -274,11 +317,71 @@ def get_hook_templates(hook_name):
     return PluginManager().get_template_hooks(hook_name)
 
 
+def register_pure_hooks(hook_names):
+    """
+    Declare hooks whose results only depend on their arguments
+
+    hook_handle() calls the handlers of those just once per distinct set
+    of (hashable) arguments, and reuses the result after that.
+    """
+    PURE_HOOKS.update(hook_names)
+    _hook_memo.clear()
+
+
+def enable_hook_stats(enabled=True):
+    """Start (or stop) counting calls to, and time spent in, every hook"""
+    global _hook_stats
+    _hook_stats = {} if enabled else None
+
+
+def get_hook_stats():
+    """
+    Returns a dict of hook name -> (calls, seconds), or None unless
+    enable_hook_stats() was called.
+    """
+    if _hook_stats is None:
+        return None
+    return dict(
+        (hook_name, tuple(stats))
+        for hook_name, stats in _hook_stats.items())
+
+
+def _get_hook_callables(hook_name):
+    if _hook_table is not None:
+        return _hook_table.get(hook_name, ())
+    return PluginManager().get_hook_callables(hook_name)
+
+
+def _is_pure_hook(hook_name):
+    if isinstance(hook_name, tuple):
+        hook_name = hook_name[0]
+    return hook_name in PURE_HOOKS
+
+
+def _profiled(hook_func):
+    """Record calls of hook_func in _hook_stats, if profiling"""
+    @wraps(hook_func)
+    def wrapper(hook_name, *args, **kwargs):
+        if _hook_stats is None:
+            return hook_func(hook_name, *args, **kwargs)
+
+        start = time.time()
+        try:
+            return hook_func(hook_name, *args, **kwargs)
+        finally:
+            stats = _hook_stats.setdefault(hook_name, [0, 0.0])
+            stats[0] += 1
+            stats[1] += time.time() - start
+
+    return wrapper
+
+
 #############################
 ## Hooks: The Next Generation
 #############################
 
 
+@_profiled
 def hook_handle(hook_name, *args, **kwargs):
     """
     Run through hooks attempting to find one that handle this hook.
@@ -297,25 +400,44 @@ def hook_handle(hook_name, *args, **kwargs):
     Some examples of using this:
      - You need an interface implemented, but only one fit for it
      - You need to *do* something, but only one thing needs to do it.
+
+    The result of hooks in PURE_HOOKS is memoized.
     """
     default_handler = kwargs.pop('default_handler', None)
 
-    callables = PluginManager().get_hook_callables(hook_name)
+    memo_key = None
+    if _is_pure_hook(hook_name):
+        memo_key = (hook_name, args, frozenset(kwargs.items()))
+        try:
+            if memo_key in _hook_memo:
+                result = _hook_memo[memo_key]
+                if result is None and default_handler is not None:
+                    result = default_handler(*args, **kwargs)
+                return result
+        except TypeError:
+            # Unhashable arguments, so no memoizing
+            memo_key = None
 
     result = None
 
-    for callable in callables:
+    for callable in _get_hook_callables(hook_name):
         result = callable(*args, **kwargs)
 
         if result is not None:
             break
 
+    if memo_key is not None and _hook_table is not None:
+        if len(_hook_memo) >= HOOK_MEMO_SIZE:
+            _hook_memo.clear()
+        _hook_memo[memo_key] = result
+
     if result is None and default_handler is not None:
         result = default_handler(*args, **kwargs)
 
     return result
 
 
+@_profiled
 def hook_runall(hook_name, *args, **kwargs):
     """
     Run through all callable hooks and pass in arguments.
@@ -332,11 +454,9 @@ def hook_runall(hook_name, *args, **kwargs):
      - You need to *do* something, and actually multiple plugins need
        to do it separately
     """
-    callables = PluginManager().get_hook_callables(hook_name)
-
     results = []
 
-    for callable in callables:
+    for callable in _get_hook_callables(hook_name):
         result = callable(*args, **kwargs)
 
         if result is not None:
@@ -345,6 +465,7 @@ def hook_runall(hook_name, *args, **kwargs):
     return results
 
 
+@_profiled
 def hook_transform(hook_name, arg):
     """
     Run through a bunch of hook callables and transform some input.
@@ -359,9 +480,7 @@ def hook_transform(hook_name, arg):
     """
     result = arg
 
-    callables = PluginManager().get_hook_callables(hook_name)
-
-    for callable in callables:
+    for callable in _get_hook_callables(hook_name):
         result = callable(result)
 
     return result
@@ -49,7 +49,7 @@ def setup_user_in_request(request):
         request.user = None
         return
 
-    request.user = User.query.get(request.session['user_id'])
+    request.user = request.lookups.first(User, id=request.session['user_id'])
 
     if not request.user:
         # Something's wrong... this user doesn't exist?  Invalidate
@@ -14,11 +14,14 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import hashlib
 import json
 
 import six
 import werkzeug.utils
+from werkzeug.http import is_resource_modified
 from werkzeug.wrappers import Response as wz_Response
+from mediagoblin.tools.fragment_cache import fragment_cache
 from mediagoblin.tools.template import render_template
 from mediagoblin.tools.translate import (lazy_pass_to_ugettext as _,
                                          pass_to_ugettext)
@@ -37,6 +40,28 @@ def render_to_response(request, template, context, status=200, mimetype=None):
         status=status,
         mimetype=mimetype)
 
+def cached_feed_response(request, key, make_feed):
+    """Respond with the Atom feed cached under key, or made by make_feed()
+
+    key has to change whenever the feed would, and is also the base of
+    the ETag, so polls without anything new get a 304 Not Modified.
+
+    There's no Last-Modified: the newest update doesn't change when an
+    older entry is removed from a feed, so only the ETag can tell.
+    """
+    etag = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+    if not is_resource_modified(request.environ, etag=etag):
+        response = Response(status=304)
+    else:
+        feed = fragment_cache.get(key)
+        if feed is None:
+            feed = make_feed().to_string()
+            fragment_cache.set(key, feed)
+        response = Response(feed, mimetype='application/atom+xml')
+
+    response.set_etag(etag)
+    return response
+
 def render_error(request, status=500, title=_('Oops!'),
                  err_msg=_('An error occured')):
     """Render any error page with a given error code, title and text body
@@ -18,7 +18,7 @@ import six
 
 import jinja2
 from jinja2.ext import Extension
-from jinja2.nodes import Include, Const
+from jinja2.nodes import CallBlock, Const, Include, List
 
 from babel.localedata import exists
 from werkzeug.urls import url_quote_plus
@@ -27,6 +27,7 @@ from mediagoblin import mg_globals
 from mediagoblin import messages
 from mediagoblin import _version
 from mediagoblin.tools import common
+from mediagoblin.tools.fragment_cache import fragment_cache
 from mediagoblin.tools.translate import is_rtl
 from mediagoblin.tools.translate import set_thread_locale
 from mediagoblin.tools.pluginapi import get_hook_templates, hook_transform
@@ -63,7 +64,7 @@ def get_jinja_env(app, template_loader, locale):
         undefined=jinja2.StrictUndefined,
         extensions=[
             'jinja2.ext.i18n', 'jinja2.ext.autoescape',
-            TemplateHookExtension] + local_exts)
+            TemplateHookExtension, FragmentCacheExtension] + local_exts)
 
     if six.PY2:
         template_env.install_gettext_callables(mg_globals.thread_scope.translations.ugettext,
@@ -179,3 +180,38 @@ class TemplateHookExtension(Extension):
                     True))
 
         return includes
+
+
+class FragmentCacheExtension(Extension):
+    """
+    Cache the rendered output of a template block.
+
+    Use:
+      {% cache "media_thumb", entry.id, entry.updated %}
+        ...
+      {% endcache %}
+
+    ... renders the block once per distinct key.  The key has to cover
+    everything the block depends on, see mediagoblin.tools.fragment_cache.
+    """
+
+    tags = set(["cache"])
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        key = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            key.append(parser.parse_expression())
+
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return CallBlock(
+            self.call_method('_render_cached', [List(key)]),
+            [], [], body).set_lineno(lineno)
+
+    def _render_cached(self, key, caller):
+        key = tuple(key)
+        fragment = fragment_cache.get(key)
+        if fragment is None:
+            fragment = caller()
+            fragment_cache.set(key, fragment)
+        return fragment
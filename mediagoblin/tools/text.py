@@ -14,12 +14,16 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import hashlib
+
+import six
 import wtforms
 import markdown
 from lxml.html.clean import Cleaner
 
 from mediagoblin import mg_globals
 from mediagoblin.tools import url
+from mediagoblin.tools.fragment_cache import FragmentCache
 
 
 # A super strict version of the lxml.html cleaner class
@@ -112,6 +116,10 @@ def tag_length_validator(form, field):
 UNSAFE_MARKDOWN_INSTANCE = markdown.Markdown()
 
 
+# Recently rendered markdown, keyed by the hash of the text
+MARKDOWN_CACHE = FragmentCache(max_entries=1000)
+
+
 def cleaned_markdown_conversion(text):
     """
     Take a block of text, run it through MarkDown, and clean its HTML.
@@ -121,4 +129,25 @@ def cleaned_markdown_conversion(text):
     if not text:
         return u''
 
-    return clean_html(UNSAFE_MARKDOWN_INSTANCE.convert(text))
+    if isinstance(text, six.text_type):
+        key = hashlib.sha1(text.encode('utf-8')).hexdigest()
+    else:
+        key = hashlib.sha1(text).hexdigest()
+
+    html = MARKDOWN_CACHE.get(key)
+    if html is None:
+        html = clean_html(UNSAFE_MARKDOWN_INSTANCE.convert(text))
+        MARKDOWN_CACHE.set(key, html)
+    return html
+
+
+def stored_markdown_conversion(text):
+    """
+    Rendered version of text to store in the database along with it, or
+    None if the instance doesn't store rendered markdown.
+    """
+    app_config = mg_globals.app_config
+    if not app_config or not app_config.get('store_rendered_markdown'):
+        return None
+
+    return cleaned_markdown_conversion(text)
@@ -14,6 +14,9 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import hashlib
+import json
+import logging
 import os
 import shutil
 import tempfile
@@ -21,6 +24,125 @@ import tempfile
 import six
 
 from mediagoblin._compat import py2_unicode
+from mediagoblin.storage import NotImplementedError
+from mediagoblin.tools.files import SizeBoundedDirectory
+
+_log = logging.getLogger(__name__)
+
+
+# Cache of files from remote storage
+# ----------------------------------
+
+class RemoteFileCache(object):
+    """
+    Size-bounded on-disk cache of files copied from remote storage.
+
+    Shared by all workbenches (and worker processes) using the same
+    cache_dir, so processing and reprocessing an entry over and over only
+    downloads its files once.  Entries are keyed by the storage, filepath,
+    size and ETag of the file, so a changed file is downloaded again.
+    Files of storages which can't tell their ETag aren't cached, as a
+    file rewritten at the same size (like a reprocessed derivative) would
+    look the same.  When the cache grows over max_size bytes, the least
+    recently used entries are evicted.
+
+    Workbenches get hardlinks to the cached files where possible, which
+    makes it all the more important that localized files are only read.
+    """
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        self._size_bound = SizeBoundedDirectory(cache_dir, max_size)
+
+    def _entry_path(self, storage, filepath):
+        """
+        Where the current version of filepath would be cached, or None if
+        the storage can't tell what version it is
+        """
+        try:
+            etag = storage.get_file_etag(filepath)
+            if etag is None:
+                return None
+            size = storage.get_file_size(filepath)
+        except NotImplementedError:
+            return None
+
+        key_data = json.dumps([
+            type(storage).__module__, type(storage).__name__,
+            list(filepath), size, etag])
+        key = hashlib.sha256(key_data.encode('utf-8')).hexdigest()
+        extension = os.path.splitext(filepath[-1])[1]
+        return os.path.join(self.cache_dir, key[:2], key + extension)
+
+    def _link(self, entry_path, dest_filename):
+        if os.path.exists(dest_filename):
+            os.remove(dest_filename)
+        try:
+            os.link(entry_path, dest_filename)
+        except OSError:
+            # Maybe the cache is on another file system
+            shutil.copyfile(entry_path, dest_filename)
+
+    def copy_locally(self, storage, filepath, dest_filename):
+        """
+        Like storage.copy_locally(), from the cache if possible
+        """
+        entry_path = self._entry_path(storage, filepath)
+        if entry_path is None:
+            storage.copy_locally(filepath, dest_filename)
+            return
+
+        try:
+            self._link(entry_path, dest_filename)
+        except (IOError, OSError):
+            pass
+        else:
+            self.stats['hits'] += 1
+            # Mark as recently used
+            try:
+                os.utime(entry_path, None)
+            except OSError:
+                pass
+            return
+
+        self.stats['misses'] += 1
+        storage.copy_locally(filepath, dest_filename)
+
+        if os.path.getsize(dest_filename) > self.max_size:
+            return
+        entry_dir = os.path.dirname(entry_path)
+        try:
+            if not os.path.exists(entry_dir):
+                os.makedirs(entry_dir)
+            # Copy under a temporary name first, so nobody ever sees half
+            # of an entry
+            with tempfile.NamedTemporaryFile(
+                    dir=entry_dir, delete=False) as tmp_file:
+                with open(dest_filename, 'rb') as local_file:
+                    shutil.copyfileobj(local_file, tmp_file)
+            os.rename(tmp_file.name, entry_path)
+        except (IOError, OSError) as exc:
+            _log.warn('Could not cache {0}: {1}'.format(filepath, exc))
+            return
+
+        self.stats['evictions'] += len(self._size_bound.added(
+            os.path.getsize(entry_path)))
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits
+        max_size again
+        """
+        self.stats['evictions'] += len(self._size_bound.evict())
+
+    def get_stats(self):
+        """
+        How many files this process found in the cache, had to download,
+        and evicted
+        """
+        return dict(self.stats)
+
 
 # Actual workbench stuff
 # ----------------------
@@ -34,12 +156,13 @@ class Workbench(object):
     WARNING: DO NOT create Workbench objects on your own,
     let the WorkbenchManager do that for you!
     """
-    def __init__(self, dir):
+    def __init__(self, dir, cache=None):
         """
         WARNING: DO NOT create Workbench objects on your own,
         let the WorkbenchManager do that for you!
         """
         self.dir = dir
+        self.cache = cache
 
     def __str__(self):
         return six.text_type(self.dir)
@@ -61,8 +184,9 @@ class Workbench(object):
         purposes, modifications should be written to a new file.).
 
         If the file is already local, just return the absolute filename of that
-        local file.  Otherwise, copy the file locally to the workbench, and
-        return the absolute path of the new file.
+        local file.  Otherwise, copy the file locally to the workbench (from
+        the RemoteFileCache, if there is one), and return the absolute path
+        of the new file.
 
         If it is copying locally, we might want to require a filename like
         "source.jpg" to ensure that we won't conflict with other filenames in
@@ -112,8 +236,12 @@ class Workbench(object):
                 self.dir, dest_filename)
 
             # copy it over
-            storage.copy_locally(
-                filepath, full_dest_filename)
+            if self.cache is not None:
+                self.cache.copy_locally(
+                    storage, filepath, full_dest_filename)
+            else:
+                storage.copy_locally(
+                    filepath, full_dest_filename)
 
             return full_dest_filename
 
@@ -154,13 +282,15 @@ class WorkbenchManager(object):
     wrapper.
     """
 
-    def __init__(self, base_workbench_dir):
+    def __init__(self, base_workbench_dir, cache=None):
         self.base_workbench_dir = os.path.abspath(base_workbench_dir)
         if not os.path.exists(self.base_workbench_dir):
             os.makedirs(self.base_workbench_dir)
+        self.cache = cache
 
     def create(self):
         """
         Create and return the path to a new workbench (directory).
         """
-        return Workbench(tempfile.mkdtemp(dir=self.base_workbench_dir))
+        return Workbench(tempfile.mkdtemp(dir=self.base_workbench_dir),
+                         self.cache)
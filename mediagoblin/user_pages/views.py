@@ -23,11 +23,12 @@ import six
 from mediagoblin import messages, mg_globals
 from mediagoblin.db.models import (MediaEntry, MediaTag, Collection,
                                    CollectionItem, User)
+from mediagoblin.db.util import query_version
 from mediagoblin.tools.response import render_to_response, render_404, \
-    redirect, redirect_obj
+    redirect, redirect_obj, cached_feed_response
 from mediagoblin.tools.text import cleaned_markdown_conversion
 from mediagoblin.tools.translate import pass_to_ugettext as _
-from mediagoblin.tools.pagination import Pagination
+from mediagoblin.tools.pagination import Pagination, KeysetPagination
 from mediagoblin.tools.federation import create_activity
 from mediagoblin.user_pages import forms as user_forms
 from mediagoblin.user_pages.lib import (send_comment_email,
@@ -54,7 +55,7 @@ _log.setLevel(logging.DEBUG)
 @uses_pagination
 def user_home(request, page):
     """'Homepage' of a User()"""
-    user = User.query.filter_by(username=request.matchdict['user']).first()
+    user = request.lookups.first(User, username=request.matchdict['user'])
     if not user:
         return render_404(request)
     elif not user.has_privilege(u'active'):
@@ -67,7 +68,8 @@ def user_home(request, page):
         filter_by(uploader = user.id,
                   state = u'processed').order_by(MediaEntry.created.desc())
 
-    pagination = Pagination(page, cursor)
+    pagination = KeysetPagination(page, cursor,
+                                  marker=request.pagination_marker)
     media_entries = pagination()
 
     #if no data is available, return NotFound
@@ -103,7 +105,8 @@ def user_gallery(request, page, url_user=None):
                 MediaTag.slug == request.matchdict['tag']))
 
     # Paginate gallery
-    pagination = Pagination(page, cursor)
+    pagination = KeysetPagination(page, cursor,
+                                  marker=request.pagination_marker)
     media_entries = pagination()
 
     #if no data is available, return NotFound
@@ -129,20 +132,16 @@ def media_home(request, media, page, **kwargs):
     'Homepage' of a MediaEntry()
     """
     comment_id = request.matchdict.get('comment', None)
-    if comment_id:
-        if request.user:
-            mark_comment_notification_seen(comment_id, request.user)
-
-        pagination = Pagination(
-            page, media.get_comments(
-                mg_globals.app_config['comments_ascending']),
-            MEDIA_COMMENTS_PER_PAGE,
-            comment_id)
-    else:
-        pagination = Pagination(
-            page, media.get_comments(
-                mg_globals.app_config['comments_ascending']),
-            MEDIA_COMMENTS_PER_PAGE)
+    if comment_id and request.user:
+        mark_comment_notification_seen(comment_id, request.user)
+
+    ascending = mg_globals.app_config['comments_ascending']
+    pagination = KeysetPagination(
+        page, media.get_comments(ascending),
+        MEDIA_COMMENTS_PER_PAGE,
+        comment_id,
+        marker=request.pagination_marker,
+        ascending=ascending)
 
     comments = pagination()
 
@@ -350,9 +349,10 @@ def media_confirm_delete(request, media):
 @uses_pagination
 def user_collection(request, page, url_user=None):
     """A User-defined Collection"""
-    collection = Collection.query.filter_by(
-        get_creator=url_user,
-        slug=request.matchdict['collection']).first()
+    collection = request.lookups.first(
+        Collection,
+        creator=url_user.id,
+        slug=request.matchdict['collection'])
 
     if not collection:
         return render_404(request)
@@ -485,131 +485,149 @@ def atom_feed(request):
     """
     generates the atom feed with the newest images
     """
-    user = User.query.filter_by(
-        username = request.matchdict['user']).first()
+    user = request.lookups.first(User, username=request.matchdict['user'])
     if not user or not user.has_privilege(u'active'):
         return render_404(request)
 
-    cursor = MediaEntry.query.filter_by(
+    entries = MediaEntry.query.filter_by(
         uploader = user.id,
-        state = u'processed').\
-        order_by(MediaEntry.created.desc()).\
-        limit(ATOM_DEFAULT_NR_OF_UPDATED_ITEMS)
-
-    """
-    ATOM feed id is a tag URI (see http://en.wikipedia.org/wiki/Tag_URI)
-    """
-    atomlinks = [{
-           'href': request.urlgen(
-               'mediagoblin.user_pages.user_home',
-               qualified=True, user=request.matchdict['user']),
-           'rel': 'alternate',
-           'type': 'text/html'
-           }]
-
-    if mg_globals.app_config["push_urls"]:
-        for push_url in mg_globals.app_config["push_urls"]:
-            atomlinks.append({
-                'rel': 'hub',
-                'href': push_url})
-
-    feed = AtomFeed(
-               "MediaGoblin: Feed for user '%s'" % request.matchdict['user'],
-               feed_url=request.url,
-               id='tag:{host},{year}:gallery.user-{user}'.format(
-                   host=request.host,
-                   year=datetime.datetime.today().strftime('%Y'),
-                   user=request.matchdict['user']),
-               links=atomlinks)
-
-    for entry in cursor:
-        feed.add(entry.get('title'),
-            entry.description_html,
-            id=entry.url_for_self(request.urlgen, qualified=True),
-            content_type='html',
-            author={
-                'name': entry.get_uploader.username,
-                'uri': request.urlgen(
-                    'mediagoblin.user_pages.user_home',
-                    qualified=True, user=entry.get_uploader.username)},
-            updated=entry.get('created'),
-            links=[{
-                'href': entry.url_for_self(
-                    request.urlgen,
-                    qualified=True),
-                'rel': 'alternate',
-                'type': 'text/html'}])
-
-    return feed.get_response()
+        state = u'processed')
+    count, last_modified = query_version(entries, MediaEntry.updated)
+
+    def make_feed():
+        cursor = entries.order_by(MediaEntry.created.desc()).\
+            limit(ATOM_DEFAULT_NR_OF_UPDATED_ITEMS)
+
+        """
+        ATOM feed id is a tag URI (see http://en.wikipedia.org/wiki/Tag_URI)
+        """
+        atomlinks = [{
+               'href': request.urlgen(
+                   'mediagoblin.user_pages.user_home',
+                   qualified=True, user=request.matchdict['user']),
+               'rel': 'alternate',
+               'type': 'text/html'
+               }]
+
+        if mg_globals.app_config["push_urls"]:
+            for push_url in mg_globals.app_config["push_urls"]:
+                atomlinks.append({
+                    'rel': 'hub',
+                    'href': push_url})
+
+        feed = AtomFeed(
+                   "MediaGoblin: Feed for user '%s'" % request.matchdict['user'],
+                   feed_url=request.base_url,
+                   id='tag:{host},{year}:gallery.user-{user}'.format(
+                       host=request.host,
+                       year=datetime.datetime.today().strftime('%Y'),
+                       user=request.matchdict['user']),
+                   links=atomlinks)
+
+        for entry in cursor:
+            feed.add(entry.get('title'),
+                entry.description_html,
+                id=entry.url_for_self(request.urlgen, qualified=True),
+                content_type='html',
+                author={
+                    'name': entry.get_uploader.username,
+                    'uri': request.urlgen(
+                        'mediagoblin.user_pages.user_home',
+                        qualified=True, user=entry.get_uploader.username)},
+                updated=entry.get('created'),
+                links=[{
+                    'href': entry.url_for_self(
+                        request.urlgen,
+                        qualified=True),
+                    'rel': 'alternate',
+                    'type': 'text/html'}])
+
+        return feed
+
+    return cached_feed_response(
+        request,
+        (u'user_feed', user.id, request.base_url, count, last_modified),
+        make_feed)
 
 
 def collection_atom_feed(request):
     """
     generates the atom feed with the newest images from a collection
     """
-    user = User.query.filter_by(
-        username = request.matchdict['user']).first()
+    user = request.lookups.first(User, username=request.matchdict['user'])
     if not user or not user.has_privilege(u'active'):
         return render_404(request)
 
-    collection = Collection.query.filter_by(
-               creator=user.id,
-               slug=request.matchdict['collection']).first()
+    collection = request.lookups.first(
+        Collection,
+        creator=user.id,
+        slug=request.matchdict['collection'])
     if not collection:
         return render_404(request)
 
-    cursor = CollectionItem.query.filter_by(
-                 collection=collection.id) \
-                 .order_by(CollectionItem.added.desc()) \
-                 .limit(ATOM_DEFAULT_NR_OF_UPDATED_ITEMS)
-
-    """
-    ATOM feed id is a tag URI (see http://en.wikipedia.org/wiki/Tag_URI)
-    """
-    atomlinks = [{
-           'href': collection.url_for_self(request.urlgen, qualified=True),
-           'rel': 'alternate',
-           'type': 'text/html'
-           }]
-
-    if mg_globals.app_config["push_urls"]:
-        for push_url in mg_globals.app_config["push_urls"]:
-            atomlinks.append({
-                'rel': 'hub',
-                'href': push_url})
-
-    feed = AtomFeed(
-                "MediaGoblin: Feed for %s's collection %s" %
-                (request.matchdict['user'], collection.title),
-                feed_url=request.url,
-                id=u'tag:{host},{year}:gnu-mediagoblin.{user}.collection.{slug}'\
-                    .format(
-                    host=request.host,
-                    year=collection.created.strftime('%Y'),
-                    user=request.matchdict['user'],
-                    slug=collection.slug),
-                links=atomlinks)
-
-    for item in cursor:
-        entry = item.get_media_entry
-        feed.add(entry.get('title'),
-            item.note_html,
-            id=entry.url_for_self(request.urlgen, qualified=True),
-            content_type='html',
-            author={
-                'name': entry.get_uploader.username,
-                'uri': request.urlgen(
-                    'mediagoblin.user_pages.user_home',
-                    qualified=True, user=entry.get_uploader.username)},
-            updated=item.get('added'),
-            links=[{
-                'href': entry.url_for_self(
-                    request.urlgen,
-                    qualified=True),
-                'rel': 'alternate',
-                'type': 'text/html'}])
-
-    return feed.get_response()
+    items = CollectionItem.query.filter_by(
+                 collection=collection.id)
+    count, last_added, last_updated = query_version(
+        items.join(CollectionItem.get_media_entry),
+        CollectionItem.added, MediaEntry.updated)
+
+    def make_feed():
+        cursor = items.order_by(CollectionItem.added.desc()) \
+                     .limit(ATOM_DEFAULT_NR_OF_UPDATED_ITEMS)
+
+        """
+        ATOM feed id is a tag URI (see http://en.wikipedia.org/wiki/Tag_URI)
+        """
+        atomlinks = [{
+               'href': collection.url_for_self(request.urlgen, qualified=True),
+               'rel': 'alternate',
+               'type': 'text/html'
+               }]
+
+        if mg_globals.app_config["push_urls"]:
+            for push_url in mg_globals.app_config["push_urls"]:
+                atomlinks.append({
+                    'rel': 'hub',
+                    'href': push_url})
+
+        feed = AtomFeed(
+                    "MediaGoblin: Feed for %s's collection %s" %
+                    (request.matchdict['user'], collection.title),
+                    feed_url=request.base_url,
+                    id=u'tag:{host},{year}:gnu-mediagoblin.{user}.collection.{slug}'\
+                        .format(
+                        host=request.host,
+                        year=collection.created.strftime('%Y'),
+                        user=request.matchdict['user'],
+                        slug=collection.slug),
+                    links=atomlinks)
+
+        for item in cursor:
+            entry = item.get_media_entry
+            feed.add(entry.get('title'),
+                item.note_html,
+                id=entry.url_for_self(request.urlgen, qualified=True),
+                content_type='html',
+                author={
+                    'name': entry.get_uploader.username,
+                    'uri': request.urlgen(
+                        'mediagoblin.user_pages.user_home',
+                        qualified=True, user=entry.get_uploader.username)},
+                updated=item.get('added'),
+                links=[{
+                    'href': entry.url_for_self(
+                        request.urlgen,
+                        qualified=True),
+                    'rel': 'alternate',
+                    'type': 'text/html'}])
+
+        return feed
+
+    return cached_feed_response(
+        request,
+        (u'collection_feed', collection.id, request.base_url,
+         collection.title, count, last_added, last_updated),
+        make_feed)
 
 @require_active_login
 def processing_panel(request):
@@ -617,7 +635,7 @@ def processing_panel(request):
     Show to the user what media is still in conversion/processing...
     and what failed, and why!
     """
-    user = User.query.filter_by(username=request.matchdict['user']).first()
+    user = request.lookups.first(User, username=request.matchdict['user'])
     # TODO: XXX: Should this be a decorator?
     #
     # Make sure we have permission to access this user's panel.  Only
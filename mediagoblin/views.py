@@ -16,7 +16,7 @@
 
 from mediagoblin import mg_globals
 from mediagoblin.db.models import MediaEntry
-from mediagoblin.tools.pagination import Pagination
+from mediagoblin.tools.pagination import KeysetPagination
 from mediagoblin.tools.pluginapi import hook_handle
 from mediagoblin.tools.response import render_to_response, render_404, redirect
 from mediagoblin.decorators import uses_pagination, user_not_banned, require_active_login
@@ -34,7 +34,8 @@ def default_root_view(request, page):
     cursor = request.db.query(MediaEntry).filter_by(state=u'processed').\
         order_by(MediaEntry.created.desc())
 
-    pagination = Pagination(page, cursor)
+    pagination = KeysetPagination(page, cursor,
+                                  marker=request.pagination_marker)
     media_entries = pagination()
     return render_to_response(
         request, 'mediagoblin/root.html',
@@ -95,6 +95,12 @@ install_requires = [
     # 'Pillow',
 ] + pyversion_install_requires
 
+# What the media types which aren't enabled by default need from PyPI,
+# install them with eg. `pip install -e .[stl]`
+extras_require = {
+    'stl': ['numpy'],
+}
+
 dependency_links = []
 if not PY2:
     # PyPI version (1.4.2) does not have proper Python 3 support
@@ -113,6 +119,7 @@ try:
     include_package_data = True,
     # scripts and dependencies
     install_requires=install_requires,
+    extras_require=extras_require,
     dependency_links=dependency_links,
     test_suite='nose.collector',
     entry_points="""\